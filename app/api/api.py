@@ -1,17 +1,34 @@
+from enum import Enum
 import logging
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends
-from pydantic import BaseModel
-from rtree import index
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
+from starlette.status import (HTTP_404_NOT_FOUND, HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                              HTTP_422_UNPROCESSABLE_ENTITY, HTTP_503_SERVICE_UNAVAILABLE)
 
 import api.geometry as geom
+import api.queries as queries
+from api.cache import MISSING, cache
+from api.catalog import catalog
+from api.config import get_setting
+from api.encoding import FastJSONResponse
 from api.dependencies import get_token
+from api.executor import PoolSaturated, pool
+from api.metrics import metrics, points_total
+from api.queries import DEFAULT_FOV, SearchOptions, View
+from api.registry import STORE_KIND, registry
+from api.store import AddressColumns, BuildingColumns
 from commands.util import Timer
 
 router = APIRouter(dependencies=[Depends(get_token)])
 logger = logging.getLogger(__name__)
 
+MAX_BATCH_SIZE = get_setting('GIS_MAX_BATCH_SIZE', 1000, int)
+MAX_K = get_setting('GIS_MAX_K', 500, int)
+
+registry.on_reload(cache.invalidate)
+
 class CoordinateOut(BaseModel):
     latitude: float
     longitude: float
@@ -35,7 +52,7 @@ class AddressOut(BaseModel):
 
 class IntersectionResult(BaseModel):
     idx: int
-    t: float
+    t: float = Field(..., description="Distance in meters from the ray's origin to the hit")
     addresses: List[str]
     point: CoordinateOut
     normal: PointOut
@@ -48,71 +65,305 @@ class IntersectionOut(BaseModel):
     result: List[IntersectionResult]
 
 
-@router.get('/addresses', response_model=AddressOut)
-async def get_rtree_addresses(region: str, lat: float, lon: float):
-    rtree = index.Index(f"gis_data/addresses_{region}_rtree")
-    with Timer("Querying for nearest"):
-        result = []
-        for address in rtree.nearest((lon, lat), num_results=50, objects='raw'):
-            model = AddressResult(
-                address=address.full_address_without_region,
-                coord=CoordinateOut(latitude=address.center[1], longitude=address.center[0])
-            )
-            result.append(model.dict())
-    return {
+class TraversalMode(str, Enum):
+    nearest = 'nearest'
+    ray = 'ray'
+
+
+class QueryPoint(BaseModel):
+    lat: float
+    lon: float
+    heading: Optional[float]
+
+
+class BatchQuery(BaseModel):
+    region: Optional[str]
+    points: List[QueryPoint]
+    k: int = Field(50, ge=1, le=MAX_K)
+    max_distance_m: Optional[float] = Field(None, gt=0)
+    mode: TraversalMode = TraversalMode.nearest
+    max_hits: Optional[int] = Field(None, ge=1)
+    visible: bool = False
+    elevation_m: Optional[float]
+    pitch: float = Field(0.0, ge=-90, le=90)
+    fov: float = Field(DEFAULT_FOV, gt=0, le=180)
+
+    def options(self) -> SearchOptions:
+        return SearchOptions(self.k, self.max_distance_m, self.mode.value, self.max_hits,
+                             viewer(self.visible, self.elevation_m, self.pitch, self.fov))
+
+
+class BatchAddressOut(BaseModel):
+    count: int
+    results: List[AddressOut]
+
+
+class BatchIntersectionOut(BaseModel):
+    count: int
+    results: List[IntersectionOut]
+
+
+def viewer(visible: bool, elevation_m: Optional[float], pitch: float, fov: float) -> Optional[View]:
+    return View(elevation_m, pitch, fov) if visible else None
+
+
+def not_found(region: str) -> HTTPException:
+    return HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f'No index for region {region}.')
+
+
+def resolve_regions(region: Optional[str], items: list) -> Dict[str, List[int]]:
+    """
+    Positions of `items` by region: all of them in `region` if one was
+    given, otherwise in the region each point falls in.
+
+    Raises:
+        HTTPException if a point isn't in any region.
+    """
+    if region is not None:
+        return {region: list(range(len(items)))}
+    groups: Dict[str, List[int]] = {}
+    for i, item in enumerate(items):
+        lon, lat = item[0], item[1]
+        resolved = catalog.resolve(lon, lat)
+        if resolved is None:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f'No region covers {lat}, {lon}.')
+        groups.setdefault(resolved, []).append(i)
+    return groups
+
+
+def region_label(groups: Dict[str, List[int]]) -> str:
+    return next(iter(groups)) if len(groups) == 1 else 'multiple'
+
+
+def check_batch(query: BatchQuery, needs_heading: bool = False):
+    if len(query.points) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f'Batches are limited to {MAX_BATCH_SIZE} points.')
+    if needs_heading and any(p.heading is None for p in query.points):
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='Every point needs a heading.')
+
+
+def coordinate(lon: float, lat: float) -> dict:
+    return {'latitude': lat, 'longitude': lon}
+
+
+def address_results(addresses: AddressColumns) -> List[dict]:
+    """
+    `AddressResult`s as plain dicts, built straight from the columns.
+    """
+    return [{'address': address, 'coord': coordinate(*center), 'polygon_coords': None}
+            for address, center in zip(addresses.address, addresses.center.tolist())]
+
+
+def building_results(buildings: BuildingColumns) -> List[dict]:
+    return [{'address': "Some",
+             'coord': coordinate(*center),
+             'polygon_coords': [coordinate(*p) for p in mbr]}
+            for center, mbr in zip(buildings.center.tolist(), buildings.mbr.tolist())]
+
+
+def intersection_results(isects: queries.Intersections, ray: int) -> List[dict]:
+    """
+    `IntersectionResult`s for one ray as plain dicts.
+    """
+    hits, buildings = isects.hits, isects.buildings
+    rows = isects.for_ray(ray)
+    owners = hits.owner[rows]
+    heights = geom.heights_in_meters(buildings.height[owners]).tolist()
+    return [{'idx': idx,
+             't': t,
+             'addresses': isects.addresses[i],
+             'point': coordinate(*point),
+             'normal': {'x': normal[0], 'y': normal[1]},
+             'face_length': face_length,
+             'face_height': height}
+            for i, idx, t, point, normal, face_length, height in zip(
+                rows.tolist(), buildings.idx[owners].tolist(), hits.t[rows].tolist(),
+                hits.point[rows].tolist(), hits.normal[rows].tolist(),
+                hits.face_length[rows].tolist(), heights)]
+
+
+def find_addresses(region: str, points: List[Tuple[float, float]],
+                   options: SearchOptions) -> List[List[dict]]:
+    with Timer(f"Querying for nearest addresses to {len(points)} points", stage='query'):
+        batches = queries.nearest_addresses_many(region, points, options.k, options.max_distance_m)
+        metrics.count(points_total, len(points))
+        with Timer(f"Building results for {len(points)} points", stage='results'):
+            return [address_results(a) for a in batches]
+
+
+def find_buildings(region: str, points: List[Tuple[float, float]],
+                   options: SearchOptions) -> List[List[dict]]:
+    with Timer(f"Querying for nearest buildings to {len(points)} points", stage='query'):
+        batches = queries.nearest_buildings_many(region, points, options.k, options.max_distance_m)
+        metrics.count(points_total, len(points))
+        with Timer(f"Building results for {len(points)} points", stage='results'):
+            return [building_results(b) for b in batches]
+
+
+def find_intersections(region: str, rays: List[Tuple[float, float, float]],
+                       options: SearchOptions) -> List[List[dict]]:
+    with Timer(f"Calculating intersection for {len(rays)} rays", stage='query'):
+        isects = queries.intersect_many(region, rays, options)
+        metrics.count(points_total, len(rays))
+        with Timer(f"Building results for {len(rays)} rays", stage='results'):
+            return [intersection_results(isects, ray) for ray in range(len(rays))]
+
+
+async def run_query(fn: Callable, groups: Dict[str, List[int]], items: list, options: SearchOptions) -> list:
+    """
+    Run a blocking query for each region's share of `items`, as grouped by
+    `resolve_regions`, and return the results in the order of `items`.
+    """
+    if len(groups) == 1:
+        region, = groups
+        return await run_region_query(fn, region, items, options)
+    results = [None] * len(items)
+    for region, positions in groups.items():
+        with metrics.labels(region=region):
+            found = await run_region_query(fn, region, [items[i] for i in positions], options)
+        for i, result in zip(positions, found):
+            results[i] = result
+    return results
+
+
+def cached_query(fn: Callable, region: str, items: list, options: SearchOptions) -> list:
+    """
+    Answer the points of `items` that have a cached result from the cache
+    and run `fn` for the rest. Runs on the query pool, since the index
+    version can open the region and a shared cache reads SQLite.
+    """
+    keys = cache.keys(fn.__name__, region, registry.version(region), items, options)
+    results = cache.get_many(keys)
+    missing = [i for i, result in enumerate(results) if result is MISSING]
+    if missing:
+        found = fn(region, [items[i] for i in missing], options)
+        cache.put_many([keys[i] for i in missing], found)
+        for i, result in zip(missing, found):
+            results[i] = result
+    return results
+
+
+async def run_region_query(fn: Callable, region: str, items: list, options: SearchOptions) -> list:
+    """
+    Run a blocking query on the worker pool, through the cache if it is
+    enabled, mapping its failures to HTTP errors. An index that disagrees
+    with the database, or a database that is missing or locked, is a 503:
+    the request can succeed once a rebuild or update has finished.
+    """
+    try:
+        if not cache.enabled:
+            return await pool.run(fn, region, items, options)
+        return await pool.run(cached_query, fn, region, items, options)
+    except PoolSaturated as e:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail='Server is busy.',
+                            headers={'Retry-After': '1'}) from e
+    except FileNotFoundError as e:
+        raise not_found(region) from e
+    except KeyError as e:
+        logger.exception("The index of %s disagrees with the database", region)
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=f'Region {region} is being updated, try again.',
+                            headers={'Retry-After': '1'}) from e
+    except queries.DatabaseUnavailable as e:
+        logger.exception("Could not read the database for %s", region)
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail='Database is unavailable.',
+                            headers={'Retry-After': '1'}) from e
+
+
+def single_out(results: list) -> FastJSONResponse:
+    result, = results
+    return FastJSONResponse({
         'count': len(result),
         'result': result
-    }
+    })
+
+
+def batch_out(results: list) -> FastJSONResponse:
+    return FastJSONResponse({
+        'count': len(results),
+        'results': [{'count': len(r), 'result': r} for r in results]
+    })
+
+
+@router.get('/addresses', response_model=AddressOut)
+async def get_rtree_addresses(lat: float, lon: float, region: Optional[str] = None,
+                              k: int = Query(50, ge=1, le=MAX_K),
+                              max_distance_m: Optional[float] = Query(None, gt=0)):
+    options = SearchOptions(k, max_distance_m)
+    groups = resolve_regions(region, [(lon, lat)])
+    with metrics.labels(route='/addresses', region=region_label(groups)):
+        return single_out(await run_query(find_addresses, groups, [(lon, lat)], options))
 
 @router.get('/buildings', response_model=AddressOut)
-async def get_rtree_buildings(region: str, lat: float, lon: float):
-    rtree = index.Index(f"gis_data/buildings_{region}_rtree")
-    with Timer("Querying for nearest"):
-        result = []
-        for building in rtree.nearest((lon, lat), num_results=50, objects='raw'):
-            polygon = building.min_bounding_rect
-            polygon_coords = [CoordinateOut(latitude=p[1], longitude=p[0]) for p in polygon]
-            model = AddressResult(
-                address="Some",
-                coord=CoordinateOut(latitude=building.center[1], longitude=building.center[0]),
-                polygon_coords=polygon_coords
-            )
-            result.append(model.dict())
-    return {
-        'count': len(result),
-        'result': result
-    }
+async def get_rtree_buildings(lat: float, lon: float, region: Optional[str] = None,
+                              k: int = Query(50, ge=1, le=MAX_K),
+                              max_distance_m: Optional[float] = Query(None, gt=0)):
+    options = SearchOptions(k, max_distance_m)
+    groups = resolve_regions(region, [(lon, lat)])
+    with metrics.labels(route='/buildings', region=region_label(groups)):
+        return single_out(await run_query(find_buildings, groups, [(lon, lat)], options))
 
 @router.get('/intersect', response_model=IntersectionOut)
-async def get_intersection(region: str, lat: float, lon: float, heading: float):
-    building_rtree = index.Index(f"gis_data/buildings_{region}_rtree")
-    address_rtree = index.Index(f"gis_data/addresses_{region}_rtree")
-    with Timer("Calculating intersection:"):
-        buildings = list(building_rtree.nearest((lon, lat), num_results=50, objects='raw'))
-        t_vals, indices = [], []
-        ray = geom.Ray((lon, lat), heading)
-        for i, building in enumerate(buildings):
-            isects = [ray.line_intersection(l) for l in building.lines_for_shape]
-            ts = [t for t in isects if t]
-            if len(ts) > 1:
-                t_vals.append(min(ts, key=lambda t: t[0]))
-                indices.append(i)
-        pts = [tuple(t[1]) for t in t_vals]
-        normals = [t[2] for t in t_vals]
-        face_lengths = [t[3] for t in t_vals]
-        t_vals = [t[0] for t in t_vals]
-        result = []
-        for i, idx in enumerate(indices):
-            addresses = [a.full_address_with_region for a in address_rtree.nearest(pts[i], 3, objects='raw')]
-            result.append(IntersectionResult(idx=buildings[idx].idx,
-                                             t=t_vals[i],
-                                             addresses=addresses,
-                                             point=CoordinateOut(latitude=pts[i][1], longitude=pts[i][0]),
-                                             normal=PointOut(x=normals[i][0], y=normals[i][1]),
-                                             face_length=face_lengths[i],
-                                             face_height=buildings[idx].height * geom.FT_TO_M or 5.0))
-        result.sort(key=lambda r: r.t)
+async def get_intersection(lat: float, lon: float, heading: float, region: Optional[str] = None,
+                           k: int = Query(50, ge=1, le=MAX_K),
+                           max_distance_m: Optional[float] = Query(None, gt=0),
+                           mode: TraversalMode = TraversalMode.nearest,
+                           max_hits: Optional[int] = Query(None, ge=1),
+                           visible: bool = False, elevation_m: Optional[float] = None,
+                           pitch: float = Query(0.0, ge=-90, le=90),
+                           fov: float = Query(DEFAULT_FOV, gt=0, le=180)):
+    options = SearchOptions(k, max_distance_m, mode.value, max_hits, viewer(visible, elevation_m, pitch, fov))
+    groups = resolve_regions(region, [(lon, lat, heading)])
+    with metrics.labels(route='/intersect', region=region_label(groups)):
+        return single_out(await run_query(find_intersections, groups, [(lon, lat, heading)], options))
+
+@router.post('/addresses/batch', response_model=BatchAddressOut)
+async def post_rtree_addresses(query: BatchQuery):
+    check_batch(query)
+    points = [(p.lon, p.lat) for p in query.points]
+    groups = resolve_regions(query.region, points)
+    with metrics.labels(route='/addresses/batch', region=region_label(groups)):
+        return batch_out(await run_query(find_addresses, groups, points, query.options()))
+
+@router.post('/buildings/batch', response_model=BatchAddressOut)
+async def post_rtree_buildings(query: BatchQuery):
+    check_batch(query)
+    points = [(p.lon, p.lat) for p in query.points]
+    groups = resolve_regions(query.region, points)
+    with metrics.labels(route='/buildings/batch', region=region_label(groups)):
+        return batch_out(await run_query(find_buildings, groups, points, query.options()))
+
+@router.post('/intersect/batch', response_model=BatchIntersectionOut)
+async def post_intersection(query: BatchQuery):
+    check_batch(query, needs_heading=True)
+    rays = [(p.lon, p.lat, p.heading) for p in query.points]
+    groups = resolve_regions(query.region, rays)
+    with metrics.labels(route='/intersect/batch', region=region_label(groups)):
+        return batch_out(await run_query(find_intersections, groups, rays, query.options()))
+
+@router.get('/stats/pool')
+async def get_pool_stats():
     return {
-        'count': len(result),
-        'result': result
+        'workers': pool.workers,
+        'queue_depth': pool.queue_depth,
+        'in_flight': pool.in_flight,
+        **pool.stats.as_dict()
     }
+
+@router.get('/stats/cache')
+async def get_cache_stats():
+    return cache.as_dict()
+
+@router.get('/stats/regions')
+async def get_region_stats():
+    return registry.as_dict()
+
+@router.get('/regions')
+async def get_regions():
+    loaded = registry.loaded()
+    return {'regions': [{'region': info.region, 'bbox': list(info.bbox), 'buildings': info.buildings,
+                         'addresses': info.addresses, 'size_bytes': info.size_bytes,
+                         'store': STORE_KIND in info.paths, 'loaded': info.region in loaded}
+                        for info in catalog.entries().values()]}
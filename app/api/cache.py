@@ -0,0 +1,303 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Sequence
+
+from api.config import get_setting
+from api.geometry import meters_to_degrees
+from api.metrics import Sample
+
+MISSING = object()
+TRIM_INTERVAL = 100
+
+logger = logging.getLogger(__name__)
+
+
+def quantize(item: Sequence[float], grid_m: float, heading_deg: float) -> tuple:
+    """
+    Snap a (lon, lat) or (lon, lat, heading) query to its grid cell and heading
+    bucket. Queries that land in the same cell share one cache entry, so a
+    cached result can belong to a point up to one cell away.
+    """
+    lon, lat = item[0], item[1]
+    _, dlat = meters_to_degrees(lat, grid_m)
+    cell_lat = round(lat / dlat)
+    dlon, _ = meters_to_degrees(cell_lat * dlat, grid_m)
+    cell = (round(lon / dlon), cell_lat)
+    if len(item) > 2:
+        buckets = max(int(round(360.0 / heading_deg)), 1)
+        cell += (int(round((item[2] % 360.0) / 360.0 * buckets)) % buckets,)
+    return cell
+
+
+class CacheStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    def add(self, **counts: int):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'errors': self.errors
+            }
+
+
+class MemoryBackend:
+
+    def __init__(self, max_entries: int, ttl: float, stats: CacheStats):
+        """
+        Per-process LRU of query results, each kept for at most `ttl` seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = stats
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < now:
+                del self._entries[key]
+                self.stats.add(expirations=1)
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.add(evictions=evicted)
+
+    def invalidate(self, region: str) -> int:
+        with self._lock:
+            stale = [key for key in self._entries if key[1] == region]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedBackend:
+
+    def __init__(self, path: str, max_entries: int, ttl: float, stats: CacheStats):
+        """
+        LRU shared by every worker process on a host, kept in a SQLite file.
+        Put `path` on a memory-backed filesystem such as /dev/shm so lookups
+        never touch the disk. Values are pickled; each thread has its own
+        connection, opened again after a fork so that workers forked from a
+        preloaded master never share one.
+
+        Counting the entries is a scan of the table, so each process trims
+        back to `max_entries` only once every TRIM_INTERVAL puts: the file can
+        hold up to TRIM_INTERVAL entries per worker over `max_entries`.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = stats
+        self._local = threading.local()
+        self._puts = 0
+        self._puts_lock = threading.Lock()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, region TEXT NOT NULL, "
+                       "value BLOB NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=1.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: Hashable) -> Any:
+        db = self._connection()
+        now = time.time()
+        row = db.execute("SELECT value, expires FROM cache WHERE key = ?", (repr(key),)).fetchone()
+        if row is None:
+            return MISSING
+        with db:
+            if row[1] < now:
+                db.execute("DELETE FROM cache WHERE key = ?", (repr(key),))
+            else:
+                db.execute("UPDATE cache SET used = ? WHERE key = ?", (now, repr(key)))
+        if row[1] < now:
+            self.stats.add(expirations=1)
+            return MISSING
+        return pickle.loads(row[0])
+
+    def _should_trim(self) -> bool:
+        with self._puts_lock:
+            self._puts += 1
+            if self._puts < TRIM_INTERVAL:
+                return False
+            self._puts = 0
+            return True
+
+    def put(self, key: Hashable, value: Any):
+        db = self._connection()
+        now = time.time()
+        excess = 0
+        with db:
+            db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                       (repr(key), key[1], pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        now + self.ttl, now))
+            if self._should_trim():
+                excess = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                db.execute("DELETE FROM cache WHERE key IN "
+                           "(SELECT key FROM cache ORDER BY used LIMIT ?)", (excess,))
+        if excess > 0:
+            self.stats.add(evictions=excess)
+
+    def invalidate(self, region: str) -> int:
+        with self._connection() as db:
+            return db.execute("DELETE FROM cache WHERE region = ?", (region,)).rowcount
+
+    def clear(self):
+        with self._connection() as db:
+            db.execute("DELETE FROM cache")
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries: int, ttl: float, grid_m: float, heading_deg: float,
+                 shared_path: Optional[str] = None):
+        """
+        Caches per-point query results keyed by query kind, region, index
+        version, search options and the point snapped to a `grid_m` grid (and
+        `heading_deg` buckets for rays). The index version comes from the
+        registry, so a rebuilt region never serves results from the old index.
+        A `max_entries` of 0 disables the cache.
+
+        A point gets the result cached for the first point queried in its
+        cell, including that point's distances, so the cache only suits
+        clients that can take answers up to `grid_m` off.
+        """
+        self.max_entries = max_entries
+        self.grid_m = grid_m
+        self.heading_deg = heading_deg
+        self.stats = CacheStats()
+        if shared_path:
+            self.backend = SharedBackend(shared_path, max_entries, ttl, self.stats)
+        else:
+            self.backend = MemoryBackend(max_entries, ttl, self.stats)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def keys(self, kind: str, region: str, version: str, items: Sequence[Sequence[float]],
+             options: Hashable) -> List[tuple]:
+        return [(kind, region, version, tuple(options), quantize(item, self.grid_m, self.heading_deg))
+                for item in items]
+
+    def get_many(self, keys: Sequence[tuple]) -> List[Any]:
+        """
+        Cached values for `keys`, MISSING where there is none. A backend
+        error, e.g. a shared cache that stays locked, counts as a miss.
+        """
+        try:
+            values = [self.backend.get(key) for key in keys]
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not read the response cache")
+            self.stats.add(errors=1)
+            values = [MISSING] * len(keys)
+        misses = sum(1 for v in values if v is MISSING)
+        self.stats.add(hits=len(values) - misses, misses=misses)
+        return values
+
+    def put_many(self, keys: Sequence[tuple], values: Sequence[Any]):
+        try:
+            for key, value in zip(keys, values):
+                self.backend.put(key, value)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not write to the response cache")
+            self.stats.add(errors=1)
+
+    def invalidate(self, region: str):
+        """
+        Drop every entry for `region`, e.g. after its index was rebuilt.
+        Entries are keyed by index version, so any left behind by an error
+        are never served.
+        """
+        try:
+            self.stats.add(invalidations=self.backend.invalidate(region))
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not invalidate the response cache for %s", region)
+            self.stats.add(errors=1)
+
+    def clear(self):
+        self.backend.clear()
+
+    def samples(self) -> Iterator[Sample]:
+        if not self.enabled:
+            return
+        yield Sample('gis_cache_entries', 'gauge', "Entries in the response cache.", {}, len(self.backend))
+        for name, value in self.stats.as_dict().items():
+            yield Sample(f'gis_cache_{name}_total', 'counter', f"Response cache {name}.", {}, value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        stats = self.stats.as_dict()
+        lookups = stats['hits'] + stats['misses']
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend),
+            'max_entries': self.max_entries,
+            'grid_m': self.grid_m,
+            'heading_deg': self.heading_deg,
+            'hit_rate': stats['hits'] / lookups if lookups else None,
+            **stats
+        }
+
+
+# Off unless GIS_CACHE_SIZE is set, since cached answers are for another point in the cell
+cache = ResponseCache(max_entries=get_setting('GIS_CACHE_SIZE', 0, int),
+                      ttl=get_setting('GIS_CACHE_TTL_S', 300.0, float),
+                      grid_m=get_setting('GIS_CACHE_GRID_M', 1.0, float),
+                      heading_deg=get_setting('GIS_CACHE_HEADING_DEG', 1.0, float),
+                      shared_path=get_setting('GIS_CACHE_SHARED_PATH', '') or None)
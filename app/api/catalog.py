@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from rtree import index
+
+from api.config import get_setting
+from api.geometry import meters_to_degrees
+from api.registry import (DATA_DIR, INDEX_KINDS, STORE_KIND, disk_size, discover_regions, file_signature,
+                          index_path)
+from api.store import MANIFEST, store_path
+
+CATALOG = 'catalog.json'
+# Points this far outside a region's bounding box still resolve to it
+REGION_MARGIN_M = get_setting('GIS_REGION_MARGIN_M', 500.0, float)
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[float, float, float, float]
+
+
+class RegionInfo(NamedTuple):
+    """
+    What a worker knows about a region without opening it. `bbox` is in
+    lon/lat, `paths` maps each index kind, and the store if the region has
+    one, to its path, and `signature` identifies the index files described.
+    """
+    region: str
+    bbox: Box
+    buildings: int
+    addresses: int
+    paths: Dict[str, str]
+    size_bytes: int
+    signature: str
+
+    def contains(self, lon: float, lat: float, margin_m: float = 0.0) -> bool:
+        dlon, dlat = meters_to_degrees(lat, margin_m)
+        min_x, min_y, max_x, max_y = self.bbox
+        return min_x - dlon <= lon <= max_x + dlon and min_y - dlat <= lat <= max_y + dlat
+
+    @property
+    def area(self) -> float:
+        min_x, min_y, max_x, max_y = self.bbox
+        return (max_x - min_x) * (max_y - min_y)
+
+    def as_dict(self) -> dict:
+        return {**self._asdict(), 'bbox': list(self.bbox)}
+
+
+def index_signature(region: str, data_dir: str) -> str:
+    return repr([file_signature(index_path(kind, region, data_dir)) for kind in INDEX_KINDS])
+
+
+def describe_region(region: str, data_dir: str = DATA_DIR) -> RegionInfo:
+    """
+    Read a region's bounding box and counts from its indexes.
+
+    Raises:
+        FileNotFoundError if either index is missing.
+    """
+    signature = index_signature(region, data_dir)
+    paths = {kind: index_path(kind, region, data_dir) for kind in INDEX_KINDS}
+    counts, boxes = {}, []
+    for kind, path in paths.items():
+        rtree = index.Index(path)
+        min_x, min_y, max_x, max_y = rtree.bounds
+        # An empty index reports inverted infinite bounds
+        counts[kind] = rtree.count((min_x, min_y, max_x, max_y)) if min_x <= max_x else 0
+        if counts[kind]:
+            boxes.append((min_x, min_y, max_x, max_y))
+        rtree.close()
+    if os.path.isfile(os.path.join(store_path(region, data_dir), MANIFEST)):
+        paths[STORE_KIND] = store_path(region, data_dir)
+    bbox = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes)) if boxes else (0.0, 0.0, 0.0, 0.0)
+    return RegionInfo(region=region, bbox=bbox, buildings=counts['buildings'], addresses=counts['addresses'],
+                      paths=paths, size_bytes=sum(disk_size(kind, path) for kind, path in paths.items()),
+                      signature=signature)
+
+
+def read_catalog(data_dir: str = DATA_DIR) -> Dict[str, RegionInfo]:
+    try:
+        with open(os.path.join(data_dir, CATALOG), 'r') as catalog_file:
+            entries = json.load(catalog_file)
+    except FileNotFoundError:
+        return {}
+    return {e['region']: RegionInfo(**{**e, 'bbox': tuple(e['bbox'])}) for e in entries['regions']}
+
+
+def record_region(region: str, data_dir: str = DATA_DIR) -> RegionInfo:
+    """
+    Describe `region` again and write it to the catalog in `data_dir`, which
+    is replaced atomically. Regions whose indexes are gone are dropped.
+    """
+    info = describe_region(region, data_dir)
+    present = set(discover_regions(data_dir))
+    entries = {name: entry for name, entry in read_catalog(data_dir).items() if name in present}
+    entries[region] = info
+    path = os.path.join(data_dir, CATALOG)
+    tmp_path = os.path.join(data_dir, '.' + CATALOG + '.tmp')
+    with open(tmp_path, 'w') as catalog_file:
+        json.dump({'regions': [entries[name].as_dict() for name in sorted(entries)]}, catalog_file, indent=2)
+    os.replace(tmp_path, path)
+    return info
+
+
+class RegionCatalog:
+
+    def __init__(self, data_dir: str = DATA_DIR, check_interval: float = 1.0,
+                 margin_m: float = REGION_MARGIN_M):
+        """
+        Regions available in `data_dir`, read from catalog.json, which the
+        commands that build a region keep up to date. Regions missing from it
+        or whose indexes changed since are described from their indexes.
+
+        Only the first call reads the directory, so load the catalog at
+        startup. After that, lookups return the entries already read, and
+        once they are `check_interval` seconds old a background thread reads
+        the directory again, since describing a region opens its indexes.
+        """
+        self.data_dir = data_dir
+        self.check_interval = check_interval
+        self.margin_m = margin_m
+        self.checked_at = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._refreshing: Optional[int] = None
+        self._entries: Dict[str, RegionInfo] = {}
+
+    def entries(self) -> Dict[str, RegionInfo]:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.refresh()
+        elif time.monotonic() - self.checked_at >= self.check_interval:
+            self._refresh_in_background()
+        return self._entries
+
+    def refresh(self):
+        """
+        Read the directory now. Blocks while regions are described.
+        """
+        self._entries = self._read()
+        self.checked_at = time.monotonic()
+        self._loaded = True
+
+    def regions(self) -> List[str]:
+        return sorted(self.entries())
+
+    def get(self, region: str) -> RegionInfo:
+        """
+        Raises:
+            KeyError if there is no such region.
+        """
+        return self.entries()[region]
+
+    def resolve(self, lon: float, lat: float) -> Optional[str]:
+        """
+        The region whose bounding box, widened by `margin_m`, contains the
+        point, the smallest if several do, or None if none does.
+        """
+        matches = [info for info in self.entries().values() if info.contains(lon, lat, self.margin_m)]
+        return min(matches, key=lambda info: (info.area, info.region)).region if matches else None
+
+    def _refresh_in_background(self):
+        # By pid, so that a worker forked while the master was refreshing starts its own
+        with self._lock:
+            if self._refreshing == os.getpid():
+                return
+            self._refreshing = os.getpid()
+        threading.Thread(target=self._background_refresh, name='region-catalog', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not refresh the region catalog")
+            self.checked_at = time.monotonic()
+        finally:
+            self._refreshing = None
+
+    def _read(self) -> Dict[str, RegionInfo]:
+        recorded = read_catalog(self.data_dir)
+        entries = {}
+        for region in discover_regions(self.data_dir):
+            try:
+                signature = index_signature(region, self.data_dir)
+                known = [e for e in (recorded.get(region), self._entries.get(region))
+                         if e is not None and e.signature == signature]
+                if not known:
+                    logger.info("Reading the bounds of %s from its indexes", region)
+                entries[region] = known[0] if known else describe_region(region, self.data_dir)
+            except FileNotFoundError:
+                continue
+        return entries
+
+
+catalog = RegionCatalog()
@@ -0,0 +1,27 @@
+import os
+from typing import Any, Callable, Dict, Optional
+
+
+def read_env_file(path: str) -> Dict[str, str]:
+    try:
+        with open(path, 'r') as env_file:
+            lines = [l for l in env_file.readlines() if '=' in l]
+            return {l.split('=')[0]: l.split('=')[1].strip() for l in lines}
+    except FileNotFoundError:
+        return {}
+
+
+env = read_env_file(os.path.join(os.getcwd(), '.env'))
+
+
+def get_setting(name: str, default: Any = None, cast: Callable[[str], Any] = str) -> Any:
+    """
+    Look up a setting in the process environment, falling back to `.env`.
+
+    Returns:
+        the value passed through `cast`, or `default` if it isn't set.
+    """
+    value: Optional[str] = os.environ.get(name, env.get(name))
+    if value is None or value == '':
+        return default
+    return cast(value)
@@ -2,9 +2,40 @@ import os
 
 from peewee import SqliteDatabase
 
+from api.config import get_setting
+
 path = os.path.join(os.getcwd(), 'gis_data', 'database.db')
 
-db = SqliteDatabase(path, pragmas={
+# Ingest commands write through `db`. WAL lets the API keep reading while a
+# region loads, and synchronous=normal is durable enough in WAL mode for data
+# that can be loaded again from the shapefiles.
+WRITER_PRAGMAS = {
     'journal_mode': 'wal',
-    'cache_size': -1024 * 64
-})
+    'synchronous': 'normal',
+    'cache_size': -1024 * 64,
+    'busy_timeout': 30_000
+}
+
+# The API only reads. Pages come straight from the mmap'd file (shared with
+# every other worker through the page cache), any sorting happens in memory,
+# and query_only rejects writes.
+READER_PRAGMAS = {
+    'query_only': 1,
+    'mmap_size': get_setting('GIS_DB_MMAP_MB', 256, int) * 1024 * 1024,
+    'temp_store': 'memory',
+    'cache_size': -1024 * 16
+}
+
+db = SqliteDatabase(path, pragmas=WRITER_PRAGMAS)
+
+
+def read_only_database(db_path: str = path) -> SqliteDatabase:
+    """
+    Read-only handle on the database at `db_path`. Peewee keeps one connection
+    per thread, so each query pool worker opens its connection on first use and
+    keeps it, along with the statements prepared on it, for its lifetime.
+    """
+    return SqliteDatabase(f"file:{db_path}?mode=ro", uri=True, pragmas=READER_PRAGMAS)
+
+
+reader = read_only_database()
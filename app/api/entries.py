@@ -0,0 +1,41 @@
+from typing import Any, NamedTuple, Optional, Tuple
+
+Point = Tuple[float, float]
+
+
+class BuildingEntry(NamedTuple):
+    """
+    Payload stored in the building R-tree. Leaves hold it as a plain tuple so
+    that queries unpickle a few floats instead of a peewee model. Heights
+    and ground elevations are in feet.
+    """
+    idx: int
+    height: Optional[int]
+    center: Point
+    min_bounding_rect: Tuple[Point, Point, Point, Point]
+    ground_elevation: Optional[int] = None
+
+    @staticmethod
+    def from_raw(raw: Any) -> 'BuildingEntry':
+        # Indexes built before payloads existed hold whole Building models,
+        # and older payloads have no ground elevation
+        if isinstance(raw, tuple):
+            return BuildingEntry(*raw)
+        return BuildingEntry(*raw.to_entry())
+
+
+class AddressEntry(NamedTuple):
+    """
+    Payload stored in the address R-tree, with the address strings already
+    formatted.
+    """
+    idx: int
+    address: str
+    address_with_region: str
+    center: Point
+
+    @staticmethod
+    def from_raw(raw: Any) -> 'AddressEntry':
+        if isinstance(raw, tuple):
+            return AddressEntry._make(raw)
+        return AddressEntry._make(raw.to_entry())
@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator
+
+from api.config import get_setting
+from api.metrics import Sample
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class PoolStats:
+
+    def __init__(self):
+        """
+        Running totals of queue wait and execution time, in seconds.
+        """
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total, self.wait_max = 0.0, 0.0
+        self.run_total, self.run_max = 0.0, 0.0
+
+    def record(self, wait: float, run: float):
+        with self._lock:
+            self.completed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.run_total += run
+            self.run_max = max(self.run_max, run)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            completed = max(self.completed, 1)
+            return {
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_mean_s': self.wait_total / completed,
+                'wait_max_s': self.wait_max,
+                'run_mean_s': self.run_total / completed,
+                'run_max_s': self.run_max
+            }
+
+
+class QueryPool:
+
+    def __init__(self, workers: int, queue_depth: int):
+        """
+        Runs blocking query work off the event loop. At most `workers` tasks
+        run at once and at most `queue_depth` more wait for a thread; anything
+        beyond that is rejected so callers can shed load. Threads are used
+        rather than processes because the region indexes and stores are
+        opened per process, and rtree and NumPy release the GIL for the heavy
+        parts of a query.
+        """
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.stats = PoolStats()
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query')
+
+    @property
+    def in_flight(self) -> int:
+        return self.workers + self.queue_depth - self._slots._value # pylint: disable=protected-access
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """
+        Run `fn(*args)` on the pool and wait for its result.
+
+        Raises:
+            PoolSaturated if every worker is busy and the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.stats.reject()
+            raise PoolSaturated()
+        submitted = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.stats.record(started - submitted, time.perf_counter() - started)
+                self._slots.release()
+
+        try:
+            # Carry the request's context, e.g. its metric labels, into the thread
+            future = self._executor.submit(contextvars.copy_context().run, task)
+        except BaseException:
+            self._slots.release()
+            raise
+        return await asyncio.wrap_future(future)
+
+    def samples(self) -> Iterator[Sample]:
+        stats = self.stats.as_dict()
+        yield Sample('gis_pool_workers', 'gauge', "Query pool threads.", {}, self.workers)
+        yield Sample('gis_pool_in_flight', 'gauge', "Queries running or queued.", {}, self.in_flight)
+        yield Sample('gis_pool_completed_total', 'counter', "Queries completed by the pool.", {},
+                     stats['completed'])
+        yield Sample('gis_pool_rejected_total', 'counter', "Queries rejected because the pool was full.", {},
+                     stats['rejected'])
+        yield Sample('gis_pool_wait_seconds_total', 'counter', "Time queries spent queued.", {},
+                     self.stats.wait_total)
+        yield Sample('gis_pool_run_seconds_total', 'counter', "Time queries spent running.", {},
+                     self.stats.run_total)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+pool = QueryPool(workers=get_setting('GIS_POOL_WORKERS', os.cpu_count() or 1, int),
+                 queue_depth=get_setting('GIS_POOL_QUEUE_DEPTH', 64, int))
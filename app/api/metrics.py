@@ -0,0 +1,213 @@
+import bisect
+import contextlib
+import contextvars
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from api.config import get_setting
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Starlette appends the charset to text/ media types
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Labels of the request being served, e.g. {'route': '/intersect', 'region': 'denver'}.
+# The query pool copies them into its threads along with the rest of the context.
+context_labels: contextvars.ContextVar = contextvars.ContextVar('metric_labels', default={})
+
+LabelValues = Tuple[str, ...]
+
+
+class Sample(NamedTuple):
+    """
+    One value reported by a collector.
+    """
+    name: str
+    kind: str
+    help: str
+    labels: Dict[str, str]
+    value: float
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Counter:
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+
+
+class Histogram:
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Per label set: a count per bucket (and one for +Inf), and the sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        names = self.labelnames + ('le',)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(names, key + (format_value(bound),))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Metrics:
+
+    def __init__(self, enabled: bool):
+        """
+        Process-wide metrics, rendered in the Prometheus text format. When
+        disabled, recording is a single attribute check.
+        """
+        self.enabled = enabled
+        self._metrics: List = []
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect: Callable[[], Iterable[Sample]]):
+        """
+        Add a callable that reports current values, such as pool or cache
+        statistics, each time the metrics are rendered.
+        """
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        described = set()
+        for collect in self._collectors:
+            for sample in collect():
+                if sample.name not in described:
+                    described.add(sample.name)
+                    lines.append(f"# HELP {sample.name} {sample.help}")
+                    lines.append(f"# TYPE {sample.name} {sample.kind}")
+                lines.append(f"{sample.name}{format_labels(sample.labels, sample.labels.values())} "
+                             f"{format_value(sample.value)}")
+        return '\n'.join(lines) + '\n'
+
+    @contextlib.contextmanager
+    def labels(self, **labels: str):
+        """
+        Attach `labels` to everything recorded in this context, including
+        work handed to the query pool.
+        """
+        token = context_labels.set({**context_labels.get(), **labels})
+        try:
+            yield
+        finally:
+            context_labels.reset(token)
+
+    def count(self, counter: Counter, amount: float = 1.0, **labels: str):
+        if self.enabled:
+            counter.inc(amount, **{**context_labels.get(), **labels})
+
+    def observe(self, histogram: Histogram, value: float, **labels: str):
+        if self.enabled:
+            histogram.observe(value, **{**context_labels.get(), **labels})
+
+
+metrics = Metrics(enabled=get_setting('GIS_METRICS', True, lambda v: v.lower() not in ('0', 'false', 'no')))
+
+stage_seconds = metrics.histogram('gis_stage_duration_seconds', "Time spent in each stage of a query.",
+                                  ('stage', 'route', 'region'))
+request_seconds = metrics.histogram('gis_request_duration_seconds', "HTTP request latency.",
+                                    ('route', 'method', 'status'))
+points_total = metrics.counter('gis_query_points_total', "Query points answered by the index.",
+                               ('route', 'region'))
+candidates_total = metrics.counter('gis_candidates_total', "Candidates fetched from an index.",
+                                   ('route', 'region', 'kind'))
+hits_total = metrics.counter('gis_hits_total', "Ray hits returned.", ('route', 'region'))
+occluded_total = metrics.counter('gis_occluded_hits_total', "Ray hits dropped as hidden from the viewer.",
+                                 ('route', 'region'))
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app, routes: Optional[Iterable[str]] = None):
+        """
+        Times every HTTP request. Paths outside `routes` are reported as
+        'other' so unknown URLs can't create new series.
+        """
+        self.app = app
+        self.routes = set(routes or ())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = ['500']
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope['path'] if scope['path'] in self.routes else 'other'
+            request_seconds.observe(time.perf_counter() - start, route=route, method=scope['method'],
+                                    status=status[0])
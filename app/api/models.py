@@ -1,34 +1,64 @@
 import json
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 from functools import cached_property
 
 import numpy as np
 import peewee as pw
 
-from api.db import db
-from api.geometry import minimum_bounding_rectangle, sorted_points_by_polar_angle
+from api.db import db, reader
+from api.entries import AddressEntry, BuildingEntry
+from api.geometry import convex_hull, minimum_bounding_rectangle, sorted_points_by_polar_angle
 
 CoordinateList = List[Tuple[float, float]]
 
-
-class CoordinateListField(pw.TextField):
-    def db_value(self, value: CoordinateList) -> str:
-        return json.dumps(value)
-
-    def python_value(self, value) -> CoordinateList:
-        return json.loads(value)
-
-
-class IndexListField(pw.TextField):
-    def db_value(self, value: List[int]) -> str:
-        return json.dumps(value)
-
-    def python_value(self, value) -> List[int]:
-        return json.loads(value)
+# Stored in PRAGMA user_version. Version 1 kept points as JSON text and used
+# idx as the primary key, version 2 had no building_id, see commands.migrate_schema.
+SCHEMA_VERSION = 3
+
+
+class PointArrayField(pw.BlobField):
+    """
+    Points packed as little-endian float64 (x, y) pairs. Values read back as
+    read-only nx2 arrays over the row's bytes, so decoding is a single view.
+    """
+    def db_value(self, value) -> bytes:
+        if value is None:
+            return None
+        return np.ascontiguousarray(value, dtype='<f8').reshape(-1, 2).tobytes()
+
+    def python_value(self, value) -> np.array:
+        return None if value is None else np.frombuffer(value, dtype='<f8').reshape(-1, 2)
+
+
+def rows_by_idx(model, region: str, ids: Sequence[int], database: pw.Database) -> List:
+    """
+    Rows of `model` in `region` with ids `ids`, in that order, read through
+    `database`. The ids go in as one JSON parameter, so the SQL is the same
+    for any number of ids and each connection prepares it only once.
+
+    Raises:
+        KeyError if any of `ids` isn't in the table.
+    """
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    query = (model.select()
+             .where((model.region == region) &
+                    (model.idx << pw.SQL('(SELECT value FROM json_each(?))', [json.dumps(ids)])))
+             .bind(database))
+    found = {row.idx: row for row in query}
+    try:
+        return [found[i] for i in ids]
+    except KeyError as e:
+        raise KeyError(f"{model.__name__} {e.args[0]} missing from the database") from e
 
 
 class Address(pw.Model):
-    idx = pw.IntegerField(primary_key=True)
+    # Rows are clustered by region: each region is loaded in one pass and
+    # gets a contiguous run of rowids. `idx` is the feature number within the
+    # region's shapefile and the id used by the region's indexes.
+    id = pw.AutoField()
+    idx = pw.IntegerField()
     region = pw.TextField()
     building_type = pw.TextField(null=True)
     address_1 = pw.TextField(null=True)
@@ -40,15 +70,20 @@ class Address(pw.Model):
     unit_type = pw.TextField(null=True)
     unit_identifier = pw.TextField(null=True)
     full_address = pw.TextField()
-    coord = CoordinateListField()
+    lon = pw.FloatField()
+    lat = pw.FloatField()
 
     @staticmethod
     def all(region: str) -> List:
         return list(Address.select().where(Address.region == region))
 
+    @staticmethod
+    def by_idx(region: str, ids: Sequence[int], database: pw.Database = reader) -> List:
+        return rows_by_idx(Address, region, ids, database)
+
     @property
     def center(self) -> Tuple[float, float]:
-        return self.coord[0]
+        return self.lon, self.lat
 
     @property
     def full_address_with_region(self) -> str:
@@ -59,23 +94,41 @@ class Address(pw.Model):
         components = [self.address_1, self.predirective, self.street_name, self.post_type]
         return " ".join([c for c in components if c])
 
+    def to_entry(self) -> tuple:
+        longitude, latitude = self.center
+        return tuple(AddressEntry(idx=self.idx,
+                                  address=self.full_address_without_region,
+                                  address_with_region=self.full_address_with_region,
+                                  center=(float(longitude), float(latitude))))
+
     class Meta:
         database = db
+        indexes = ((('region', 'idx'), True),)
 
 
 class Building(pw.Model):
-    idx = pw.IntegerField(primary_key=True)
+    id = pw.AutoField()
+    idx = pw.IntegerField()
     region = pw.TextField(null=False)
     height = pw.IntegerField(null=True)
     ground_elevation = pw.IntegerField(null=True)
     building_type = pw.TextField(null=False)
-    polygon_points = CoordinateListField(null=False)
-    dob_id = pw.TextField(null=True) 
+    polygon_points = PointArrayField(null=False)
+    vertex_count = pw.IntegerField()
+    dob_id = pw.TextField(null=True)
+    hull_points = PointArrayField(null=True)
+    mbr_points = PointArrayField(null=True)
+    # Stable id from the source data, used to diff updates against
+    building_id = pw.TextField(null=True)
 
     @staticmethod
     def all(region=None) -> List:
         return list(Building.select().where(Building.region == region))
 
+    @staticmethod
+    def by_idx(region: str, ids: Sequence[int], database: pw.Database = reader) -> List:
+        return rows_by_idx(Building, region, ids, database)
+
     @cached_property
     def center(self) -> Tuple[float, float]:
         min_x, min_y, max_x, max_y = self.bbox
@@ -85,15 +138,10 @@ class Building(pw.Model):
 
     @cached_property
     def bbox(self) -> Tuple[float, float, float, float]:
-        min_x, min_y = 100000.0, 100000.0
-        max_x, max_y = -100000.0, -100000.0
-        for point in self.polygon_points:
-            x, y = point
-            min_x = min(x, min_x)
-            max_x = max(x, max_x)
-            min_y = min(y, min_y)
-            max_y = max(y, max_y)
-        return min_x, min_y, max_x, max_y
+        points = np.asarray(self.polygon_points, dtype=float).reshape(-1, 2)
+        min_x, min_y = points.min(axis=0)
+        max_x, max_y = points.max(axis=0)
+        return float(min_x), float(min_y), float(max_x), float(max_y)
 
     @cached_property
     def lines_for_shape(self) -> List[Tuple[np.array, np.array]]:
@@ -102,8 +150,20 @@ class Building(pw.Model):
 
     @cached_property
     def min_bounding_rect(self) -> CoordinateList:
-        rect = minimum_bounding_rectangle(self.polygon_points)
+        if self.mbr_points is not None:
+            return self.mbr_points
+        hull = self.hull_points if self.hull_points is not None else convex_hull(self.polygon_points)
+        rect = minimum_bounding_rectangle(hull)
         return sorted_points_by_polar_angle(rect, self.center)
 
+    def to_entry(self) -> tuple:
+        rect = tuple((float(x), float(y)) for x, y in self.min_bounding_rect)
+        return tuple(BuildingEntry(idx=self.idx,
+                                   height=self.height,
+                                   center=self.center,
+                                   min_bounding_rect=rect,
+                                   ground_elevation=self.ground_elevation))
+
     class Meta:
         database = db
+        indexes = ((('region', 'idx'), True),)
@@ -0,0 +1,537 @@
+import itertools
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+import api.geometry as geom
+from api.entries import AddressEntry, BuildingEntry
+from api.metrics import candidates_total, hits_total, metrics, occluded_total
+from api.registry import registry
+from api.store import AddressColumns, BuildingColumns, GeometryStore
+from commands.util import Timer
+
+Point = Tuple[float, float]
+Heading = Tuple[float, float, float]
+
+# Length of each step of a ray-ordered traversal, and how far it goes by default
+RAY_STEP_M = 25.0
+RAY_MAX_DISTANCE_M = 1000.0
+# Eye height of a viewer standing on the ground, and the vertical field of
+# view of a phone camera held upright
+EYE_HEIGHT_M = 1.6
+DEFAULT_FOV = 60.0
+
+
+class DatabaseUnavailable(Exception):
+    """
+    The read-only database couldn't be read, e.g. because it is missing or
+    locked.
+    """
+
+
+class View(NamedTuple):
+    """
+    A viewer whose eye is `elevation_m` meters above sea level, or
+    EYE_HEIGHT_M above the ground at the first building along the ray if
+    None, and who sees `fov` degrees vertically around `pitch` degrees above
+    the horizon.
+    """
+    elevation_m: Optional[float] = None
+    pitch: float = 0.0
+    fov: float = DEFAULT_FOV
+
+    def limits(self) -> Tuple[float, float]:
+        """
+        The lowest and highest elevation angles in view, in radians.
+        """
+        low, high = max(self.pitch - self.fov / 2, -90.0), min(self.pitch + self.fov / 2, 90.0)
+        return float(np.radians(low)), float(np.radians(high))
+
+
+class SearchOptions(NamedTuple):
+    """
+    `k` candidates per query, optionally only those within `max_distance_m`.
+    For intersections, `mode` is 'nearest' to ray-test the k nearest
+    buildings or 'ray' to walk the index along the heading, and at most
+    `max_hits` hits are returned per ray. With a `view`, only the faces that
+    viewer can see are returned.
+    """
+    k: int = 50
+    max_distance_m: Optional[float] = None
+    mode: str = 'nearest'
+    max_hits: Optional[int] = None
+    view: Optional[View] = None
+
+
+class Intersections(NamedTuple):
+    """
+    Result of `intersect_many`. `hits.owner` indexes into `buildings`,
+    `hits.ray` into the query rays, and `addresses[i]` belongs to hit i.
+    """
+    buildings: BuildingColumns
+    hits: geom.RayHits
+    addresses: List[List[str]]
+
+    def for_ray(self, ray: int) -> np.array:
+        """
+        Indices of the hits for `ray`, nearest first.
+        """
+        return np.nonzero(self.hits.ray == ray)[0]
+
+
+def take(columns, indices: np.array):
+    return type(columns)(*(column[indices] if isinstance(column, np.ndarray)
+                           else [column[i] for i in indices] for column in columns))
+
+
+def concatenate(parts: Sequence):
+    return type(parts[0])(*(np.concatenate(c) if isinstance(c[0], np.ndarray)
+                            else [v for part in c for v in part] for c in zip(*parts)))
+
+
+def split(columns, counts: Sequence[int]) -> List:
+    bounds = np.cumsum([0] + list(counts))
+    return [type(columns)(*(column[start:end] for column in columns))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def nearest_within(counts: Sequence[int], ids: np.array, distances: np.array, max_distance_m: float,
+                   num_results: int) -> Tuple[np.array, List[int]]:
+    """
+    For candidates grouped by query, the `num_results` of each query that
+    are nearest and within `max_distance_m`, nearest first and the lower id
+    first on ties.
+
+    Returns:
+        the positions of the rows kept and the number kept for each query.
+    """
+    groups = np.repeat(np.arange(len(counts)), counts)
+    order = np.lexsort((ids, distances, groups))
+    order = order[distances[order] <= max_distance_m]
+    rank = np.arange(len(order)) - np.searchsorted(groups[order], groups[order])
+    keep = order[rank < num_results]
+    return keep, list(np.bincount(groups[keep], minlength=len(counts)))
+
+
+def box_candidates(rtree, points: Sequence[Point], max_distance_m: float) -> Tuple[np.array, List[int]]:
+    """
+    Ids of the entries in the box around each of `points` that holds
+    everything within `max_distance_m` of it.
+
+    Returns:
+        every point's ids one after another, and the number for each point.
+    """
+    found = rtree.intersection_many([geom.radius_bbox(p, max_distance_m) for p in points])
+    counts = [len(ids) for ids in found]
+    return np.fromiter(itertools.chain.from_iterable(found), dtype=np.int64, count=sum(counts)), counts
+
+
+def building_entries(entries: Sequence[BuildingEntry]) -> BuildingColumns:
+    return BuildingColumns(
+        idx=np.array([e.idx for e in entries], dtype=np.int64),
+        height=np.array([np.nan if e.height is None else e.height for e in entries], dtype=float),
+        ground_elevation=np.array([np.nan if e.ground_elevation is None else e.ground_elevation
+                                   for e in entries], dtype=float),
+        center=np.array([e.center for e in entries], dtype=float).reshape(-1, 2),
+        mbr=np.array([e.min_bounding_rect for e in entries], dtype=float).reshape(-1, 4, 2)
+    )
+
+
+def address_entries(entries: Sequence[AddressEntry]) -> AddressColumns:
+    return AddressColumns(
+        idx=np.array([e.idx for e in entries], dtype=np.int64),
+        center=np.array([e.center for e in entries], dtype=float).reshape(-1, 2),
+        address=[e.address for e in entries],
+        address_with_region=[e.address_with_region for e in entries]
+    )
+
+
+def database_rows(kind: str, region: str, ids: np.array) -> List:
+    """
+    The database rows of buildings or addresses `ids`, in that order. The
+    models, and peewee with them, are only imported here, which keeps them
+    out of worker startup when every region has a store.
+
+    Raises:
+        KeyError if any of `ids` isn't in the database.
+        DatabaseUnavailable if the database can't be read.
+    """
+    import peewee as pw # pylint: disable=import-outside-toplevel
+    from api.models import Address, Building # pylint: disable=import-outside-toplevel
+    model = Building if kind == 'buildings' else Address
+    try:
+        return model.by_idx(region, ids)
+    except pw.OperationalError as e:
+        raise DatabaseUnavailable(str(e)) from e
+
+
+def buildings_by_idx(region: str, ids: np.array) -> BuildingColumns:
+    """
+    Columns for buildings `ids`, in that order, from the region's geometry
+    store when it has them all and from the read-only database otherwise.
+
+    Raises:
+        KeyError if any of `ids` isn't in the database either.
+        DatabaseUnavailable if the database is needed and can't be read.
+    """
+    store = registry.store(region)
+    if store is not None:
+        try:
+            return store.buildings(ids)
+        except KeyError:
+            pass
+    return building_entries([BuildingEntry.from_raw(b) for b in database_rows('buildings', region, ids)])
+
+
+def addresses_by_idx(region: str, ids: np.array) -> AddressColumns:
+    """
+    Like `buildings_by_idx`, for addresses.
+    """
+    store = registry.store(region)
+    if store is not None:
+        try:
+            return store.addresses(ids)
+        except KeyError:
+            pass
+    return address_entries([AddressEntry.from_raw(a) for a in database_rows('addresses', region, ids)])
+
+
+def building_bounds(region: str, ids: np.array) -> np.array:
+    """
+    Bounding boxes of the footprints of buildings `ids`, as the building
+    index holds them, from the store when it has them all.
+    """
+    store = registry.store(region)
+    if store is not None:
+        try:
+            return store.footprint_bounds(ids)
+        except KeyError:
+            pass
+    return np.array([b.bbox for b in database_rows('buildings', region, ids)], dtype=float).reshape(-1, 4)
+
+
+def address_centers(region: str, ids: np.array) -> np.array:
+    """
+    The points of addresses `ids`, from the store without decoding their
+    text when it has them all.
+    """
+    store = registry.store(region)
+    if store is not None:
+        try:
+            return store.address_center[store.address_rows(ids)]
+        except KeyError:
+            pass
+    return addresses_by_idx(region, ids).center
+
+
+def building_columns(region: str, points: Sequence[Point], num_results: int,
+                     max_distance_m: Optional[float] = None) -> Tuple[BuildingColumns, List[int]]:
+    """
+    The `num_results` buildings nearest to each of `points`, nearest first,
+    concatenated into one set of columns read by `buildings_by_idx`.
+
+    The index ranks by distance in degrees, which isn't the order in
+    meters, so with `max_distance_m` every building in the box around a
+    point is ranked by the distance in meters to its footprint's bounding
+    box instead, and only the buildings kept are read.
+
+    Returns:
+        the columns and the number of rows for each point.
+
+    Raises:
+        FileNotFoundError if the region has no building index.
+    """
+    rtree = registry.buildings(region)
+    if max_distance_m is None:
+        with Timer(f"Searching the building index for {len(points)} points", stage='building_search'):
+            ids = rtree.nearest_many(points, num_results, objects=False)
+        with Timer(f"Reading {sum(len(i) for i in ids)} buildings", stage='building_fetch'):
+            columns, counts = buildings_by_idx(region, np.concatenate(ids or [[]])), [len(i) for i in ids]
+        metrics.count(candidates_total, len(columns), kind='buildings')
+        return columns, counts
+    with Timer(f"Searching the building index for {len(points)} points", stage='building_search'):
+        ids, counts = box_candidates(rtree, points, max_distance_m)
+        unique, rows = np.unique(ids, return_inverse=True)
+        bounds = building_bounds(region, unique)[rows]
+    metrics.count(candidates_total, len(ids), kind='buildings')
+    origins = np.repeat(np.asarray(points, dtype=float).reshape(-1, 2), counts, axis=0)
+    distances = geom.point_rect_distance(origins, bounds[:, :2], bounds[:, 2:])
+    keep, counts = nearest_within(counts, ids, distances, max_distance_m, num_results)
+    with Timer(f"Reading {len(keep)} buildings", stage='building_fetch'):
+        return buildings_by_idx(region, ids[keep]), counts
+
+
+def address_columns(region: str, points: Sequence[Point], num_results: int,
+                    max_distance_m: Optional[float] = None) -> Tuple[AddressColumns, List[int]]:
+    """
+    Like `building_columns`, for addresses, which are ranked by the
+    distance to their points.
+
+    Raises:
+        FileNotFoundError if the region has no address index.
+    """
+    rtree = registry.addresses(region)
+    if max_distance_m is None:
+        with Timer(f"Searching the address index for {len(points)} points", stage='address_search'):
+            ids = rtree.nearest_many(points, num_results, objects=False)
+        with Timer(f"Reading {sum(len(i) for i in ids)} addresses", stage='address_fetch'):
+            columns, counts = addresses_by_idx(region, np.concatenate(ids or [[]])), [len(i) for i in ids]
+        metrics.count(candidates_total, len(columns), kind='addresses')
+        return columns, counts
+    with Timer(f"Searching the address index for {len(points)} points", stage='address_search'):
+        ids, counts = box_candidates(rtree, points, max_distance_m)
+        unique, rows = np.unique(ids, return_inverse=True)
+        centers = address_centers(region, unique)[rows]
+    metrics.count(candidates_total, len(ids), kind='addresses')
+    origins = np.repeat(np.asarray(points, dtype=float).reshape(-1, 2), counts, axis=0)
+    distances = geom.haversine_meters(origins, centers)
+    keep, counts = nearest_within(counts, ids, distances, max_distance_m, num_results)
+    with Timer(f"Reading {len(keep)} addresses", stage='address_fetch'):
+        return addresses_by_idx(region, ids[keep]), counts
+
+
+@registry.reading()
+def buildings_in_box(region: str, box: Tuple[float, float, float, float]) -> BuildingColumns:
+    return buildings_by_idx(region, np.array(registry.buildings(region).intersection(box), dtype=np.int64))
+
+
+@registry.reading()
+def nearest_buildings_many(region: str, points: Sequence[Point], num_results: int,
+                           max_distance_m: Optional[float] = None) -> List[BuildingColumns]:
+    return split(*building_columns(region, points, num_results, max_distance_m))
+
+
+@registry.reading()
+def nearest_addresses_many(region: str, points: Sequence[Point], num_results: int,
+                           max_distance_m: Optional[float] = None) -> List[AddressColumns]:
+    return split(*address_columns(region, points, num_results, max_distance_m))
+
+
+def nearest_buildings(region: str, point: Point, num_results: int) -> BuildingColumns:
+    return nearest_buildings_many(region, [point], num_results)[0]
+
+
+def nearest_addresses(region: str, point: Point, num_results: int) -> AddressColumns:
+    return nearest_addresses_many(region, [point], num_results)[0]
+
+
+def with_addresses(region: str, buildings: BuildingColumns, hits: geom.RayHits,
+                   num_addresses: int) -> Intersections:
+    hit_points = [tuple(p) for p in hits.point]
+    addresses = [a.address_with_region for a in nearest_addresses_many(region, hit_points, num_addresses)]
+    return Intersections(buildings, hits, addresses)
+
+
+def hit_distances(origins: np.array, directions: np.array, hits: geom.RayHits, metric: bool) -> np.array:
+    """
+    Distance in meters from each hit's ray origin to where the ray hits.
+    """
+    if metric:
+        return hits.t
+    starts = origins[hits.ray]
+    return geom.haversine_meters(starts, starts + hits.t[:, None] * directions[hits.ray])
+
+
+def ceiling(store: Optional[GeometryStore], view: View) -> float:
+    """
+    The highest elevation in meters that any face in the region can reach,
+    as `visible_hits` places them, or infinity without a store to tell.
+    """
+    if store is None:
+        return np.inf
+    ground_ft, height_ft = store.highest()
+    fallback = 0.0 if view.elevation_m is None else view.elevation_m - EYE_HEIGHT_M
+    ground = fallback if np.isnan(ground_ft) else max(ground_ft * geom.FT_TO_M, fallback)
+    return ground + max(float(geom.heights_in_meters(height_ft)), geom.DEFAULT_FACE_HEIGHT_M)
+
+
+def visible_hits(buildings: BuildingColumns, hits: geom.RayHits, distance_m: np.array, view: View,
+                 n_rays: int, ceiling_m: float = np.inf) -> Tuple[np.array, np.array]:
+    """
+    `geom.visible_facades` for hits ordered by ray and then by distance.
+    Faces stand on their building's ground elevation, or on the first one
+    known along their ray where it is missing.
+    """
+    ground = buildings.ground_elevation[hits.owner] * geom.FT_TO_M
+    known = ~np.isnan(ground)
+    rays, first = np.unique(hits.ray[known], return_index=True)
+    reference = np.full(n_rays, 0.0 if view.elevation_m is None else view.elevation_m - EYE_HEIGHT_M)
+    reference[rays] = ground[known][first]
+    ground = np.where(known, ground, reference[hits.ray])
+    eye = reference + EYE_HEIGHT_M if view.elevation_m is None else np.full(n_rays, view.elevation_m)
+    top = ground + geom.heights_in_meters(buildings.height[hits.owner])
+    return geom.visible_facades(hits.ray, distance_m, ground, top, eye, *view.limits(), ceiling_m)
+
+
+def visible_only(buildings: BuildingColumns, hits: geom.RayHits, distance_m: np.array, view: View,
+                 n_rays: int) -> geom.RayHits:
+    visible, _ = visible_hits(buildings, hits, distance_m, view, n_rays)
+    metrics.count(occluded_total, len(hits.t) - int(np.count_nonzero(visible)))
+    return hits.take(np.nonzero(visible)[0])
+
+
+def projected_store(region: str) -> Optional[GeometryStore]:
+    """
+    The region's store if it was exported with a metric projection.
+    """
+    store = registry.store(region)
+    return store if store is not None and store.plane is not None else None
+
+
+@registry.reading()
+def intersect_many(region: str, rays: Sequence[Heading], options: SearchOptions = SearchOptions(),
+                   num_addresses: int = 3) -> Intersections:
+    """
+    Cast a ray from each (lon, lat, heading) in `rays` and look up the
+    addresses nearest to every building face that was hit.
+
+    In 'nearest' mode each ray is tested against its `options.k` nearest
+    buildings, and all rays share one index pass and one vectorized
+    intersection pass. 'ray' mode uses `trace_ray` for each ray.
+
+    If the region's store was exported with a projection, the rays run in
+    meters on its plane and normals are true to the ground. Otherwise they
+    run in lon/lat degrees. Either way `t` is returned in meters.
+
+    With `options.view`, faces hidden behind nearer buildings or outside
+    the field of view are dropped before `max_hits` is applied, and only
+    the faces left are looked up in the address index.
+
+    Raises:
+        FileNotFoundError if the region has no index.
+    """
+    if options.mode == 'ray':
+        return intersect_along_many(region, rays, options, num_addresses)
+    points = [(lon, lat) for lon, lat, _ in rays]
+    headings = [heading for _, _, heading in rays]
+    buildings, counts = building_columns(region, points, options.k, options.max_distance_m)
+    origins = np.array(points, dtype=float).reshape(-1, 2)
+    store = projected_store(region)
+    try:
+        rects = buildings.mbr if store is None else store.projected_rects(buildings.idx)
+    except KeyError:
+        store, rects = None, buildings.mbr
+    if store is None:
+        directions = geom.bearing_to_direction(origins[:, 1], headings)
+    else:
+        origins, directions = store.plane.project(origins), store.plane.directions(origins, headings)
+    with Timer(f"Intersecting {len(rays)} rays with {len(buildings)} buildings", stage='intersect'):
+        edges = geom.EdgeSet.from_rects(rects)
+        # Each ray is only tested against the 3 edges of each of its own candidates
+        ray_index = np.repeat(np.arange(len(rays)), np.array(counts, dtype=np.int64) * 3)
+        hits = geom.intersect_pairs(origins, directions, edges, ray_index, np.arange(len(edges.starts)),
+                                    metric=store is not None)
+        hits = geom.nearest_hits(hits, min_hits=2)
+        if options.view is not None:
+            distances = hit_distances(origins, directions, hits, metric=store is not None)
+            hits = visible_only(buildings, hits, distances, options.view, len(rays))
+        hits = geom.first_hits(hits, options.max_hits)
+        if store is None:
+            hits = hits._replace(t=hit_distances(origins, directions, hits, metric=False))
+        else:
+            hits = hits._replace(point=store.plane.unproject(hits.point))
+    metrics.count(hits_total, len(hits.t))
+    return with_addresses(region, buildings, hits, num_addresses)
+
+
+def trace_ray(region: str, point: Point, heading: float, max_hits: Optional[int],
+              max_distance_m: float, step_m: float = RAY_STEP_M,
+              store: Optional[GeometryStore] = None,
+              view: Optional[View] = None) -> Tuple[BuildingColumns, geom.RayHits]:
+    """
+    Walk the building index along the ray from `point` one step at a time,
+    nearest first, ray-testing only the buildings whose boxes touch the
+    current step. A building first found at a later step can't be hit before
+    that step starts, so the walk stops once `max_hits` hits lie within the
+    steps already walked. With a projected `store` the ray runs in meters on
+    its plane and hit points are converted back to lon/lat. Without one it
+    runs in degrees, and `t` is converted to meters once the walk is done.
+
+    With a `view`, only the faces it sees are kept and count toward
+    `max_hits`, and the walk also stops once nearer faces hide everything
+    up to the top of the view or the highest roof in the region.
+
+    Returns:
+        the buildings examined and the hits on them, ordered by `t` in
+        meters.
+
+    Raises:
+        KeyError if `store` is missing any of the buildings found.
+    """
+    if store is None:
+        ray = geom.Ray(point, heading)
+        dlon, dlat = geom.meters_to_degrees(point[1], step_m)
+        # ray.rd is a unit vector in degrees, so this is `t` for a `step_m` move
+        t_step = 1.0 / float(np.hypot(ray.rd[0] / dlon, ray.rd[1] / dlat))
+        origin, direction, to_lon_lat = ray.ro, ray.rd, lambda p: p
+    else:
+        plane = store.plane
+        t_step = step_m
+        origin, direction = plane.project(point)[0], plane.directions(point, heading)[0]
+        to_lon_lat = plane.unproject
+
+    def distances(hits: geom.RayHits) -> np.array:
+        return hit_distances(origin.reshape(1, 2), direction.reshape(1, 2), hits, metric=store is not None)
+
+    ceiling_m = ceiling(registry.store(region), view) if view is not None else np.inf
+    n_steps = int(np.ceil(max_distance_m / step_m))
+    marks = to_lon_lat(origin + np.arange(n_steps + 1)[:, None] * t_step * direction)
+    seen = np.zeros(0, dtype=np.int64)
+    found, all_hits, offset, checked = [building_entries([])], [geom.RayHits.empty()], 0, 0
+    for step in range(n_steps):
+        ends = marks[step:step + 2]
+        box = (*ends.min(axis=0), *ends.max(axis=0))
+        candidates = buildings_in_box(region, box)
+        candidates = take(candidates, np.nonzero(~np.isin(candidates.idx, seen))[0])
+        if len(candidates):
+            seen = np.concatenate([seen, candidates.idx])
+            rects = candidates.mbr if store is None else store.projected_rects(candidates.idx)
+            hits = geom.intersect_rays(origin, direction, geom.EdgeSet.from_rects(rects),
+                                       metric=store is not None)
+            hits = geom.nearest_hits(hits, min_hits=2)
+            found.append(candidates)
+            all_hits.append(hits._replace(owner=hits.owner + offset))
+            offset += len(candidates)
+        settled = sum(int(np.count_nonzero(h.t <= (step + 1) * t_step)) for h in all_hits)
+        if view is None:
+            if max_hits is not None and settled >= max_hits:
+                break
+        elif settled > checked:
+            # Faces only hide those further along, so settled hits are final
+            checked = settled
+            hits = geom.RayHits.concatenate(all_hits)
+            hits = hits.take(np.lexsort((hits.owner, hits.t))[:settled])
+            visible, blocked = visible_hits(concatenate(found), hits, distances(hits), view, 1, ceiling_m)
+            if blocked.any() or (max_hits is not None and np.count_nonzero(visible) >= max_hits):
+                break
+    buildings, hits = concatenate(found), geom.RayHits.concatenate(all_hits)
+    hits = hits.take(np.lexsort((hits.owner, hits.t)))
+    if view is not None:
+        hits = visible_only(buildings, hits, distances(hits), view, 1)
+    hits = hits.take(np.arange(len(hits.t))[:max_hits])
+    if store is None:
+        hits = hits._replace(t=distances(hits))
+    else:
+        hits = hits._replace(point=to_lon_lat(hits.point).reshape(-1, 2))
+    return buildings, hits
+
+
+def intersect_along_many(region: str, rays: Sequence[Heading], options: SearchOptions,
+                         num_addresses: int = 3) -> Intersections:
+    max_distance_m = options.max_distance_m or RAY_MAX_DISTANCE_M
+    store = projected_store(region)
+    found, all_hits, offset = [building_entries([])], [geom.RayHits.empty()], 0
+    for i, (lon, lat, heading) in enumerate(rays):
+        with Timer(f"Tracing a ray from {lon}, {lat}", stage='trace'):
+            try:
+                buildings, hits = trace_ray(region, (lon, lat), heading, options.max_hits, max_distance_m,
+                                            store=store, view=options.view)
+            except KeyError:
+                buildings, hits = trace_ray(region, (lon, lat), heading, options.max_hits, max_distance_m,
+                                            view=options.view)
+        metrics.count(candidates_total, len(buildings), kind='buildings')
+        metrics.count(hits_total, len(hits.t))
+        found.append(buildings)
+        all_hits.append(hits._replace(ray=np.full(len(hits.t), i), owner=hits.owner + offset))
+        offset += len(buildings)
+    return with_addresses(region, concatenate(found), geom.RayHits.concatenate(all_hits), num_addresses)
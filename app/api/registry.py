@@ -0,0 +1,447 @@
+import contextlib
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from rtree import index
+
+from api.config import get_setting
+from api.metrics import Sample
+from api.store import GeometryStore, store_path
+from commands.util import Timer
+
+DATA_DIR = os.path.join(os.getcwd(), 'gis_data')
+INDEX_KINDS = ('buildings', 'addresses')
+STORE_KIND = 'store'
+INDEX_EXTENSIONS = ('.dat', '.idx')
+# Names the version of an index that is current
+POINTER_EXTENSION = '.current'
+# Size on disk of the regions a worker keeps open, 0 for no limit
+MEMORY_BUDGET_MB = get_setting('GIS_MEMORY_BUDGET_MB', 0, float)
+
+logger = logging.getLogger(__name__)
+
+# The entries held by the innermost `IndexRegistry.reading` block
+_held: contextvars.ContextVar = contextvars.ContextVar('held', default=None)
+
+Signature = Tuple[Tuple[int, int], ...]
+
+
+def index_base(kind: str, region: str, data_dir: str = DATA_DIR) -> str:
+    return os.path.join(data_dir, f"{kind}_{region}_rtree")
+
+
+def index_path(kind: str, region: str, data_dir: str = DATA_DIR) -> str:
+    """
+    Path, without extension, of the region's current index. Each build
+    writes a new version of the .dat and .idx pair and then points the
+    region's pointer file at it, so the pair is switched in one rename and
+    a reader never opens half of each. Indexes written before versions
+    existed have no pointer file.
+    """
+    base = index_base(kind, region, data_dir)
+    try:
+        with open(base + POINTER_EXTENSION, 'r') as pointer:
+            version = pointer.read().strip()
+    except FileNotFoundError:
+        return base
+    return f"{base}.{version}"
+
+
+def new_index_path(kind: str, region: str, data_dir: str = DATA_DIR) -> str:
+    """
+    Path for a new version of an index, unused until `publish_index`.
+    """
+    return f"{index_base(kind, region, data_dir)}.{time.time_ns():x}"
+
+
+def publish_index(kind: str, region: str, path: str, data_dir: str = DATA_DIR):
+    """
+    Make the index at `path`, from `new_index_path`, the region's current
+    one. The version it replaces is kept for readers that resolved it just
+    before the switch, and older ones are deleted.
+    """
+    base = index_base(kind, region, data_dir)
+    keep = {path, index_path(kind, region, data_dir)}
+    tmp_path = os.path.join(data_dir, '.' + os.path.basename(base) + POINTER_EXTENSION + '.tmp')
+    with open(tmp_path, 'w') as pointer:
+        pointer.write(path[len(base) + 1:])
+    os.replace(tmp_path, base + POINTER_EXTENSION)
+    prefix = os.path.basename(base) + '.'
+    versions = {os.path.join(data_dir, os.path.splitext(name)[0]) for name in os.listdir(data_dir)
+                if name.startswith(prefix) and os.path.splitext(name)[1] in INDEX_EXTENSIONS}
+    for old in (versions | {base}) - keep:
+        for extension in INDEX_EXTENSIONS:
+            try:
+                os.remove(old + extension)
+            except FileNotFoundError:
+                pass
+
+
+def file_signature(path: str) -> Signature:
+    """
+    Inode and size of the files backing the index at `path`. Published
+    index files are never written again, while libspatialindex rewrites the
+    header of an unchanged index in place whenever a handle is closed, so
+    the modification time can't be used.
+
+    Raises:
+        FileNotFoundError if either the .dat or .idx file is missing.
+    """
+    result = []
+    for extension in INDEX_EXTENSIONS:
+        stat = os.stat(path + extension)
+        result.append((stat.st_ino, stat.st_size))
+    return tuple(result)
+
+
+def disk_size(kind: str, path: str) -> int:
+    if kind == STORE_KIND:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return sum(os.path.getsize(path + extension) for extension in INDEX_EXTENSIONS)
+
+
+def discover_regions(data_dir: str) -> List[str]:
+    """
+    Regions that have both a building and an address index in `data_dir`.
+    """
+    found: Dict[str, set] = {}
+    if not os.path.isdir(data_dir):
+        return []
+    for filename in os.listdir(data_dir):
+        name, extension = os.path.splitext(filename)
+        if extension not in ('.idx', POINTER_EXTENSION) or not name.endswith('_rtree'):
+            continue
+        kind, _, region = name[:-len('_rtree')].partition('_')
+        if kind in INDEX_KINDS and region:
+            found.setdefault(region, set()).add(kind)
+    return sorted(r for r, kinds in found.items() if kinds == set(INDEX_KINDS))
+
+
+def preload_regions(regions: List[str]) -> List[str]:
+    """
+    The regions in GIS_PRELOAD_REGIONS, or all of `regions` for '*', the
+    default, that are warmed up at startup rather than opened on first use.
+    Set it to '' to open every region on first use.
+    """
+    configured = get_setting('GIS_PRELOAD_REGIONS', '*').strip()
+    if configured == '*':
+        return list(regions)
+    return [r.strip() for r in configured.split(',') if r.strip() in regions]
+
+
+class SharedIndex:
+
+    def __init__(self, path: str):
+        """
+        Open the R-tree at `path` once so it can be queried by every request.
+        libspatialindex handles are not safe for concurrent queries, so each
+        query holds a lock and materializes its results before releasing it.
+        """
+        self.path = path
+        self.signature = SharedIndex.file_signature(path)
+        self.checked_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._index = index.Index(path)
+
+    @staticmethod
+    def file_signature(path: str) -> Signature:
+        return file_signature(path)
+
+    def nearest(self, coordinates, num_results: int = 1, objects='raw') -> List:
+        with self._lock:
+            return list(self._index.nearest(coordinates, num_results, objects=objects))
+
+    def nearest_many(self, points, num_results: int = 1, objects='raw') -> List[List]:
+        """
+        Nearest neighbours for each of `points`, taking the lock once for the
+        batch. libspatialindex ranks entries by their distance in degrees.
+        """
+        with self._lock:
+            return [list(self._index.nearest(point, num_results, objects=objects)) for point in points]
+
+    def intersection(self, coordinates, objects=False) -> List:
+        with self._lock:
+            return list(self._index.intersection(coordinates, objects=objects))
+
+    def intersection_many(self, boxes) -> List[List[int]]:
+        """
+        Ids of the entries in each of `boxes`, taking the lock once for the batch.
+        """
+        with self._lock:
+            return [list(self._index.intersection(box)) for box in boxes]
+
+    def close(self):
+        with self._lock:
+            self._index.close()
+
+
+class IndexRegistry:
+
+    def __init__(self, data_dir: str = DATA_DIR, check_interval: float = 1.0,
+                 memory_budget_mb: float = MEMORY_BUDGET_MB):
+        """
+        Region-keyed cache of opened indexes, shared by all requests in a worker.
+        Regions are opened on first use. Index files are re-checked at most
+        every `check_interval` seconds and reopened when they change on disk,
+        so a region can be rebuilt in place.
+
+        Open regions are counted at the size of their files on disk, an upper
+        bound on what they can pull into memory. Past `memory_budget_mb`, the
+        least recently used regions are dropped; requests still using one keep
+        it until they finish, and the next request opens it again.
+
+        Indexes and stores that were replaced or dropped are closed as soon
+        as no `reading` block holds them any more.
+        """
+        self.data_dir = data_dir
+        self.check_interval = check_interval
+        self.memory_budget = int(memory_budget_mb * 1e6)
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._indexes: Dict[Tuple[str, str], Any] = {}
+        self._sizes: Dict[Tuple[str, str], int] = {}
+        self._used: Dict[str, float] = {}
+        self._missing: Dict[Tuple[str, str], float] = {}
+        self._retired: List[Any] = []
+        self._readers: Dict[Any, int] = {}
+        self._reload_callbacks: List[Callable[[str], None]] = []
+
+    @contextlib.contextmanager
+    def reading(self):
+        """
+        Hold every index and store that `get` returns in the block until it
+        exits, so none of them is closed while the block still uses it. An
+        entry is closed once it was replaced or evicted and the last block
+        holding it has exited. Nested blocks share the outermost one's hold.
+        """
+        if _held.get() is not None:
+            yield
+            return
+        held: List[Any] = []
+        token = _held.set(held)
+        try:
+            yield
+        finally:
+            _held.reset(token)
+            with self._lock:
+                for entry in held:
+                    self._readers[entry] -= 1
+                    if not self._readers[entry]:
+                        del self._readers[entry]
+                self._close_retired()
+
+    def get(self, kind: str, region: str) -> Any:
+        """
+        The open index or store of `kind` for `region`, opened or reopened
+        as needed. Inside a `reading` block the entry is held until the
+        block exits; outside one it can be closed at any time after a reload.
+        """
+        key = (kind, region)
+        self._used[region] = time.monotonic()
+        held = _held.get()
+        entry = self._indexes.get(key)
+        if entry is not None and not self._is_stale(kind, region, entry):
+            if held is None or any(e is entry for e in held):
+                return entry
+            with self._lock:
+                if self._indexes.get(key) is entry:
+                    self._hold(entry, held)
+                    return entry
+        with self._lock:
+            current = self._indexes.get(key)
+            if current is not entry and current is not None:
+                self._hold(current, held)
+                return current
+            entry = self._open(kind, region, current)
+            self._indexes[key] = entry
+            self._hold(entry, held)
+            if entry is not current:
+                self._sizes[key] = disk_size(kind, entry.path)
+                if current is not None:
+                    self._retired.append(current)
+                self._evict(keep=region)
+                self._close_retired()
+        if current is not None and entry is not current:
+            for callback in self._reload_callbacks:
+                callback(region)
+        return entry
+
+    def buildings(self, region: str) -> SharedIndex:
+        return self.get('buildings', region)
+
+    def addresses(self, region: str) -> SharedIndex:
+        return self.get('addresses', region)
+
+    def store(self, region: str) -> Optional[GeometryStore]:
+        """
+        The region's columnar store, or None if it hasn't been exported.
+        """
+        key = (STORE_KIND, region)
+        missing_at = self._missing.get(key)
+        if missing_at is not None and time.monotonic() - missing_at < self.check_interval:
+            return None
+        try:
+            store = self.get(STORE_KIND, region)
+        except FileNotFoundError:
+            self._missing[key] = time.monotonic()
+            return None
+        self._missing.pop(key, None)
+        return store
+
+    def version(self, region: str) -> str:
+        """
+        Short digest of the signatures of the region's open index and store
+        files. It changes whenever any of them is reloaded and is the same in
+        every worker that has the same files open.
+        """
+        store = self.store(region)
+        signatures = [self.get(kind, region).signature for kind in INDEX_KINDS]
+        signatures.append(store.signature if store is not None else None)
+        return hashlib.blake2b(repr(signatures).encode(), digest_size=8).hexdigest()
+
+    def on_reload(self, callback: Callable[[str], None]):
+        """
+        Call `callback(region)` whenever one of the region's files is reloaded.
+        """
+        self._reload_callbacks.append(callback)
+
+    def regions(self) -> List[str]:
+        return discover_regions(self.data_dir)
+
+    def loaded(self) -> Dict[str, int]:
+        """
+        Bytes counted against the budget for each open region.
+        """
+        result: Dict[str, int] = {}
+        for (_, region), size in list(self._sizes.items()):
+            result[region] = result.get(region, 0) + size
+        return result
+
+    def validate(self, regions: Optional[List[str]] = None) -> List[str]:
+        """
+        Check that every index for `regions` (by default the configured or
+        discovered regions) exists, so that missing files fail at startup
+        rather than per request. Nothing is opened.
+
+        Returns:
+            the regions checked.
+        """
+        if regions is None:
+            configured = get_setting('GIS_REGIONS', '')
+            regions = [r.strip() for r in configured.split(',') if r.strip()] or self.regions()
+        if not regions:
+            logger.warning("No region indexes found in %s", self.data_dir)
+        for region in regions:
+            for kind in INDEX_KINDS:
+                file_signature(index_path(kind, region, self.data_dir))
+            logger.info("Found indexes for %s", region)
+        return regions
+
+    def as_dict(self) -> dict:
+        loaded = self.loaded()
+        return {
+            'loaded': loaded,
+            'loaded_bytes': sum(loaded.values()),
+            'memory_budget_bytes': self.memory_budget,
+            'evictions': self.evictions
+        }
+
+    def samples(self) -> Iterator[Sample]:
+        loaded = self.loaded()
+        yield Sample('gis_regions_loaded', 'gauge', "Regions with open indexes.", {}, len(loaded))
+        yield Sample('gis_regions_loaded_bytes', 'gauge', "Size on disk of the open regions.", {},
+                     sum(loaded.values()))
+        yield Sample('gis_regions_memory_budget_bytes', 'gauge', "Budget for open regions, 0 for none.", {},
+                     self.memory_budget)
+        yield Sample('gis_region_evictions_total', 'counter', "Regions closed to stay within the budget.", {},
+                     self.evictions)
+
+    def _evict(self, keep: str):
+        """
+        Drop the least recently used regions other than `keep` until the open
+        regions fit the budget. Call with the lock held.
+        """
+        if not self.memory_budget:
+            return
+        loaded = self.loaded()
+        total = sum(loaded.values())
+        for region in sorted(loaded, key=lambda r: self._used.get(r, 0.0)):
+            if total <= self.memory_budget:
+                break
+            if region == keep:
+                continue
+            for key in [key for key in self._indexes if key[1] == region]:
+                self._retired.append(self._indexes.pop(key))
+                self._sizes.pop(key, None)
+            total -= loaded[region]
+            self.evictions += 1
+            logger.info("Closed %s (%.1f MB) to stay within the %.1f MB budget", region,
+                        loaded[region] / 1e6, self.memory_budget / 1e6)
+
+    def _hold(self, entry: Any, held: Optional[List[Any]]):
+        """
+        Count a reader of `entry` for the `reading` block with `held`, once
+        per block. Call with the lock held.
+        """
+        if held is None or any(e is entry for e in held):
+            return
+        self._readers[entry] = self._readers.get(entry, 0) + 1
+        held.append(entry)
+
+    def _close_retired(self):
+        """
+        Close the retired entries that no `reading` block holds. Call with
+        the lock held.
+        """
+        held = []
+        while self._retired:
+            entry = self._retired.pop()
+            if self._readers.get(entry):
+                held.append(entry)
+                continue
+            try:
+                entry.close()
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Could not close %s", entry.path)
+        self._retired = held
+
+    def _path(self, kind: str, region: str) -> str:
+        if kind == STORE_KIND:
+            return store_path(region, self.data_dir)
+        return index_path(kind, region, self.data_dir)
+
+    def _is_stale(self, kind: str, region: str, entry: Any) -> bool:
+        now = time.monotonic()
+        if now - entry.checked_at < self.check_interval:
+            return False
+        entry.checked_at = now
+        try:
+            path = self._path(kind, region)
+            return path != entry.path or type(entry).file_signature(path) != entry.signature
+        except FileNotFoundError:
+            return False
+
+    def _open(self, kind: str, region: str, current: Any) -> Any:
+        opener = GeometryStore if kind == STORE_KIND else SharedIndex
+        path = self._path(kind, region)
+        if current is None:
+            # rtree would silently create an empty index for a missing path
+            opener.file_signature(path)
+            with Timer(f"Opening {path}", stage=f'open_{kind}', region=region):
+                return opener(path)
+        try:
+            with Timer(f"Reopening {path}", stage=f'open_{kind}', region=region):
+                entry = opener(path)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not reload %s, keeping the open index", path)
+            return current
+        logger.info("Reloaded %s", path)
+        return entry
+
+
+registry = IndexRegistry()
@@ -0,0 +1,181 @@
+import json
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from api.geometry import LocalTangentPlane
+
+STORE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+BUILDING_COLUMNS = ('building_idx', 'building_offsets', 'building_coords', 'building_mbr',
+                    'building_center', 'building_height', 'building_ground_elevation')
+ADDRESS_COLUMNS = ('address_idx', 'address_center', 'address_text', 'address_text_with_region')
+STRING_COLUMNS = ('string_offsets', 'string_data')
+# Written by `commands.export_store --projected`, in meters on the region's plane
+PROJECTED_COLUMNS = ('building_mbr_m',)
+
+Signature = Tuple[int, int]
+
+
+def store_path(region: str, data_dir: str) -> str:
+    return os.path.join(data_dir, f"{region}_store")
+
+
+class BuildingColumns(NamedTuple):
+    """
+    Columns for a set of buildings. Heights and ground elevations are in
+    feet, and NaN where missing.
+    """
+    idx: np.array
+    height: np.array
+    ground_elevation: np.array
+    center: np.array
+    mbr: np.array
+
+    def __len__(self) -> int:
+        return len(self.idx)
+
+
+class AddressColumns(NamedTuple):
+    idx: np.array
+    center: np.array
+    address: List[str]
+    address_with_region: List[str]
+
+    def __len__(self) -> int:
+        return len(self.idx)
+
+
+class GeometryStore:
+
+    def __init__(self, path: str):
+        """
+        Read-only view of a region exported by `commands.export_store`. Every
+        column is a memory-mapped .npy file, so all workers on a host share one
+        copy through the page cache and nothing is parsed on open.
+        """
+        self.path = path
+        self.signature = GeometryStore.file_signature(path)
+        self.checked_at = time.monotonic()
+        with open(os.path.join(path, MANIFEST), 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported store version in {path}")
+        projection = self.manifest.get('projection')
+        self.plane = LocalTangentPlane(projection['origin']) if projection else None
+        self._highest: Optional[Tuple[float, float]] = None
+        names = BUILDING_COLUMNS + ADDRESS_COLUMNS + STRING_COLUMNS
+        if self.plane is not None:
+            names += PROJECTED_COLUMNS
+        self.columns: Dict[str, np.array] = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in names
+        }
+
+    def close(self):
+        """
+        Drop the column mappings. Each file is unmapped once no array read
+        from it is left.
+        """
+        self.columns = {}
+
+    @staticmethod
+    def file_signature(path: str) -> Signature:
+        # The manifest is written last, so it changes once per export
+        stat = os.stat(os.path.join(path, MANIFEST))
+        return stat.st_mtime_ns, stat.st_size
+
+    def __getattr__(self, name: str) -> np.array:
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError as e:
+            raise AttributeError(name) from e
+
+    @property
+    def region(self) -> str:
+        return self.manifest['region']
+
+    def building_rows(self, ids) -> np.array:
+        return GeometryStore._rows(self.building_idx, ids)
+
+    def address_rows(self, ids) -> np.array:
+        return GeometryStore._rows(self.address_idx, ids)
+
+    @staticmethod
+    def _rows(column: np.array, ids) -> np.array:
+        """
+        Raises:
+            KeyError if any of `ids` isn't in the store, e.g. when the index
+            was rebuilt without exporting the store again.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.searchsorted(column, ids)
+        if len(column) == 0 or np.any(rows >= len(column)) or np.any(column[rows] != ids):
+            if len(ids):
+                raise KeyError("Ids missing from geometry store")
+        return rows
+
+    def polygon(self, row: int) -> np.array:
+        """
+        The footprint of the building at `row` as an nx2 view into the store.
+        """
+        return self.building_coords[self.building_offsets[row]:self.building_offsets[row + 1]]
+
+    def footprint_bounds(self, ids) -> np.array:
+        """
+        Bounding boxes (min_x, min_y, max_x, max_y) of the footprints of
+        buildings `ids`, the boxes the building index holds.
+
+        Raises:
+            KeyError if any of `ids` isn't in the store.
+        """
+        rows = self.building_rows(ids)
+        if len(rows) == 0:
+            return np.zeros((0, 4))
+        starts = self.building_offsets[rows]
+        lengths = self.building_offsets[rows + 1] - starts
+        firsts = np.cumsum(lengths) - lengths
+        coords = self.building_coords[np.arange(lengths.sum()) + np.repeat(starts - firsts, lengths)]
+        return np.hstack([np.minimum.reduceat(coords, firsts), np.maximum.reduceat(coords, firsts)])
+
+    def projected_rects(self, ids) -> np.array:
+        """
+        Bounding rectangles of buildings `ids` in meters on `plane`, corners
+        in the same order as `building_mbr`.
+
+        Raises:
+            KeyError if any of `ids` isn't in the store.
+        """
+        return self.building_mbr_m[self.building_rows(ids)]
+
+    def highest(self) -> Tuple[float, float]:
+        """
+        The highest ground elevation and the greatest height of the
+        buildings, in feet, or NaN where none is known.
+        """
+        if self._highest is None:
+            self._highest = (float(np.fmax.reduce(self.building_ground_elevation, initial=np.nan)),
+                             float(np.fmax.reduce(self.building_height, initial=np.nan)))
+        return self._highest
+
+    def string(self, string_id: int) -> str:
+        start, end = self.string_offsets[string_id], self.string_offsets[string_id + 1]
+        return self.string_data[start:end].tobytes().decode('utf-8')
+
+    def buildings(self, ids) -> BuildingColumns:
+        rows = self.building_rows(ids)
+        return BuildingColumns(idx=self.building_idx[rows],
+                               height=self.building_height[rows],
+                               ground_elevation=self.building_ground_elevation[rows],
+                               center=self.building_center[rows],
+                               mbr=self.building_mbr[rows])
+
+    def addresses(self, ids) -> AddressColumns:
+        rows = self.address_rows(ids)
+        return AddressColumns(idx=self.address_idx[rows],
+                              center=self.address_center[rows],
+                              address=[self.string(i) for i in self.address_text[rows]],
+                              address_with_region=[self.string(i) for i in
+                                                   self.address_text_with_region[rows]])
@@ -0,0 +1,166 @@
+import logging
+import mmap
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import api.queries as queries
+from api.catalog import catalog
+from api.config import get_setting
+from api.registry import (INDEX_EXTENSIONS, INDEX_KINDS, MEMORY_BUDGET_MB, STORE_KIND, index_path,
+                          preload_regions, registry)
+
+READ_SIZE = 1 << 20
+WARM_UP_ATTEMPTS = get_setting('GIS_WARM_UP_ATTEMPTS', 3, int)
+WARM_UP_RETRY_S = get_setting('GIS_WARM_UP_RETRY_S', 5.0, float)
+
+logger = logging.getLogger(__name__)
+
+
+def budgeted(regions: List[str], memory_budget_mb: float = MEMORY_BUDGET_MB) -> List[str]:
+    """
+    The first of `regions` that fit the memory budget together, so that
+    warming up doesn't evict what it just opened.
+    """
+    if not memory_budget_mb:
+        return regions
+    result, total = [], 0
+    for region in regions:
+        try:
+            total += catalog.get(region).size_bytes
+        except KeyError:
+            continue
+        if total > memory_budget_mb * 1e6:
+            break
+        result.append(region)
+    return result
+
+
+def read_file(path: str) -> int:
+    """
+    Read `path` through once so that it is in the page cache.
+    """
+    size = 0
+    with open(path, 'rb', buffering=0) as data:
+        while True:
+            read = len(data.read(READ_SIZE))
+            if not read:
+                return size
+            size += read
+
+
+def warm_files(regions: Optional[List[str]] = None) -> int:
+    """
+    Page in the files of the regions to preload, by default those in
+    GIS_PRELOAD_REGIONS. Run in the gunicorn master before workers fork:
+    the page cache is shared by every process, and the mapped stores opened
+    here are inherited by the workers instead of opened again in each.
+    R-tree handles are not opened, since a forked handle shares its file
+    offset with every other copy.
+
+    Returns:
+        the bytes paged in.
+    """
+    if regions is None:
+        regions = budgeted(preload_regions(registry.validate()))
+    total = 0
+    for region in regions:
+        info = catalog.get(region)
+        for kind in INDEX_KINDS:
+            for extension in INDEX_EXTENSIONS:
+                total += read_file(index_path(kind, region, registry.data_dir) + extension)
+        store = registry.store(region) if STORE_KIND in info.paths else None
+        if store is not None:
+            for column in store.columns.values():
+                if column.size:
+                    # One read per page faults the whole column into the mapping
+                    int(np.frombuffer(column, dtype=np.uint8)[::mmap.PAGESIZE].sum())
+                    total += column.nbytes
+    return total
+
+
+def warm_region(region: str):
+    """
+    Open `region`'s indexes and run one query of each kind at its center.
+    """
+    for kind in INDEX_KINDS:
+        registry.get(kind, region)
+    min_x, min_y, max_x, max_y = catalog.get(region).bbox
+    center = ((min_x + max_x) / 2, (min_y + max_y) / 2)
+    queries.nearest_buildings_many(region, [center], 1)
+    queries.nearest_addresses_many(region, [center], 1)
+    queries.intersect_many(region, [(center[0], center[1], 0.0)])
+
+
+class WarmUp:
+
+    def __init__(self, attempts: int = WARM_UP_ATTEMPTS, retry_delay: float = WARM_UP_RETRY_S):
+        """
+        Opens a worker's preloaded regions in the background and runs one
+        query of each kind against them, so that the first requests don't
+        pay for opening indexes or for first calls into NumPy and rtree.
+        Regions that fail are tried again up to `attempts` times in all,
+        `retry_delay` seconds apart, e.g. while a rebuild is replacing them.
+        The worker is ready once this has finished; regions that still fail
+        are left to open on first use and reported as degraded.
+        """
+        self.attempts = max(attempts, 1)
+        self.retry_delay = retry_delay
+        self.regions: List[str] = []
+        self.failed: List[str] = []
+        self.seconds: Optional[float] = None
+        self._started_at: Optional[float] = None
+        self._done = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def degraded(self) -> bool:
+        return bool(self.failed)
+
+    def start(self, regions: List[str]) -> threading.Thread:
+        self.regions = budgeted(regions)
+        self._started_at = time.perf_counter()
+        thread = threading.Thread(target=self.run, name='warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        pending = list(self.regions)
+        for attempt in range(1, self.attempts + 1):
+            failed = []
+            for region in pending:
+                try:
+                    warm_region(region)
+                except Exception: # pylint: disable=broad-except
+                    logger.exception("Could not warm up %s (attempt %d of %d)", region, attempt, self.attempts)
+                    failed.append(region)
+            pending = failed
+            if not pending or attempt == self.attempts:
+                break
+            time.sleep(self.retry_delay)
+        self.failed = pending
+        self.seconds = time.perf_counter() - self._started_at
+        logger.info("Worker %d warmed up %d regions in %.2f s", os.getpid(),
+                    len(self.regions) - len(self.failed), self.seconds)
+        if self.failed:
+            logger.warning("Worker %d is degraded, could not warm up %s", os.getpid(), ', '.join(self.failed))
+        self._done.set()
+
+    def as_dict(self) -> Dict:
+        return {
+            'ready': self.ready,
+            'degraded': self.degraded,
+            'pid': os.getpid(),
+            'regions': self.regions,
+            'failed': self.failed,
+            'warm_up_seconds': self.seconds
+        }
+
+
+warm_up = WarmUp()
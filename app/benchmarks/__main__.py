@@ -0,0 +1,59 @@
+"""
+Full benchmark suite: generate a synthetic city in a scratch directory,
+then run the micro-benchmarks and the load driver against it.
+
+    python -m benchmarks --buildings 20000 --out before.json
+    python -m benchmarks --buildings 20000 --out after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from benchmarks.util import APP_DIR, environment, write_report
+
+REGION = 'benchville'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the benchmark suite on a synthetic city")
+    parser.add_argument('--workdir', help="scratch directory for gis_data/ (default: a new temp dir)")
+    parser.add_argument('--buildings', type=int, default=20_000)
+    parser.add_argument('--density', type=float, default=2_000.0, help="buildings per square kilometer")
+    parser.add_argument('--projected', action='store_true', help="export a projected geometry store")
+    parser.add_argument('--repeat', type=int, default=20, help="repetitions per micro-benchmark")
+    parser.add_argument('--requests', type=int, default=200, help="requests per single-point route")
+    parser.add_argument('--batches', type=int, default=20, help="requests per batch route")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--with-cache', action='store_true', help="turn the response cache on, with GIS_CACHE_SIZE entries or 10000")
+    parser.add_argument('--out', help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    if args.with_cache:
+        os.environ.setdefault('GIS_CACHE_SIZE', '10000')
+    else:
+        os.environ['GIS_CACHE_SIZE'] = '0'
+    # The app resolves gis_data/ against the working directory at import time
+    sys.path.insert(0, APP_DIR)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gis_benchmark_')
+    os.makedirs(os.path.join(workdir, 'gis_data'), exist_ok=True)
+    os.chdir(workdir)
+
+    from benchmarks import city, load, micro # pylint: disable=import-outside-toplevel
+    city.generate_city(REGION, args.buildings, args.density)
+    city.build_city(REGION, projected=args.projected)
+    write_report({
+        'environment': environment(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('workdir', 'out')},
+        'micro': micro.run(REGION, repeat=args.repeat),
+        'load': load.run(REGION, args.requests, args.concurrency, args.batches)
+    }, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Synthetic city for benchmarking without the Denver shapefiles: a jittered
+grid of rotated rectangular and L-shaped footprints with one address each,
+written to the database and indexed like a real region.
+
+Paths are relative to the working directory like the rest of the app, so
+run this from a scratch directory:
+
+    python -m benchmarks.city benchville --buildings 20000 --density 2000
+"""
+import argparse
+import logging
+import math
+import sys
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from api.geometry import meters_to_degrees
+from api.models import Address, Building
+from api.registry import DATA_DIR
+from commands.build_index import build_region, index_properties
+from commands.export_store import export_region
+from commands.load_shapes import Row, write_rows
+from commands.migrate_schema import ensure_schema
+from commands.util import Timer
+
+DEFAULT_ORIGIN = (-104.99, 39.74)
+BUILDING_TYPES = ('Residential', 'Commercial', 'Mixed Use', 'Industrial')
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+
+def footprint(rng: np.random.Generator, spacing_m: float) -> np.array:
+    """
+    A closed ring in meters around (0, 0) that fits in a `spacing_m` cell.
+    """
+    width, depth = rng.uniform(0.3, 0.8, 2) * spacing_m / 2.0
+    if rng.random() < 0.3:
+        notch_x, notch_y = width * rng.uniform(0.2, 0.8), depth * rng.uniform(0.2, 0.8)
+        ring = [(-width, -depth), (width, -depth), (width, depth - notch_y),
+                (width - notch_x, depth - notch_y), (width - notch_x, depth), (-width, depth)]
+    else:
+        ring = [(-width, -depth), (width, -depth), (width, depth), (-width, depth)]
+    angle = rng.choice([0.0, np.pi / 2.0]) + rng.normal(0.0, np.radians(8.0))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    ring = np.array(ring) @ rotation.T
+    return np.vstack([ring, ring[:1]])
+
+
+def city_rows(region: str, buildings: int, density: float, origin: Tuple[float, float],
+              seed: int) -> Iterator[Tuple[Row, Row]]:
+    """
+    Yields a (building, address) row pair for each of `buildings` buildings
+    spread at `density` buildings per square kilometer around `origin`.
+    """
+    rng = np.random.default_rng(seed)
+    per_side = max(int(math.ceil(math.sqrt(buildings))), 1)
+    spacing_m = math.sqrt(1e6 / density)
+    dlon, dlat = meters_to_degrees(origin[1], 1.0)
+    for idx in range(buildings):
+        row, column = divmod(idx, per_side)
+        x = (column - per_side / 2.0) * spacing_m + rng.normal(0.0, spacing_m * 0.05)
+        y = (row - per_side / 2.0) * spacing_m + rng.normal(0.0, spacing_m * 0.05)
+        ring = footprint(rng, spacing_m) + (x, y)
+        points = [(origin[0] + px * dlon, origin[1] + py * dlat) for px, py in ring.tolist()]
+        center = (origin[0] + x * dlon, origin[1] + y * dlat)
+        building_type = str(rng.choice(BUILDING_TYPES))
+        height = None if rng.random() < 0.05 else int(rng.choice([rng.uniform(10, 45), rng.uniform(45, 400)],
+                                                                    p=[0.9, 0.1]))
+        number = 100 + 2 * column
+        predirective = 'W' if x < 0 else 'E'
+        street = f"Street{row}"
+        yield ({
+            'idx': idx,
+            'region': region,
+            'building_id': f"{region}-{idx}",
+            'height': height,
+            'ground_elevation': int(5280 + y / 100.0),
+            'building_type': building_type,
+            'polygon_points': points,
+            'vertex_count': len(points)
+        }, {
+            'idx': idx,
+            'region': region,
+            'building_type': building_type,
+            'address_1': number,
+            'predirective': predirective,
+            'street_name': street,
+            'post_type': 'St',
+            'full_address': f"{number} {predirective} {street} St",
+            'lon': center[0],
+            'lat': center[1]
+        })
+
+
+def generate_city(region: str, buildings: int = 20_000, density: float = 2_000.0,
+                  origin: Tuple[float, float] = DEFAULT_ORIGIN, seed: int = 0) -> int:
+    """
+    Replace `region`'s buildings and addresses with a synthetic city.
+
+    Returns:
+        the number of buildings written.
+    """
+    ensure_schema()
+    Building.delete().where(Building.region == region).execute()
+    Address.delete().where(Address.region == region).execute()
+    pairs = list(city_rows(region, buildings, density, origin, seed))
+    write_rows(Building, (b for b, _ in pairs))
+    write_rows(Address, (a for _, a in pairs))
+    return len(pairs)
+
+
+def build_city(region: str, data_dir: str = DATA_DIR, projected: bool = False):
+    """
+    Build the indexes and geometry store for a generated city.
+    """
+    build_region(region, index_properties(100, 100, 0.9, 4096, 10), data_dir, num_queries=0)
+    export_region(region, data_dir, projected)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate and index a synthetic city in gis_data/")
+    parser.add_argument('region')
+    parser.add_argument('--buildings', type=int, default=20_000)
+    parser.add_argument('--density', type=float, default=2_000.0, help="buildings per square kilometer")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--projected', action='store_true', help="export a projected geometry store")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with Timer(f"Generating {args.buildings} buildings for {args.region}"):
+        generate_city(args.region, args.buildings, args.density, seed=args.seed)
+    build_city(args.region, projected=args.projected)
@@ -0,0 +1,53 @@
+"""
+Compare two benchmark reports and list the timings that changed.
+
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+"""
+import argparse
+import json
+from typing import Any, Dict, Iterator, Tuple
+
+# Leaves compared, by key suffix. Lower is better for all but throughput.
+TIMINGS = ('_ms', '_s')
+RATES = ('_rps', 'speedup')
+
+
+def leaves(report: Any, prefix: str = '') -> Iterator[Tuple[str, float]]:
+    if isinstance(report, dict):
+        for key, value in sorted(report.items()):
+            yield from leaves(value, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(report, (int, float)) and not isinstance(report, bool):
+        if prefix.endswith(TIMINGS + RATES):
+            yield prefix, float(report)
+
+
+def compare(before: Dict[str, Any], after: Dict[str, Any], threshold: float) -> Iterator[str]:
+    old = dict(leaves({k: v for k, v in before.items() if k != 'environment'}))
+    new = dict(leaves({k: v for k, v in after.items() if k != 'environment'}))
+    for name in sorted(old.keys() & new.keys()):
+        if old[name] == 0.0:
+            continue
+        change = new[name] / old[name] - 1.0
+        if abs(change) < threshold:
+            continue
+        better = change < 0 if not name.endswith(RATES) else change > 0
+        yield f"{'better' if better else 'worse ':6} {change:+8.1%}  {old[name]:12.4f} -> {new[name]:12.4f}  {name}"
+    for name in sorted(old.keys() ^ new.keys()):
+        yield f"{'only in ' + ('before' if name in old else 'after'):14} {name}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Diff two benchmark reports")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help="smallest relative change to show")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{before['environment'].get('commit')} -> {after['environment'].get('commit')}")
+    for line in compare(before, after, args.threshold):
+        print(line)
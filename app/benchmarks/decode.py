@@ -0,0 +1,119 @@
+"""
+Compare reading points and polygons from the JSON text columns of schema
+version 1 with the REAL and packed BLOB columns of version 2, on a synthetic
+city held in in-memory SQLite databases.
+
+    python -m benchmarks.decode --buildings 20000
+"""
+import argparse
+import json
+import sqlite3
+import sys
+from typing import Any, Dict
+
+import numpy as np
+
+from api.models import PointArrayField
+from benchmarks.city import DEFAULT_ORIGIN, city_rows
+from benchmarks.util import measure
+
+REGION = 'decodeville'
+SCHEMAS = {
+    1: ("CREATE TABLE building (idx INTEGER PRIMARY KEY, region TEXT, polygon_points TEXT)",
+        "CREATE TABLE address (idx INTEGER PRIMARY KEY, region TEXT, coord TEXT)"),
+    2: ("CREATE TABLE building (id INTEGER PRIMARY KEY, idx INTEGER, region TEXT, polygon_points BLOB, "
+        "vertex_count INTEGER, UNIQUE (region, idx))",
+        "CREATE TABLE address (id INTEGER PRIMARY KEY, idx INTEGER, region TEXT, lon REAL, lat REAL, "
+        "UNIQUE (region, idx))")
+}
+
+
+def databases(buildings: int) -> Dict[int, sqlite3.Connection]:
+    pairs = list(city_rows(REGION, buildings, 2_000.0, DEFAULT_ORIGIN, seed=0))
+    blob_field = PointArrayField()
+    result = {}
+    for version, statements in SCHEMAS.items():
+        connection = sqlite3.connect(':memory:')
+        for statement in statements:
+            connection.execute(statement)
+        if version == 1:
+            connection.executemany("INSERT INTO building VALUES (?, ?, ?)",
+                                   [(b['idx'], REGION, json.dumps(b['polygon_points']))
+                                    for b, _ in pairs])
+            connection.executemany("INSERT INTO address VALUES (?, ?, ?)",
+                                   [(a['idx'], REGION, json.dumps([[a['lon'], a['lat']]]))
+                                    for _, a in pairs])
+        else:
+            connection.executemany("INSERT INTO building (idx, region, polygon_points, vertex_count) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   [(b['idx'], REGION, blob_field.db_value(b['polygon_points']),
+                                     b['vertex_count']) for b, _ in pairs])
+            connection.executemany("INSERT INTO address (idx, region, lon, lat) VALUES (?, ?, ?, ?)",
+                                   [(a['idx'], REGION, a['lon'], a['lat']) for _, a in pairs])
+        result[version] = connection
+    return result
+
+
+def run(buildings: int = 20_000, lookups: int = 50, repeat: int = 20) -> Dict[str, Any]:
+    """
+    Time decoding every polygon and address point of a region, and fetching
+    `lookups` random buildings by idx, in each schema version.
+    """
+    connections = databases(buildings)
+    blob_field = PointArrayField()
+    ids = json.dumps(np.random.default_rng(0).choice(buildings, lookups, replace=False).tolist())
+
+    def polygons_v1():
+        rows = connections[1].execute("SELECT polygon_points FROM building WHERE region = ?", (REGION,))
+        return [np.array(json.loads(text), dtype=float) for text, in rows]
+
+    def polygons_v2():
+        rows = connections[2].execute("SELECT polygon_points FROM building WHERE region = ?", (REGION,))
+        return [blob_field.python_value(blob) for blob, in rows]
+
+    def points_v1():
+        rows = connections[1].execute("SELECT coord FROM address WHERE region = ?", (REGION,))
+        return np.array([json.loads(text)[0] for text, in rows], dtype=float)
+
+    def points_v2():
+        return np.array(connections[2].execute("SELECT lon, lat FROM address WHERE region = ?",
+                                               (REGION,)).fetchall(), dtype=float)
+
+    def lookup_v1():
+        rows = connections[1].execute("SELECT polygon_points FROM building "
+                                      "WHERE idx IN (SELECT value FROM json_each(?))", (ids,))
+        return [np.array(json.loads(text), dtype=float) for text, in rows]
+
+    def lookup_v2():
+        rows = connections[2].execute("SELECT polygon_points FROM building "
+                                      "WHERE region = ? AND idx IN (SELECT value FROM json_each(?))",
+                                      (REGION, ids))
+        return [blob_field.python_value(blob) for blob, in rows]
+
+    cases = {'polygons': (polygons_v1, polygons_v2), 'address_points': (points_v1, points_v2),
+             f'lookup_{lookups}_buildings': (lookup_v1, lookup_v2)}
+    report: Dict[str, Any] = {'buildings': buildings, 'repeat': repeat, 'results': {}}
+    for name, (v1, v2) in cases.items():
+        old, new = v1(), v2()
+        case = {'json': measure(v1, repeat), 'packed': measure(v2, repeat)}
+        case['identical_values'] = all(np.array_equal(a, b) for a, b in zip(old, new)) and len(old) == len(new)
+        case['speedup'] = case['json']['mean_ms'] / case['packed']['mean_ms']
+        report['results'][name] = case
+    sizes = {version: c.execute("SELECT SUM(LENGTH(polygon_points)) FROM building").fetchone()[0]
+             for version, c in connections.items()}
+    report['polygon_bytes'] = {'json': sizes[1], 'packed': sizes[2]}
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark decoding JSON text versus packed geometry columns")
+    parser.add_argument('--buildings', type=int, default=20_000)
+    parser.add_argument('--lookups', type=int, default=50, help="buildings fetched by idx per lookup")
+    parser.add_argument('--repeat', type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    json.dump(run(args.buildings, args.lookups, args.repeat), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,109 @@
+"""
+Compare deduplicating building footprints by a digest of their JSON text,
+as the loader used to, with canonical ring hashes and the overlap pass, on a
+synthetic city with known duplicates mixed in.
+
+    python -m benchmarks.dedupe --buildings 20000 --duplicates 0.05
+"""
+import argparse
+import hashlib
+import json
+import sys
+from typing import Any, Dict, Iterable, Iterator, List
+
+import numpy as np
+
+from benchmarks.city import DEFAULT_ORIGIN, city_rows
+from benchmarks.util import measure
+from commands.dedupe_buildings import QUANTUM, DedupeStats, merge_overlapping, unique_footprints
+from commands.load_shapes import Row
+
+REGION = 'dedupeville'
+VARIANTS = ('copy', 'rotated', 'reversed', 'open', 'noisy', 'contained')
+
+
+def variant(points: List, kind: str, rng: np.random.Generator) -> List:
+    ring = np.array(points, dtype=float)
+    if kind == 'rotated':
+        ring = np.roll(ring[:-1], int(rng.integers(1, len(ring) - 1)), axis=0)
+        ring = np.vstack([ring, ring[:1]])
+    elif kind == 'reversed':
+        ring = ring[::-1]
+    elif kind == 'open':
+        ring = ring[:-1]
+    elif kind == 'noisy':
+        ring = ring + rng.uniform(-QUANTUM / 100, QUANTUM / 100, ring.shape)
+    elif kind == 'contained':
+        center = ring[:-1].mean(axis=0)
+        ring = center + (ring - center) * 0.95
+    return [tuple(p) for p in ring.tolist()]
+
+
+def rows_with_duplicates(buildings: int, share: float, seed: int = 0) -> Dict[str, Any]:
+    """
+    A city's building rows with `share` of them duplicated again, spread
+    evenly over the kinds of variant, and how many of each were added.
+    """
+    rng = np.random.default_rng(seed)
+    rows = [b for b, _ in city_rows(REGION, buildings, 2_000.0, DEFAULT_ORIGIN, seed)]
+    originals = rng.choice(len(rows), int(len(rows) * share), replace=False)
+    added = {kind: 0 for kind in VARIANTS}
+    for n, i in enumerate(originals.tolist()):
+        kind = VARIANTS[n % len(VARIANTS)]
+        rows.append({**rows[i], 'polygon_points': variant(rows[i]['polygon_points'], kind, rng)})
+        added[kind] += 1
+    order = rng.permutation(len(rows))
+    return {'rows': [rows[i] for i in order.tolist()], 'added': added}
+
+
+def json_digests(rows: Iterable[Row]) -> Iterator[Row]:
+    seen = set()
+    for row in rows:
+        key = hashlib.blake2b(json.dumps(row['polygon_points']).encode(), digest_size=16).digest()
+        if key not in seen:
+            seen.add(key)
+            yield row
+
+
+def run(buildings: int = 20_000, share: float = 0.05, repeat: int = 5) -> Dict[str, Any]:
+    """
+    Time each method over the rows, and count the duplicates it removed
+    against the number that were added.
+    """
+    city = rows_with_duplicates(buildings, share)
+    rows, added = city['rows'], city['added']
+    methods = {
+        'json': lambda: list(json_digests(rows)),
+        'canonical': lambda: list(unique_footprints(rows)),
+        'canonical_overlap': lambda: merge_overlapping(unique_footprints(rows), 0.9)
+    }
+    expected = {'json': added['copy'],
+                'canonical': sum(added.values()) - added['contained'],
+                'canonical_overlap': sum(added.values())}
+    report: Dict[str, Any] = {'footprints': len(rows), 'added': added, 'repeat': repeat, 'results': {}}
+    for name, method in methods.items():
+        timing = measure(method, repeat)
+        report['results'][name] = {
+            'removed': len(rows) - len(method()),
+            'expected': expected[name],
+            'footprints_per_s': len(rows) / (timing['mean_ms'] / 1000.0),
+            **timing
+        }
+    stats = DedupeStats()
+    merge_overlapping(unique_footprints(rows, stats=stats), 0.9, stats)
+    report['stats'] = {'copies': stats.copies, 'overlapping': stats.overlapping, 'summary': stats.summary()}
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark building footprint deduplication")
+    parser.add_argument('--buildings', type=int, default=20_000)
+    parser.add_argument('--duplicates', type=float, default=0.05, help="share of buildings duplicated")
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    json.dump(run(args.buildings, args.duplicates, args.repeat), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,63 @@
+"""
+Time the vectorized geodesy in api.geometry against the per-point geopy
+calls it replaces. Accuracy is checked by tests/test_geodesy.py.
+
+    python -m benchmarks.geodesy --samples 2000
+"""
+import argparse
+import json
+import sys
+import time
+
+import geopy
+import geopy.distance
+import numpy as np
+
+import api.geometry as geom
+
+MAX_LAT = 80.0
+
+
+def geopy_destination(point, heading: float, meters: float) -> np.array:
+    start = geopy.Point(point[1], point[0])
+    end = geopy.distance.distance(meters=meters).destination(point=start, bearing=heading)
+    return np.array([end.longitude, end.latitude])
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run(samples: int) -> dict:
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(-180.0, 180.0, samples), rng.uniform(-MAX_LAT, MAX_LAT, samples)])
+    headings = rng.uniform(0.0, 360.0, samples)
+    meters = rng.uniform(1.0, 20000.0, samples)
+    others = geom.destination(points, headings, meters)
+    timings = {
+        'geopy_destination_s': timed(lambda: [geopy_destination(p, h, m)
+                                              for p, h, m in zip(points, headings, meters)]),
+        'bearing_to_direction_s': timed(lambda: geom.bearing_to_direction(points[:, 1], headings)),
+        'destination_s': timed(lambda: geom.destination(points, headings, meters)),
+        'geopy_great_circle_s': timed(lambda: [geopy.distance.great_circle(p[::-1], q[::-1]).meters
+                                               for p, q in zip(points, others)]),
+        'geopy_geodesic_s': timed(lambda: [geopy.distance.distance(p[::-1], q[::-1]).meters
+                                           for p, q in zip(points, others)]),
+        'haversine_meters_s': timed(lambda: geom.haversine_meters(points, others)),
+        'equirectangular_meters_s': timed(lambda: geom.equirectangular_meters(points, others)),
+        'enu_round_trip_s': timed(lambda: geom.from_enu(geom.enu(others, points[0]), points[0]))
+    }
+    return {'samples': samples, 'timings': timings}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time the vectorized geodesy against geopy")
+    parser.add_argument('--samples', type=int, default=2000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    json.dump(run(parse_args().samples), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,167 @@
+"""
+End-to-end load driver that calls the ASGI app in-process, so it measures
+the whole request path (routing, validation, query pool, serialization)
+without a server or network in the way. Needs a generated region, see
+benchmarks.city.
+
+    python -m benchmarks.load benchville --requests 500 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from benchmarks.util import environment, summarize, write_report
+
+Bounds = Tuple[float, float, float, float]
+Request = Tuple[str, str, Optional[dict], Optional[dict]]
+
+
+async def asgi_request(app: Callable, method: str, path: str, params: Optional[dict] = None,
+                       body: Optional[dict] = None) -> Tuple[int, bytes]:
+    """
+    Send one HTTP request straight to an ASGI app.
+
+    Returns:
+        the status code and response body.
+    """
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf-8'),
+        'root_path': '',
+        'query_string': urlencode(params or {}).encode('utf-8'),
+        'headers': [(b'host', b'benchmark'), (b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode('utf-8'))],
+        'client': ('127.0.0.1', 0),
+        'server': ('benchmark', 80)
+    }
+    messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    status, chunks = 0, []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, b''.join(chunks)
+
+
+def workload(region: str, bounds: Bounds, count: int, batches: int, batch_size: int, k: int,
+             rng: random.Random) -> Dict[str, List[Request]]:
+    """
+    `count` requests per single-point route and `batches` per batch route, at
+    uniformly random points within `bounds`.
+    """
+    minx, miny, maxx, maxy = bounds
+
+    def point(heading: bool = False) -> dict:
+        result = {'lat': rng.uniform(miny, maxy), 'lon': rng.uniform(minx, maxx)}
+        if heading:
+            result['heading'] = rng.uniform(0.0, 360.0)
+        return result
+
+    def batch(mode: str = 'nearest') -> dict:
+        return {'region': region, 'k': k, 'mode': mode,
+                'points': [point(heading=True) for _ in range(batch_size)]}
+
+    return {
+        'GET /addresses': [('GET', '/addresses', {'region': region, 'k': k, **point()}, None)
+                           for _ in range(count)],
+        'GET /buildings': [('GET', '/buildings', {'region': region, 'k': k, **point()}, None)
+                           for _ in range(count)],
+        'GET /intersect': [('GET', '/intersect', {'region': region, 'k': k, **point(heading=True)}, None)
+                           for _ in range(count)],
+        'GET /intersect?mode=ray': [('GET', '/intersect', {'region': region, 'mode': 'ray', 'max_hits': 3,
+                                                           **point(heading=True)}, None)
+                                    for _ in range(count)],
+        'POST /addresses/batch': [('POST', '/addresses/batch', None, batch()) for _ in range(batches)],
+        'POST /intersect/batch': [('POST', '/intersect/batch', None, batch()) for _ in range(batches)]
+    }
+
+
+async def drive(app: Callable, requests: List[Request], concurrency: int) -> Dict[str, Any]:
+    """
+    Send `requests` with at most `concurrency` in flight.
+    """
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(request: Request):
+        method, path, params, body = request
+        async with slots:
+            start = time.perf_counter()
+            status, _ = await asgi_request(app, method, path, params, body)
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(r) for r in requests))
+    elapsed = time.perf_counter() - start
+    return {
+        'latency': summarize(latencies),
+        'throughput_rps': len(requests) / elapsed if elapsed else 0.0,
+        'statuses': statuses
+    }
+
+
+async def run_async(app: Any, region: str, bounds: Bounds, count: int, concurrency: int,
+                    batches: int, batch_size: int, k: int, seed: int) -> Dict[str, Any]:
+    routes = workload(region, bounds, count, batches, batch_size, k, random.Random(seed))
+    await app.router.startup()
+    try:
+        # One request per route first, so index opening isn't timed
+        for requests in routes.values():
+            await asgi_request(app, *requests[0])
+        return {name: await drive(app, requests, concurrency) for name, requests in routes.items()}
+    finally:
+        await app.router.shutdown()
+
+
+def run(region: str, requests: int = 200, concurrency: int = 8, batches: int = 20,
+        batch_size: int = 50, k: int = 50, seed: int = 0) -> Dict[str, Any]:
+    """
+    Drive every route of `main.app` with requests against `region`. Settings
+    such as GIS_CACHE_SIZE are read when the app is imported, so set them in
+    the environment before calling this.
+    """
+    from main import app # pylint: disable=import-outside-toplevel
+    from api.registry import registry # pylint: disable=import-outside-toplevel
+    bounds = registry.buildings(region)._index.bounds # pylint: disable=protected-access
+    return asyncio.run(run_async(app, region, tuple(bounds), requests, concurrency, batches, batch_size,
+                                 k, seed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive the API in-process and report latency per route")
+    parser.add_argument('region')
+    parser.add_argument('--requests', type=int, default=200, help="requests per single-point route")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batches', type=int, default=20, help="requests per batch route")
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--out', help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    write_report({'environment': environment(),
+                  'load': run(args.region, args.requests, args.concurrency, args.batches,
+                              args.batch_size, args.k)},
+                 args.out)
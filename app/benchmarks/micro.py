@@ -0,0 +1,147 @@
+"""
+Micro-benchmarks for the geometry kernels, the region indexes, response
+serialization and geometry column decoding. Index and visibility
+benchmarks need a generated region, see benchmarks.city.
+
+    python -m benchmarks.micro --region benchville
+"""
+import argparse
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+import api.geometry as geom
+import api.queries as api_queries
+from api.catalog import catalog
+from api.registry import DATA_DIR, SharedIndex, index_path
+from api.store import GeometryStore, store_path
+from benchmarks import decode, dedupe, serialization
+from benchmarks.util import environment, measure, summarize, write_report
+
+
+def random_hulls(rng: np.random.Generator, n: int) -> list:
+    return [geom.convex_hull(rng.normal(0.0, 1e-4, (rng.integers(4, 12), 2)) + (-104.99, 39.74))
+            for _ in range(n)]
+
+
+def bench_bounding_rectangles(rng: np.random.Generator, n: int, repeat: int) -> Dict[str, Any]:
+    hulls = random_hulls(rng, n)
+    return {
+        'hulls': n,
+        'minimum_bounding_rectangle': measure(lambda: [geom.minimum_bounding_rectangle(h) for h in hulls],
+                                              repeat),
+        'minimum_bounding_rectangles': measure(lambda: geom.minimum_bounding_rectangles(hulls), repeat)
+    }
+
+
+def bench_ray_intersection(rng: np.random.Generator, rays: int, buildings: int,
+                           repeat: int) -> Dict[str, Any]:
+    hulls = random_hulls(rng, buildings)
+    centers = np.array([h.mean(axis=0) for h in hulls])
+    rects = geom.sorted_rects_by_polar_angle(geom.minimum_bounding_rectangles(hulls), centers)
+    edges = geom.EdgeSet.from_rects(rects)
+    origins = rng.normal(0.0, 1e-4, (rays, 2)) + (-104.99, 39.74)
+    headings = rng.uniform(0.0, 360.0, rays)
+    geom_rays = [geom.Ray(tuple(o), h) for o, h in zip(origins, headings)]
+    lines = list(zip(edges.starts, edges.ends))
+
+    def per_edge():
+        return [ray.line_intersection(line) for ray in geom_rays for line in lines]
+
+    def vectorized():
+        return geom.intersect_rays(origins, geom.bearing_to_direction(origins[:, 1], headings), edges)
+
+    return {
+        'rays': rays,
+        'edges': len(lines),
+        'line_intersection': measure(per_edge, max(repeat // 10, 1)),
+        'intersect_rays': measure(vectorized, repeat)
+    }
+
+
+def bench_indexes(region: str, data_dir: str, queries: int, k: int,
+                  rng: np.random.Generator) -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    for kind in ('buildings', 'addresses'):
+        path = index_path(kind, region, data_dir)
+        opens = []
+        for _ in range(5):
+            start = time.perf_counter()
+            rtree = SharedIndex(path)
+            opens.append(time.perf_counter() - start)
+            rtree.close()
+        rtree = SharedIndex(path)
+        minx, miny, maxx, maxy = rtree._index.bounds # pylint: disable=protected-access
+        points = np.column_stack([rng.uniform(minx, maxx, queries), rng.uniform(miny, maxy, queries)])
+        nearest = []
+        for point in points.tolist():
+            start = time.perf_counter()
+            rtree.nearest(point, k, objects=False)
+            nearest.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        rtree.nearest_many(points.tolist(), k, objects=False)
+        batch = time.perf_counter() - start
+        result[kind] = {
+            'open': summarize(opens),
+            f'nearest_{k}': summarize(nearest),
+            f'nearest_many_{k}_per_point_ms': batch / queries * 1000.0
+        }
+        rtree.close()
+    opens = []
+    for _ in range(5):
+        start = time.perf_counter()
+        GeometryStore(store_path(region, data_dir))
+        opens.append(time.perf_counter() - start)
+    result['store'] = {'open': summarize(opens)}
+    return result
+
+
+def bench_visibility(region: str, rays: int, repeat: int, rng: np.random.Generator) -> Dict[str, Any]:
+    """
+    Intersections in each traversal mode with and without a viewer at eye
+    level, for rays from the region in the working directory.
+    """
+    min_x, min_y, max_x, max_y = catalog.get(region).bbox
+    headings = [(lon, lat, heading) for lon, lat, heading in zip(
+        rng.uniform(min_x, max_x, rays).tolist(), rng.uniform(min_y, max_y, rays).tolist(),
+        rng.uniform(0.0, 360.0, rays).tolist())]
+    result: Dict[str, Any] = {'rays': rays}
+    for mode in ('nearest', 'ray'):
+        for name, view in (('all', None), ('visible', api_queries.View())):
+            options = api_queries.SearchOptions(mode=mode, view=view)
+            hits = len(api_queries.intersect_many(region, headings, options).hits.t)
+            result[f'{mode}_{name}'] = {
+                'hits': hits,
+                **measure(lambda o=options: api_queries.intersect_many(region, headings, o), repeat)
+            }
+    return result
+
+
+def run(region: Optional[str], data_dir: str = DATA_DIR, repeat: int = 20, queries: int = 1000,
+        k: int = 50) -> Dict[str, Any]:
+    rng = np.random.default_rng(0)
+    report: Dict[str, Any] = {
+        'bounding_rectangles': bench_bounding_rectangles(rng, 1000, repeat),
+        'ray_intersection': bench_ray_intersection(rng, 20, 50, repeat),
+        'serialization': serialization.run(points=20, k=k, hits=5, repeat=repeat)['results'],
+        'decode': decode.run(buildings=5000, repeat=repeat)['results'],
+        'dedupe': dedupe.run(buildings=5000, repeat=max(repeat // 4, 1))['results']
+    }
+    if region:
+        report['indexes'] = bench_indexes(region, data_dir, queries, k, rng)
+        report['visibility'] = bench_visibility(region, 100, max(repeat // 10, 1), rng)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the micro-benchmarks")
+    parser.add_argument('--region', help="generated region to benchmark the indexes of")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--out', help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    write_report({'environment': environment(), 'micro': run(args.region, repeat=args.repeat)}, args.out)
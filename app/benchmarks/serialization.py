@@ -0,0 +1,152 @@
+"""
+Compare the old per-item pydantic response path with the plain-dict path
+the handlers use now, on synthetic query results. Fails if the default
+'json' encoder doesn't write exactly the bytes of the old path.
+
+    python -m benchmarks.serialization --points 100 --k 50
+"""
+import argparse
+import json
+import sys
+from typing import List
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+
+import api.api as api
+import api.geometry as geom
+from api.encoding import ENCODERS, dumps, orjson
+from api.queries import Intersections
+from api.store import AddressColumns, BuildingColumns
+from benchmarks.util import measure
+
+
+def synthetic_buildings(rng: np.random.Generator, n: int) -> BuildingColumns:
+    center = np.column_stack([rng.uniform(-105.0, -104.9, n), rng.uniform(39.7, 39.8, n)])
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=float) * 1e-4
+    return BuildingColumns(idx=np.arange(n, dtype=np.int64),
+                           height=rng.uniform(10.0, 100.0, n),
+                           ground_elevation=rng.uniform(5200.0, 5400.0, n),
+                           center=center,
+                           mbr=center[:, None, :] + corners[None, :, :])
+
+
+def synthetic_addresses(rng: np.random.Generator, n: int) -> AddressColumns:
+    center = np.column_stack([rng.uniform(-105.0, -104.9, n), rng.uniform(39.7, 39.8, n)])
+    address = [f"{i} E Colfax Ave" for i in range(n)]
+    return AddressColumns(idx=np.arange(n, dtype=np.int64), center=center, address=address,
+                          address_with_region=[a + ", Denver" for a in address])
+
+
+def synthetic_intersections(rng: np.random.Generator, rays: int, hits_per_ray: int) -> Intersections:
+    n = rays * hits_per_ray
+    hits = geom.RayHits(ray=np.repeat(np.arange(rays), hits_per_ray),
+                        edge=np.arange(n),
+                        owner=np.arange(n),
+                        t=np.sort(rng.uniform(1e-5, 1e-2, n)),
+                        point=np.column_stack([rng.uniform(-105.0, -104.9, n), rng.uniform(39.7, 39.8, n)]),
+                        normal=np.tile([[1.0, 0.0]], (n, 1)),
+                        face_length=rng.uniform(5.0, 50.0, n))
+    addresses = [[f"{i} E Colfax Ave, Denver"] * 3 for i in range(n)]
+    return Intersections(synthetic_buildings(rng, n), hits, addresses)
+
+
+# The response path before handlers built plain dicts: one model per result
+# and per coordinate, then FastAPI validated the response against the route's
+# response_model and encoded it with JSONResponse.
+def model_address_results(addresses: AddressColumns) -> List[dict]:
+    result = []
+    for i in range(len(addresses)):
+        center = addresses.center[i]
+        model = api.AddressResult(address=addresses.address[i],
+                                  coord=api.CoordinateOut(latitude=center[1], longitude=center[0]))
+        result.append(model.dict())
+    return result
+
+
+def model_building_results(buildings: BuildingColumns) -> List[dict]:
+    result = []
+    for i in range(len(buildings)):
+        center = buildings.center[i]
+        polygon_coords = [api.CoordinateOut(latitude=p[1], longitude=p[0]) for p in buildings.mbr[i]]
+        model = api.AddressResult(address="Some",
+                                  coord=api.CoordinateOut(latitude=center[1], longitude=center[0]),
+                                  polygon_coords=polygon_coords)
+        result.append(model.dict())
+    return result
+
+
+def model_intersection_results(isects: Intersections, ray: int) -> List[api.IntersectionResult]:
+    hits, buildings = isects.hits, isects.buildings
+    result = []
+    for i in isects.for_ray(ray):
+        owner = hits.owner[i]
+        pt = hits.point[i]
+        result.append(api.IntersectionResult(idx=int(buildings.idx[owner]),
+                                             t=hits.t[i],
+                                             addresses=isects.addresses[i],
+                                             point=api.CoordinateOut(latitude=pt[1], longitude=pt[0]),
+                                             normal=api.PointOut(x=hits.normal[i][0], y=hits.normal[i][1]),
+                                             face_length=hits.face_length[i],
+                                             face_height=buildings.height[owner] * geom.FT_TO_M or 5.0))
+    return result
+
+
+def model_response(model, content: dict) -> bytes:
+    value = model.parse_obj(jsonable_encoder(content))
+    return json.dumps(jsonable_encoder(value), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def batch(results: list) -> dict:
+    return {'count': len(results), 'results': [{'count': len(r), 'result': r} for r in results]}
+
+
+def run(points: int, k: int, hits: int, repeat: int) -> dict:
+    rng = np.random.default_rng(0)
+    addresses = [synthetic_addresses(rng, k) for _ in range(points)]
+    buildings = [synthetic_buildings(rng, k) for _ in range(points)]
+    isects = synthetic_intersections(rng, points, hits)
+    cases = {
+        'addresses': (
+            api.BatchAddressOut,
+            lambda: batch([model_address_results(a) for a in addresses]),
+            lambda: batch([api.address_results(a) for a in addresses])),
+        'buildings': (
+            api.BatchAddressOut,
+            lambda: batch([model_building_results(b) for b in buildings]),
+            lambda: batch([api.building_results(b) for b in buildings])),
+        'intersections': (
+            api.BatchIntersectionOut,
+            lambda: batch([model_intersection_results(isects, r) for r in range(points)]),
+            lambda: batch([api.intersection_results(isects, r) for r in range(points)]))
+    }
+    encoders = [e for e in ENCODERS if e != 'orjson' or orjson is not None]
+    report = {'points': points, 'k': k, 'hits_per_ray': hits, 'repeat': repeat, 'results': {}}
+    for name, (model, model_content, fast_content) in cases.items():
+        expected = model_response(model, model_content())
+        case = {'model': measure(lambda: model_response(model, model_content()), repeat)}
+        for encoder in encoders:
+            body = dumps(fast_content(), encoder)
+            case[encoder] = measure(lambda: dumps(fast_content(), encoder), repeat)
+            case[encoder]['identical_bytes'] = body == expected
+            case[encoder]['identical_values'] = json.loads(body) == json.loads(expected)
+            case[encoder]['speedup'] = case['model']['mean_ms'] / case[encoder]['mean_ms']
+        assert case['json']['identical_bytes'], f"'json' encoding of {name} differs from the model path"
+        report['results'][name] = case
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark response serialization")
+    parser.add_argument('--points', type=int, default=100, help="points per batch")
+    parser.add_argument('--k', type=int, default=50, help="results per point")
+    parser.add_argument('--hits', type=int, default=5, help="intersections per ray")
+    parser.add_argument('--repeat', type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    json.dump(run(args.points, args.k, args.hits, args.repeat), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,71 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(samples: Sequence[float]) -> Dict[str, float]:
+    """
+    Count, mean and percentiles in milliseconds of `samples` in seconds.
+    """
+    ms = np.asarray(samples, dtype=float) * 1000.0
+    if len(ms) == 0:
+        return {'count': 0}
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'max_ms': float(ms.max())
+    }
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def write_report(report: Dict[str, Any], path: Optional[str]):
+    """
+    Write `report` as sorted, indented JSON so runs from different commits diff cleanly.
+    """
+    if path is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+        report_file.write('\n')
@@ -0,0 +1,134 @@
+import argparse
+from itertools import chain
+import logging
+import os
+import random
+import sys
+import time
+from typing import Iterator, Tuple
+
+import numpy as np
+from rtree import index
+
+from api.catalog import record_region
+from api.models import Address, Building
+from api.registry import DATA_DIR, INDEX_EXTENSIONS, index_path, new_index_path, publish_index
+from commands.util import Timer
+
+EPSILON = 0.000001
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+Item = Tuple[int, Tuple[float, float, float, float], tuple]
+
+
+def generate_buildings(region: str) -> Iterator[Item]:
+    query = Building.select().where(Building.region == region).order_by(Building.idx)
+    for b in query.iterator():
+        minx, miny, maxx, maxy = b.bbox
+        yield (b.idx, (minx, miny, maxx, maxy), b.to_entry())
+
+def generate_addresses(region: str) -> Iterator[Item]:
+    query = Address.select().where(Address.region == region).order_by(Address.idx)
+    for a in query.iterator():
+        minx, miny = a.center
+        yield (a.idx, (minx, miny, minx + EPSILON, miny + EPSILON), a.to_entry())
+
+def index_properties(leaf_capacity: int, index_capacity: int, fill_factor: float,
+                     page_size: int, buffering_capacity: int) -> index.Property:
+    properties = index.Property()
+    properties.leaf_capacity = leaf_capacity
+    properties.index_capacity = index_capacity
+    properties.fill_factor = fill_factor
+    properties.pagesize = page_size
+    properties.buffering_capacity = buffering_capacity
+    properties.overwrite = True
+    return properties
+
+def build_index(kind: str, region: str, items: Iterator[Item], properties: index.Property,
+                data_dir: str = DATA_DIR) -> int:
+    """
+    Bulk-load `items` into a new version of the region's index and make it
+    current. Given a stream, libspatialindex packs the tree with
+    Sort-Tile-Recursive instead of inserting one item at a time. Readers
+    keep the previous version until the finished pair is published.
+
+    Returns:
+        the number of items indexed.
+    """
+    path = new_index_path(kind, region, data_dir)
+    items = iter(items)
+    first = next(items, None)
+    count = 0
+
+    def counted():
+        nonlocal count
+        for item in chain([first], items):
+            count += 1
+            yield item
+
+    if first is None:
+        # libspatialindex refuses to bulk-load an empty stream
+        built = index.Index(path, properties=properties)
+    else:
+        built = index.Index(path, counted(), properties=properties)
+    built.close()
+    publish_index(kind, region, path, data_dir)
+    return count
+
+def measure_queries(path: str, num_queries: int = 1000, num_results: int = 50) -> np.array:
+    """
+    Latencies in seconds of `num_queries` nearest-neighbour queries at random
+    points within the index bounds.
+    """
+    rtree = index.Index(path)
+    minx, miny, maxx, maxy = rtree.bounds
+    rng = random.Random(0)
+    latencies = []
+    for _ in range(num_queries):
+        point = (rng.uniform(minx, maxx), rng.uniform(miny, maxy))
+        start = time.perf_counter()
+        list(rtree.nearest(point, num_results, objects='raw'))
+        latencies.append(time.perf_counter() - start)
+    rtree.close()
+    return np.array(latencies)
+
+def build_region(region: str, properties: index.Property, data_dir: str = DATA_DIR,
+                 num_queries: int = 1000):
+    for kind, items in (('buildings', generate_buildings(region)),
+                        ('addresses', generate_addresses(region))):
+        start = time.perf_counter()
+        with Timer(f"Building the {kind} index of {region}"):
+            count = build_index(kind, region, items, properties, data_dir)
+        path = index_path(kind, region, data_dir)
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(path + extension) for extension in INDEX_EXTENSIONS)
+        logger.info("%s: %s items in %.2f s, %.1f MB", kind, count, elapsed, size / 1e6)
+        if count and num_queries:
+            latencies = measure_queries(path, num_queries) * 1000.0
+            logger.info("%s: nearest(50) latency p50 %.3f ms, p95 %.3f ms, p99 %.3f ms", kind,
+                        *np.percentile(latencies, [50, 95, 99]))
+    info = record_region(region, data_dir)
+    logger.info("Cataloged %s with bounds %s", region, info.bbox)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bulk-load a region's R-tree indexes into gis_data/")
+    parser.add_argument('region')
+    parser.add_argument('--leaf-capacity', type=int, default=100)
+    parser.add_argument('--index-capacity', type=int, default=100)
+    parser.add_argument('--fill-factor', type=float, default=0.9,
+                        help="fraction of each page filled by the bulk load")
+    parser.add_argument('--page-size', type=int, default=4096)
+    parser.add_argument('--buffering-capacity', type=int, default=10,
+                        help="pages buffered in memory while sorting")
+    parser.add_argument('--queries', type=int, default=1000,
+                        help="random queries used to report latency (0 to skip)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    build_region(args.region,
+                 index_properties(args.leaf_capacity, args.index_capacity, args.fill_factor,
+                                  args.page_size, args.buffering_capacity),
+                 num_queries=args.queries)
@@ -1,6 +1,18 @@
+"""
+Merge duplicate addresses in a region into one row at their mean coordinate.
+
+Addresses are duplicates when their number, predirective, street name and
+post type match exactly, or with --normalized, after normalizing case,
+punctuation and common directional and street type spellings. The whole
+pass is a few set-based statements in one transaction.
+
+    python -m commands.clean_addresses denver --normalized --dry-run
+"""
+import argparse
 import logging
-from typing import Dict, List
+import re
 import sys
+from typing import NamedTuple, Optional
 
 from api.db import db
 from api.models import Address
@@ -9,40 +21,110 @@ from commands.util import Timer
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
+KEY_COLUMNS = ('address_1', 'predirective', 'street_name', 'post_type')
+
+WORDS = {
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+    'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'BOULEVARD': 'BLVD', 'DRIVE': 'DR', 'ROAD': 'RD',
+    'COURT': 'CT', 'PLACE': 'PL', 'LANE': 'LN', 'PARKWAY': 'PKWY', 'CIRCLE': 'CIR', 'TERRACE': 'TER',
+    'HIGHWAY': 'HWY', 'SQUARE': 'SQ', 'TRAIL': 'TRL', 'POINT': 'PT', 'MOUNT': 'MT', 'SAINT': 'ST'
+}
+SEPARATORS = re.compile(r"[\s.,#'\-]+")
+
+
+class Changes(NamedTuple):
+    """
+    What a deduplication pass did. `groups` sets of duplicates were each
+    merged into their lowest idx, `deleted` rows were removed, and
+    `unchanged` addresses had no duplicate. With normalized matching,
+    `normalized` of the groups only matched after normalizing.
+    """
+    groups: int
+    deleted: int
+    unchanged: int
+    normalized: int
+
+
+def normalize_component(value: Optional[str]) -> str:
+    """
+    Upper case, punctuation and repeated whitespace removed, and common
+    spellings of directionals and street types abbreviated, so that
+    'North Main Street.' and 'N MAIN ST' compare equal.
+    """
+    if value is None:
+        return ''
+    words = SEPARATORS.split(str(value).upper())
+    return ' '.join(WORDS.get(w, w.lstrip('0') if w.isdigit() else w) for w in words if w)
+
+
+def key_sql(normalized: bool) -> str:
+    """
+    SQL expression grouping a row's address components into one key.
+    """
+    if normalized:
+        parts = [f"normalize_component({c})" for c in KEY_COLUMNS]
+    else:
+        parts = [f"COALESCE({c}, '')" for c in KEY_COLUMNS]
+    return " || char(31) || ".join(parts)
+
+
+def deduplicate(region: str, normalized: bool = False, dry_run: bool = False) -> Changes:
+    """
+    Merge the region's duplicate addresses in one transaction, which is
+    rolled back if `dry_run`.
+    """
+    table = Address._meta.table_name
+    db.register_function(normalize_component, 'normalize_component', 1)
+    statements = [
+        "DROP TABLE IF EXISTS temp.address_key",
+        "DROP TABLE IF EXISTS temp.address_group",
+        ("CREATE TEMP TABLE address_key (id INTEGER PRIMARY KEY, idx INTEGER, key TEXT, exact TEXT, "
+         "lon REAL, lat REAL)"),
+        (f"INSERT INTO address_key SELECT id, idx, {key_sql(normalized)}, {key_sql(False)}, lon, lat "
+         f"FROM {table} WHERE region = ?", [region]),
+        "CREATE INDEX temp.address_key_key ON address_key (key)",
+        # Typed, so that lookups by `keep` use the rowid
+        ("CREATE TEMP TABLE address_group (keep INTEGER PRIMARY KEY, idx INTEGER, key TEXT UNIQUE, "
+         "n INTEGER, variants INTEGER, lon REAL, lat REAL)"),
+        # With MIN(idx), SQLite takes the bare `id` from the row holding the minimum
+        ("INSERT INTO address_group SELECT id, MIN(idx), key, COUNT(*), COUNT(DISTINCT exact), AVG(lon), "
+         "AVG(lat) FROM address_key GROUP BY key HAVING COUNT(*) > 1"),
+        (f"UPDATE {table} SET lon = (SELECT g.lon FROM address_group g WHERE g.keep = {table}.id), "
+         f"lat = (SELECT g.lat FROM address_group g WHERE g.keep = {table}.id) "
+         f"WHERE id IN (SELECT keep FROM address_group)"),
+        (f"DELETE FROM {table} WHERE id IN (SELECT k.id FROM address_key k "
+         f"JOIN address_group g ON g.key = k.key WHERE k.id != g.keep)")
+    ]
+    with db.atomic() as transaction:
+        for statement in statements:
+            sql, params = statement if isinstance(statement, tuple) else (statement, [])
+            db.execute_sql(sql, params)
+        total = db.execute_sql("SELECT COUNT(*) FROM address_key").fetchone()[0]
+        groups, merged, normalized_groups = db.execute_sql(
+            "SELECT COUNT(*), COALESCE(SUM(n), 0), COALESCE(SUM(variants > 1), 0) FROM address_group"
+        ).fetchone()
+        if dry_run:
+            transaction.rollback()
+    db.execute_sql("DROP TABLE IF EXISTS temp.address_key")
+    db.execute_sql("DROP TABLE IF EXISTS temp.address_group")
+    return Changes(groups=groups, deleted=merged - groups, unchanged=total - merged, normalized=normalized_groups)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge duplicate addresses in a region")
+    parser.add_argument('region')
+    parser.add_argument('--normalized', action='store_true',
+                        help="match addresses after normalizing case, punctuation and abbreviations")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change and roll back")
+    return parser.parse_args()
 
-def address_dict(area) -> Dict[str, List[Address]]:
-    result: Dict[str, List[Address]] = dict()
-    for address in Address.all(area):
-        full_address = address.full_address_with_region
-        if full_address in result:
-            result[full_address].append(address)
-        else:
-            result[full_address] = [address]
-    return result
-
-def uniquify(address_result):
-    saved_count, deleted_count, skip_count = 0, 0, 0
-    for models in address_result.values():
-        if len(models) == 1:
-            skip_count += 1
-            continue
-        coords = [addr.coord[0] for addr in models]
-        longitude: float = sum([c[0] for c in coords]) / float(len(coords))
-        latitude: float = sum([c[1] for c in coords]) / float(len(coords))
-        unique_result = models[0]
-        unique_result.coord = [[longitude, latitude]]
-        other_results = models[1:]
-        saved_count += 1
-        deleted_count += len(other_results)
-        with db.atomic():
-            unique_result.save()
-            for a in other_results:
-                a.delete_instance()
-    logger.info("Addresses: Updated %s, deleted %s, skipped %s", saved_count, deleted_count, skip_count)
 
 if __name__ == "__main__":
-    region = sys.argv[1]
-    with Timer("Creating address dict"):
-        address_map = address_dict(region)
-    with Timer("Uniquifiyng"):
-        uniquify(address_map)
+    args = parse_args()
+    with Timer(f"Deduplicating addresses in {args.region}"):
+        changes = deduplicate(args.region, args.normalized, args.dry_run)
+    logger.info("Addresses%s: merged %s groups, deleted %s, unchanged %s",
+                " (dry run)" if args.dry_run else "", changes.groups, changes.deleted, changes.unchanged)
+    if args.normalized:
+        logger.info("%s of the groups only matched after normalizing", changes.normalized)
@@ -0,0 +1,242 @@
+"""
+Remove duplicate building footprints from a region.
+
+Footprints match when their canonical rings hash the same: coordinates are
+snapped to a grid of QUANTUM degrees, repeated vertices (the closing one
+included) are dropped, and the ring is turned counterclockwise and rotated
+to start at its lowest vertex. Copies that differ only by starting vertex,
+winding order or noise finer than the grid therefore match. Keys are
+computed with NumPy for a chunk of footprints at a time.
+
+An optional second pass merges near duplicates: each footprint is checked
+against an R-tree of those kept so far, and if it overlaps one of them by at
+least a given share of the smaller area, only the larger is kept.
+
+If the region's building index has been built, the duplicates are removed
+from it before their rows are deleted, and the geometry store is exported
+again, the same way `commands.update_region` applies deletes.
+
+    python -m commands.dedupe_buildings denver --overlap 0.9 --dry-run
+"""
+import argparse
+import hashlib
+from itertools import chain
+import logging
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import peewee as pw
+from rtree import index
+from shapely.geometry import Polygon
+
+from api.db import db
+from api.models import Building
+from api.registry import DATA_DIR, file_signature, index_path
+from commands.util import Timer
+
+# About a centimeter
+QUANTUM = 1e-7
+CHUNK_SIZE = 10_000
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+Row = Dict[str, Any]
+
+
+class DedupeStats:
+    """
+    Footprints seen, removed as copies and merged by overlap, and the
+    seconds spent deciding, across the passes a run makes.
+    """
+    def __init__(self):
+        self.seen = 0
+        self.copies = 0
+        self.overlapping = 0
+        self.seconds = 0.0
+
+    @property
+    def removed(self) -> int:
+        return self.copies + self.overlapping
+
+    @property
+    def throughput(self) -> float:
+        return self.seen / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (f"removed {self.copies} copies and {self.overlapping} overlapping footprints "
+                f"of {self.seen} ({self.throughput:,.0f} footprints/s)")
+
+
+def canonical_rings(rings: Sequence, quantum: float = QUANTUM) -> Tuple[np.array, np.array]:
+    """
+    The canonical form of each ring, as grid coordinates.
+
+    Returns:
+        an nx2 int64 array of every ring's vertices one after another, and
+        the number of vertices of each ring.
+    """
+    counts = np.fromiter((len(r) for r in rings), dtype=np.int64, count=len(rings))
+    if len(rings) and all(isinstance(r, np.ndarray) for r in rings):
+        flat = np.concatenate([r.reshape(-1) for r in rings]).astype(float)
+    else:
+        flat = np.fromiter(chain.from_iterable(chain.from_iterable(rings)), dtype=float, count=2 * counts.sum())
+    grid = np.rint(flat.reshape(-1, 2) / quantum).astype(np.int64)
+    ring_of = np.repeat(np.arange(len(rings)), counts)
+    starts = np.cumsum(counts) - counts
+    nonempty = counts > 0
+
+    # Drop vertices equal to the one before, wrapping around the ring
+    previous = np.arange(len(grid)) - 1
+    previous[starts[nonempty]] = starts[nonempty] + counts[nonempty] - 1
+    keep = np.any(grid != grid[previous], axis=1)
+    degenerate = nonempty & (np.bincount(ring_of[keep], minlength=len(rings)) == 0)
+    keep[starts[degenerate]] = True
+    grid, ring_of = grid[keep], ring_of[keep]
+    counts = np.bincount(ring_of, minlength=len(rings))
+    starts = np.cumsum(counts) - counts
+    position = np.arange(len(grid)) - starts[ring_of]
+
+    # Twice the signed area, relative to each ring's first vertex to keep the products small
+    offsets = (grid - grid[starts[ring_of]]).astype(float)
+    following = np.where(position + 1 == counts[ring_of], starts[ring_of], np.arange(len(grid)) + 1)
+    cross = offsets[:, 0] * offsets[following, 1] - offsets[following, 0] * offsets[:, 1]
+    direction = np.where(np.bincount(ring_of, weights=cross, minlength=len(rings)) < 0, -1, 1)
+
+    # Lowest vertex by (x, y) of each ring
+    lowest = np.lexsort((grid[:, 1], grid[:, 0], ring_of))[starts[counts > 0]]
+    rotation = np.zeros(len(rings), dtype=np.int64)
+    rotation[counts > 0] = lowest - starts[counts > 0]
+    source = starts[ring_of] + (rotation[ring_of] + direction[ring_of] * position) % counts[ring_of]
+    return grid[source], counts
+
+
+def footprint_keys(rings: Sequence, quantum: float = QUANTUM) -> List[bytes]:
+    """
+    A 16 byte digest of each ring's canonical form.
+    """
+    grid, counts = canonical_rings(rings, quantum)
+    data = memoryview(grid.tobytes())
+    ends = np.cumsum(counts) * grid.itemsize * 2
+    return [hashlib.blake2b(data[start:end], digest_size=16).digest()
+            for start, end in zip(chain((0,), ends[:-1].tolist()), ends.tolist())]
+
+
+def unique_footprints(rows: Iterable[Row], quantum: float = QUANTUM, chunk_size: int = CHUNK_SIZE,
+                      stats: Optional[DedupeStats] = None) -> Iterator[Row]:
+    """
+    Drops rows whose footprint has already been seen. Only a digest of each
+    footprint is kept, so memory grows by a few bytes per building.
+    """
+    stats = stats or DedupeStats()
+    seen = set()
+    for chunk in pw.chunked(rows, chunk_size):
+        start = time.perf_counter()
+        unique = []
+        for row, key in zip(chunk, footprint_keys([row['polygon_points'] for row in chunk], quantum)):
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        stats.seen += len(chunk)
+        stats.copies += len(chunk) - len(unique)
+        stats.seconds += time.perf_counter() - start
+        yield from unique
+
+
+def footprint_polygon(points) -> Polygon:
+    polygon = Polygon(points)
+    return polygon if polygon.is_valid else polygon.buffer(0)
+
+
+def merge_overlapping(rows: Iterable[Row], ratio: float, stats: Optional[DedupeStats] = None) -> List[Row]:
+    """
+    Merges footprints that overlap an earlier one by at least `ratio` of
+    the smaller area, keeping the larger. Kept rows stay in their order.
+    Run after `unique_footprints`, which counts the footprints seen.
+    """
+    stats = stats or DedupeStats()
+    rows = list(rows)
+    start = time.perf_counter()
+    polygons = [footprint_polygon(row['polygon_points']) for row in rows]
+    candidates = [i for i, polygon in enumerate(polygons) if polygon.area > 0]
+    if not candidates:
+        return rows
+    rtree = index.Index((i, polygons[i].bounds, None) for i in candidates)
+    removed = set()
+    for i in candidates:
+        polygon = polygons[i]
+        for j in rtree.intersection(polygon.bounds):
+            if j >= i or j in removed:
+                continue
+            other = polygons[j]
+            if polygon.intersection(other).area >= ratio * min(polygon.area, other.area):
+                stats.overlapping += 1
+                if polygon.area > other.area:
+                    removed.add(j)
+                else:
+                    removed.add(i)
+                    break
+    stats.seconds += time.perf_counter() - start
+    return [row for i, row in enumerate(rows) if i not in removed]
+
+
+def is_indexed(region: str, data_dir: str = DATA_DIR) -> bool:
+    try:
+        file_signature(index_path('buildings', region, data_dir))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def dedupe_region(region: str, quantum: float = QUANTUM, overlap: Optional[float] = None,
+                  dry_run: bool = False, data_dir: str = DATA_DIR) -> DedupeStats:
+    """
+    Delete the region's duplicate footprints, keeping the lowest idx of each
+    set of copies. If the region has a building index, the duplicates are
+    taken out of a new version of it first, and its store is exported again
+    afterwards, so running workers never look up a deleted row.
+    """
+    # update_region imports this module for its footprint keys
+    from commands.update_region import (  # pylint: disable=import-outside-toplevel
+        building_box, delete_rows, edit_index, refresh_store)
+    stats = DedupeStats()
+    rows = list(Building.select(Building.id, Building.idx, Building.polygon_points)
+                .where(Building.region == region)
+                .order_by(Building.idx)
+                .dicts())
+    kept = unique_footprints(rows, quantum, stats=stats)
+    if overlap:
+        kept = merge_overlapping(kept, overlap, stats)
+    kept_ids = {row['id'] for row in kept}
+    removed = [row for row in rows if row['id'] not in kept_ids]
+    if dry_run or not removed:
+        return stats
+    indexed = is_indexed(region, data_dir)
+    if indexed:
+        edit_index('buildings', region, [(row['idx'], building_box(row['polygon_points'])) for row in removed],
+                   [], data_dir)
+    with db.atomic():
+        delete_rows(Building, [row['id'] for row in removed])
+    if indexed:
+        refresh_store(region, data_dir)
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Remove duplicate building footprints from a region")
+    parser.add_argument('region')
+    parser.add_argument('--quantum', type=float, default=QUANTUM,
+                        help="grid size in degrees that coordinates are snapped to (default: 1e-7)")
+    parser.add_argument('--overlap', type=float,
+                        help="also merge footprints overlapping by at least this share of the smaller one")
+    parser.add_argument('--dry-run', action='store_true', help="report what would be removed")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with Timer(f"Deduplicating buildings in {args.region}"):
+        result = dedupe_region(args.region, args.quantum, args.overlap, args.dry_run)
+    logger.info("Buildings%s: %s", " (dry run)" if args.dry_run else "", result.summary())
@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from api.catalog import record_region
+from api.geometry import (LocalTangentPlane, convex_hull, minimum_bounding_rectangles,
+                          sorted_rects_by_polar_angle)
+from api.models import Address, Building
+from api.registry import DATA_DIR
+from api.store import MANIFEST, STORE_VERSION, store_path
+from commands.util import Timer
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+
+class StringTable:
+    """
+    Interns strings into one UTF-8 blob addressed by offsets.
+    """
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.offsets: List[int] = [0]
+        self.chunks: List[bytes] = []
+
+    def intern(self, value: str) -> int:
+        string_id = self.ids.get(value)
+        if string_id is None:
+            data = value.encode('utf-8')
+            string_id = len(self.chunks)
+            self.ids[value] = string_id
+            self.chunks.append(data)
+            self.offsets.append(self.offsets[-1] + len(data))
+        return string_id
+
+    def columns(self) -> Dict[str, np.array]:
+        return {
+            'string_offsets': np.array(self.offsets, dtype=np.int64),
+            'string_data': np.frombuffer(b''.join(self.chunks), dtype=np.uint8)
+        }
+
+
+def building_columns(region: str) -> Dict[str, np.array]:
+    idx, offsets, coords, mbr, center, height, elevation = [], [0], [], [], [], [], []
+    query = Building.select().where(Building.region == region).order_by(Building.idx)
+    for building in query.iterator():
+        idx.append(building.idx)
+        coords.append(np.asarray(building.polygon_points, dtype=float).reshape(-1, 2))
+        offsets.append(offsets[-1] + len(coords[-1]))
+        mbr.append(building.min_bounding_rect)
+        center.append(building.center)
+        height.append(np.nan if building.height is None else building.height)
+        elevation.append(np.nan if building.ground_elevation is None else building.ground_elevation)
+    return {
+        'building_idx': np.array(idx, dtype=np.int64),
+        'building_offsets': np.array(offsets, dtype=np.int64),
+        'building_coords': np.concatenate(coords) if coords else np.zeros((0, 2)),
+        'building_mbr': np.array(mbr, dtype=float).reshape(-1, 4, 2),
+        'building_center': np.array(center, dtype=float).reshape(-1, 2),
+        'building_height': np.array(height, dtype=float),
+        'building_ground_elevation': np.array(elevation, dtype=float)
+    }
+
+
+def address_columns(region: str, strings: StringTable) -> Dict[str, np.array]:
+    idx, center, text, text_with_region = [], [], [], []
+    query = Address.select().where(Address.region == region).order_by(Address.idx)
+    for address in query.iterator():
+        idx.append(address.idx)
+        center.append(address.center)
+        text.append(strings.intern(address.full_address_without_region))
+        text_with_region.append(strings.intern(address.full_address_with_region))
+    return {
+        'address_idx': np.array(idx, dtype=np.int64),
+        'address_center': np.array(center, dtype=float).reshape(-1, 2),
+        'address_text': np.array(text, dtype=np.int64),
+        'address_text_with_region': np.array(text_with_region, dtype=np.int64)
+    }
+
+
+def region_plane(columns: Dict[str, np.array]) -> LocalTangentPlane:
+    """
+    Tangent plane at the middle of the region's buildings.
+    """
+    centers = columns['building_center']
+    if len(centers) == 0:
+        return LocalTangentPlane((0.0, 0.0))
+    return LocalTangentPlane((centers.min(axis=0) + centers.max(axis=0)) / 2.0)
+
+
+def projected_columns(columns: Dict[str, np.array], plane: LocalTangentPlane) -> Dict[str, np.array]:
+    """
+    Bounding rectangles fitted to each footprint in meters on `plane`, where
+    the rectangle is square in reality rather than in degrees.
+    """
+    coords = plane.project(columns['building_coords'])
+    offsets = columns['building_offsets']
+    hulls = [convex_hull(coords[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+    if not hulls:
+        return {'building_mbr_m': np.zeros((0, 4, 2))}
+    rects = minimum_bounding_rectangles(hulls)
+    centers = plane.project(columns['building_center'])
+    return {'building_mbr_m': sorted_rects_by_polar_angle(rects, centers)}
+
+
+def write_store(path: str, region: str, columns: Dict[str, np.array],
+                plane: Optional[LocalTangentPlane] = None):
+    """
+    Write `columns` to a temporary directory and swap it into `path`, so
+    readers never see a partially written store.
+    """
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(column))
+    manifest = {
+        'version': STORE_VERSION,
+        'region': region,
+        'buildings': len(columns['building_idx']),
+        'addresses': len(columns['address_idx'])
+    }
+    if plane is not None:
+        manifest['projection'] = {'type': 'local_tangent_plane', 'origin': list(plane.origin)}
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    old_path = path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def export_region(region: str, data_dir: str = DATA_DIR, projected: bool = False):
+    strings = StringTable()
+    with Timer("Exporting buildings"):
+        columns = building_columns(region)
+    with Timer("Exporting addresses"):
+        columns.update(address_columns(region, strings))
+    columns.update(strings.columns())
+    plane = None
+    if projected:
+        plane = region_plane(columns)
+        with Timer(f"Projecting buildings onto the plane at {plane.origin}"):
+            columns.update(projected_columns(columns, plane))
+    path = store_path(region, data_dir)
+    with Timer(f"Writing {path}"):
+        write_store(path, region, columns, plane)
+    size = sum(column.nbytes for column in columns.values())
+    logger.info("Exported %s buildings, %s addresses and %s strings (%.1f MB)",
+                len(columns['building_idx']), len(columns['address_idx']),
+                len(strings.chunks), size / 1e6)
+    try:
+        record_region(region, data_dir)
+    except FileNotFoundError:
+        logger.info("%s has no indexes yet, it will be cataloged when they are built", region)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a region's geometry to a columnar store in gis_data/")
+    parser.add_argument('region')
+    parser.add_argument('--projected', action='store_true',
+                        help="also store buildings in meters on a local tangent plane, "
+                             "so intersections run in meters")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    export_region(args.region, projected=args.projected)
@@ -1,12 +1,27 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 class Factory: # pylint: disable=too-few-public-methods    
 
-    def __init__(self, region: str):
+    def __init__(self, region: str, layout: Optional[str] = None):
+        """
+        Builds rows for `region` from features with the attributes of the
+        shapefile layout `layout`, by default the one named after the region,
+        so metros that publish data like Denver's can load as 'denver'.
+
+        Raises:
+            ValueError if there is no such layout.
+        """
         self.region = region
+        self.layout = layout or region
+        if not hasattr(self, f'create_{self.layout}'):
+            raise ValueError(f"No shapefile layout '{self.layout}', known layouts: {', '.join(self.layouts())}")
+
+    @classmethod
+    def layouts(cls) -> List[str]:
+        return sorted(name[len('create_'):] for name in dir(cls) if name.startswith('create_'))
 
     def create(self, data: dict, idx: int) -> Dict[str, Any]:
-        return getattr(self, f'create_{self.region}')(data, idx)
+        return getattr(self, f'create_{self.layout}')(data, idx)
 
 
 class BuildingShapeFactory(Factory):
@@ -16,6 +31,7 @@ class BuildingShapeFactory(Factory):
         building_type = properties['BLDG_TYPE']
         if building_type == 'Garage/Shed':
             return None
+        polygon = data['geometry']['coordinates'][0]
         return {
             'idx': idx,
             'region': self.region,
@@ -23,7 +39,8 @@ class BuildingShapeFactory(Factory):
             'height': properties['BLDG_HEIGH'],
             'ground_elevation': properties['GROUND_ELE'],
             'building_type': building_type,
-            'polygon_points': data['geometry']['coordinates'][0]
+            'polygon_points': polygon,
+            'vertex_count': len(polygon)
         }
 
 
@@ -34,7 +51,6 @@ class AddressedLocationFactory(Factory):
         building_type = properties['BUILDING_T']
         if building_type == 'Garage/Shed':
             return None
-        coord = [(properties['LONGITUDE'], properties['LATITUDE'])]
         return {
             'idx': idx,
             'region': self.region,
@@ -46,5 +62,6 @@ class AddressedLocationFactory(Factory):
             'street_name': properties['STREET_NAM'],
             'post_type': properties['POSTTYPE'],
             'full_address': properties['FULL_ADDRE'],
-            'coord': coord
+            'lon': properties['LONGITUDE'],
+            'lat': properties['LATITUDE']
         }
\ No newline at end of file
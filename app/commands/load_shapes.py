@@ -1,68 +1,191 @@
-import json
+import argparse
+from collections import deque
+from itertools import chain, islice
 import logging
-from typing import Tuple, List
+import multiprocessing
+import multiprocessing.pool
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 import os
 import sys
 
 import fiona
+import peewee as pw
 
 from api.db import db
 from api.models import Building, Address
+from commands.dedupe_buildings import DedupeStats, merge_overlapping, unique_footprints
 from commands.factory import Factory, BuildingShapeFactory, AddressedLocationFactory
-from commands.util import Timer
+from commands.migrate_schema import ensure_schema
+from commands.util import Progress, Timer
+
+# Rows per transaction, and the SQLite bound-parameter limit per INSERT
+CHUNK_SIZE = 10_000
+SQLITE_MAX_VARIABLES = 999
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
+Row = Dict[str, Any]
+
 
-def load_shapefile(filename: str, factory: Factory):
+def read_features(filename: str) -> Iterator[Tuple[int, dict]]:
+    """
+    Yields (idx, feature) for every feature in the shapefile, one at a time.
+    """
+    if not os.path.isfile(filename):
+        logger.error("Could not open %s", filename)
+        return
+    with fiona.open(filename, 'r') as source:
+        yield from enumerate(source)
+
+def parse_features(features: Iterable[Tuple[int, dict]], factory: Factory) -> Iterator[Row]:
+    for idx, item in features:
+        row = factory.create(item, idx=idx)
+        if row:
+            yield row
+
+def load_shapefile(filename: str, factory: Factory) -> Iterator[Row]:
+    return parse_features(read_features(filename), factory)
+
+def chunked(rows: Iterable[Row], size: int) -> Iterator[List[Row]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def write_rows(model: pw.Model, rows: Iterable[Row], chunk_size: int = CHUNK_SIZE,
+               progress: Optional[Progress] = None) -> int:
+    """
+    Inserts `rows` with one transaction per `chunk_size` rows and as many
+    rows per INSERT statement as SQLite allows.
+
+    Returns:
+        the number of rows written.
+    """
+    fields = model._meta.fields
+    rows_per_statement = max(1, SQLITE_MAX_VARIABLES // len(fields))
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        chunk = [{k: v for k, v in row.items() if k in fields} for row in chunk]
+        with db.atomic():
+            for batch in pw.chunked(chunk, rows_per_statement):
+                model.insert_many(batch).execute()
+        count += len(chunk)
+        if progress:
+            progress.update(len(chunk))
+    return count
+
+def feature_ranges(filename: str, size: int) -> List[Tuple[int, int]]:
     if not os.path.isfile(filename):
         logger.error("Could not open %s", filename)
         return []
-    with Timer(f"Reading {filename}"):
-        with fiona.open(filename, 'r') as source:
-            item_list = list(source)
-    with Timer("Parsing items"):
-        items = [factory.create(item, idx=idx) for idx, item in enumerate(item_list)]
-        items = [item for item in items if item]
-    return items
-
-def generate_buildings_and_addresses(area: str) -> Tuple[List[Building], List[Address]]:
-    building_factory = BuildingShapeFactory(region)
-    address_factory = AddressedLocationFactory(region)
-    buildings = load_shapefile(os.path.join(data_dir, f'{area}.shp'), building_factory)
-    addresses = load_shapefile(os.path.join(data_dir, f'{area}_addresses.shp'), address_factory)
-    buildings = get_unique_buildings([Building(**building) for building in buildings])
-    addresses = [Address(**address) for address in addresses]
-    return buildings, addresses
-
-def get_unique_buildings(buildings: List[Building]) -> List[Building]:
-    coord_set = set()
-    result = []
-    for building in buildings:
-        key = json.dumps(building.polygon_points)
-        if key not in coord_set:
-            result.append(building)
-            coord_set.add(key)
-    return result
-
-def create_buildings_and_addresses(buildings: List[Building], addresses: List[Address]):
+    with fiona.open(filename, 'r') as source:
+        count = len(source)
+    return [(start, min(start + size, count)) for start in range(0, count, size)]
+
+def parse_range(task: Tuple[str, Factory, int, int]) -> List[Row]:
+    """
+    Parses features [start, stop) of a shapefile. Runs in a worker process.
+    """
+    filename, factory, start, stop = task
+    with fiona.open(filename, 'r') as source:
+        features = zip(range(start, stop), (f for _, f in source.items(start, stop)))
+        return list(parse_features(features, factory))
+
+def ordered_results(pool: multiprocessing.pool.Pool, fn, tasks: Iterable,
+                    max_pending: int) -> Iterator:
+    """
+    Like `pool.imap`, but with at most `max_pending` results in flight, so
+    workers can't run ahead of a slow consumer.
+    """
+    pending: Deque[multiprocessing.pool.AsyncResult] = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(fn, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def write_buildings_and_addresses(address_rows: Iterable[Row], building_rows: Iterable[Row],
+                                  chunk_size: int = CHUNK_SIZE, overlap: Optional[float] = None):
+    """
+    Writes both kinds of rows, dropping duplicate building footprints and,
+    if `overlap` is given, merging footprints that overlap by that share.
+    Merging holds the region's buildings in memory.
+    """
     with Timer("Creating addresses"):
-        with db.atomic():
-            Address.bulk_create(addresses, batch_size=100)
-    logger.info("Created %s addresses", len(address_models))
+        progress = Progress("Addresses written")
+        count = write_rows(Address, address_rows, chunk_size, progress)
+        progress.log()
+    logger.info("Created %s addresses", count)
     with Timer("Creating buildings"):
-        with db.atomic():
-            Building.bulk_create(buildings, batch_size=100)
-    logger.info("Created %s buildings", len(building_models))
+        stats = DedupeStats()
+        buildings = unique_footprints(building_rows, stats=stats)
+        if overlap:
+            buildings = merge_overlapping(buildings, overlap, stats)
+        progress = Progress("Buildings written")
+        count = write_rows(Building, buildings, chunk_size, progress)
+        progress.log()
+    logger.info("Created %s buildings, %s", count, stats.summary())
+
+def create_buildings_and_addresses(area: str, data_dir: str, chunk_size: int = CHUNK_SIZE,
+                                   overlap: Optional[float] = None, layout: Optional[str] = None):
+    address_rows = load_shapefile(os.path.join(data_dir, f'{area}_addresses.shp'),
+                                  AddressedLocationFactory(area, layout))
+    building_rows = load_shapefile(os.path.join(data_dir, f'{area}.shp'),
+                                   BuildingShapeFactory(area, layout))
+    write_buildings_and_addresses(address_rows, building_rows, chunk_size, overlap)
+
+def create_buildings_and_addresses_parallel(area: str, data_dir: str, workers: int,
+                                            chunk_size: int = CHUNK_SIZE, overlap: Optional[float] = None,
+                                            layout: Optional[str] = None):
+    """
+    Parses both shapefiles in `workers` processes, one feature range per
+    task, while this process stays the only SQLite writer. Results are
+    consumed in feature order, so ids and dedupe decisions match a
+    sequential run and reruns produce identical databases.
+    """
+    address_file = os.path.join(data_dir, f'{area}_addresses.shp')
+    building_file = os.path.join(data_dir, f'{area}.shp')
+    address_tasks = [(address_file, AddressedLocationFactory(area, layout), start, stop)
+                     for start, stop in feature_ranges(address_file, chunk_size)]
+    building_tasks = [(building_file, BuildingShapeFactory(area, layout), start, stop)
+                      for start, stop in feature_ranges(building_file, chunk_size)]
+    with multiprocessing.Pool(workers) as pool:
+        results = ordered_results(pool, parse_range, address_tasks + building_tasks,
+                                  max_pending=workers * 2)
+        address_rows = chain.from_iterable(islice(results, len(address_tasks)))
+        building_rows = chain.from_iterable(results)
+        write_buildings_and_addresses(address_rows, building_rows, chunk_size, overlap)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load a region's shapefiles into the database")
+    parser.add_argument('region')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes used to parse features (default: 1, no pool)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="features per task and rows per transaction")
+    parser.add_argument('--layout', help="shapefile layout to read, e.g. denver (default: the region)")
+    parser.add_argument('--overlap', type=float,
+                        help="merge building footprints overlapping by at least this share of the smaller one")
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    args = parse_args()
+    # Fail on an unknown layout before anything is deleted
+    BuildingShapeFactory(args.region, args.layout)
     db.connect()
-    models = [Address, Building]
-    db.drop_tables(models)
-    db.create_tables(models)
-    n_grid = 200
+    ensure_schema()
+    # Other regions in the database are left alone
+    Building.delete().where(Building.region == args.region).execute()
+    Address.delete().where(Address.region == args.region).execute()
     data_dir = os.path.join(os.getcwd(), 'gis_data')
-    region = sys.argv[1]
-    building_models, address_models = generate_buildings_and_addresses(region)
-    create_buildings_and_addresses(building_models, address_models)
+    if args.workers > 1:
+        create_buildings_and_addresses_parallel(args.region, data_dir, args.workers, args.chunk_size,
+                                                args.overlap, args.layout)
+    else:
+        create_buildings_and_addresses(args.region, data_dir, args.chunk_size, args.overlap, args.layout)
@@ -0,0 +1,151 @@
+"""
+Upgrade a database.db to the current schema in place.
+
+Version 1 stored address points and building polygons as JSON text and used
+each region's feature number as the primary key, so only one region fit in
+a database. Version 2 stores points as lon/lat REAL columns and polygons as
+packed float64 BLOBs with a vertex count, keys rows by rowid with a unique
+(region, idx) index, and clusters each region's rows together. Version 3
+adds each building's stable id from the source data.
+
+    python -m commands.migrate_schema
+"""
+import argparse
+import json
+import logging
+import sys
+from typing import Dict, List, Optional
+
+from peewee import Database, SqliteDatabase
+from playhouse.migrate import SqliteMigrator, migrate
+
+from api.db import WRITER_PRAGMAS, db, path
+from api.models import SCHEMA_VERSION, Address, Building, PointArrayField
+from commands.util import Timer
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+LEGACY_SUFFIX = '_v1'
+
+
+def schema_version(database: Database = db) -> int:
+    """
+    0 for a database without tables, otherwise the version it was written with.
+    """
+    if not database.table_exists(Address._meta.table_name):
+        return 0
+    return max(database.execute_sql("PRAGMA user_version").fetchone()[0], 1)
+
+
+def ensure_schema(database: Database = db):
+    """
+    Create the tables on a new database.
+
+    Raises:
+        RuntimeError if the database has an older schema and must be migrated first.
+    """
+    version = schema_version(database)
+    if 0 < version < SCHEMA_VERSION:
+        raise RuntimeError(f"{database.database} has schema version {version}, "
+                           f"run commands.migrate_schema first")
+    with database.bind_ctx([Address, Building]):
+        database.create_tables([Address, Building])
+    database.execute_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def pack_points(text: Optional[str]) -> Optional[bytes]:
+    return None if text is None else PointArrayField().db_value(json.loads(text))
+
+
+def copy_legacy_tables(database: Database) -> Dict[str, int]:
+    """
+    Copy every row of a version 1 database into tables with the current
+    schema, ordered by region and idx.
+
+    Returns:
+        the number of rows copied per table.
+    """
+    database.register_function(pack_points, 'pack_points', 1)
+    address, building = Address._meta.table_name, Building._meta.table_name
+    legacy_building = {c.name for c in database.get_columns(building)}
+    hull = "pack_points(hull_points)" if 'hull_points' in legacy_building else "NULL"
+    mbr = "pack_points(mbr_points)" if 'mbr_points' in legacy_building else "NULL"
+    for table in (address, building):
+        database.execute_sql(f'ALTER TABLE "{table}" RENAME TO "{table}{LEGACY_SUFFIX}"')
+    with database.bind_ctx([Address, Building]):
+        database.create_tables([Address, Building])
+    database.execute_sql(
+        f'INSERT INTO "{address}" (idx, region, building_type, address_1, address_2, predirective, '
+        f'postdirective, street_name, post_type, unit_type, unit_identifier, full_address, lon, lat) '
+        f'SELECT idx, region, building_type, address_1, address_2, predirective, postdirective, '
+        f'street_name, post_type, unit_type, unit_identifier, full_address, '
+        f"json_extract(coord, '$[0][0]'), json_extract(coord, '$[0][1]') "
+        f'FROM "{address}{LEGACY_SUFFIX}" ORDER BY region, idx')
+    database.execute_sql(
+        f'INSERT INTO "{building}" (idx, region, height, ground_elevation, building_type, polygon_points, '
+        f'vertex_count, dob_id, hull_points, mbr_points) '
+        f'SELECT idx, region, height, ground_elevation, building_type, pack_points(polygon_points), '
+        f'json_array_length(polygon_points), dob_id, {hull}, {mbr} '
+        f'FROM "{building}{LEGACY_SUFFIX}" ORDER BY region, idx')
+    counts = {table: database.execute_sql(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+              for table in (address, building)}
+    for table in (address, building):
+        database.execute_sql(f'DROP TABLE "{table}{LEGACY_SUFFIX}"')
+    return counts
+
+
+def add_building_ids(database: Database):
+    """
+    Add the column for stable building ids. Existing rows have none until
+    `commands.update_region` matches them to the source data.
+    """
+    migrator = SqliteMigrator(database)
+    migrate(migrator.add_column(Building._meta.table_name, Building.building_id.column_name,
+                                Building.building_id))
+
+
+def migrate_database(database: Database = db, vacuum: bool = True) -> List[str]:
+    """
+    Bring the database up to `SCHEMA_VERSION` in one transaction. If rows
+    were copied, VACUUM afterwards to drop the space the old tables used.
+
+    Returns:
+        a description of each step applied, empty if there was nothing to do.
+    """
+    version = schema_version(database)
+    if version == 0 or version >= SCHEMA_VERSION:
+        return []
+    steps = []
+    with database.atomic():
+        if version < 2:
+            counts = copy_legacy_tables(database)
+            steps.append("copied " + ", ".join(f"{count} {table} rows" for table, count in counts.items())
+                         + " into typed tables")
+        else:
+            add_building_ids(database)
+            steps.append("added building ids")
+        database.execute_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if vacuum and version < 2:
+        with Timer("Vacuuming"):
+            database.execute_sql("VACUUM")
+    return steps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upgrade database.db to the current schema")
+    parser.add_argument('--path', default=path, help="database to migrate (default: gis_data/database.db)")
+    parser.add_argument('--no-vacuum', action='store_true', help="skip the VACUUM after migrating")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    target = db if args.path == path else SqliteDatabase(args.path, pragmas=WRITER_PRAGMAS)
+    before = schema_version(target)
+    with Timer(f"Migrating {args.path} from schema version {before}"):
+        applied = migrate_database(target, vacuum=not args.no_vacuum)
+    if applied:
+        logger.info("Migrated to schema version %s: %s", SCHEMA_VERSION, "; ".join(applied))
+    else:
+        logger.info("Nothing to migrate, %s has schema version %s", args.path, before)
@@ -0,0 +1,64 @@
+import logging
+import sys
+from typing import List
+
+import numpy as np
+from playhouse.migrate import SqliteMigrator, migrate
+
+from api.db import db
+from api.geometry import convex_hull, minimum_bounding_rectangles, sorted_rects_by_polar_angle
+from api.models import Building
+from commands.util import Timer
+
+CHUNK_SIZE = 2000
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+
+def ensure_columns():
+    """
+    Add the precomputed geometry columns to databases created before they existed.
+    """
+    existing = {c.name for c in db.get_columns(Building._meta.table_name)}
+    migrator = SqliteMigrator(db)
+    operations = [migrator.add_column(Building._meta.table_name, field.column_name, field)
+                  for field in (Building.hull_points, Building.mbr_points)
+                  if field.column_name not in existing]
+    if operations:
+        migrate(*operations)
+
+
+def precompute_chunk(buildings: List[Building]):
+    hulls = [convex_hull(b.polygon_points) for b in buildings]
+    centers = np.array([b.center for b in buildings])
+    rects = sorted_rects_by_polar_angle(minimum_bounding_rectangles(hulls), centers)
+    for building, hull, rect in zip(buildings, hulls, rects):
+        building.hull_points = hull.tolist()
+        building.mbr_points = rect.tolist()
+
+
+def precompute_region(region: str, chunk_size: int = CHUNK_SIZE) -> int:
+    count, last_idx = 0, -1
+    while True:
+        chunk = list(Building.select()
+                     .where((Building.region == region) & (Building.idx > last_idx))
+                     .order_by(Building.idx)
+                     .limit(chunk_size))
+        if not chunk:
+            return count
+        precompute_chunk(chunk)
+        with db.atomic():
+            Building.bulk_update(chunk, fields=[Building.hull_points, Building.mbr_points],
+                                 batch_size=500)
+        count += len(chunk)
+        last_idx = chunk[-1].idx
+        logger.info("Precomputed %s buildings", count)
+
+
+if __name__ == "__main__":
+    region = sys.argv[1]
+    ensure_columns()
+    with Timer(f"Precomputing hulls and bounding rectangles for {region}"):
+        total = precompute_region(region)
+    logger.info("Stored hulls and bounding rectangles for %s buildings", total)
@@ -1,29 +1,8 @@
-import logging
 import sys
 
-from rtree import index
-
-from api.models import Address, Building
-from commands.util import Timer
-
-EPSILON = 0.000001
-
-logger = logging.Logger(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-
-def generate_buildings(region):
-    for b in Building.all(region):
-        minx, miny, maxx, maxy = b.bbox
-        yield (b.idx, (minx, miny, maxx, maxy), b)
-
-def generate_addresses(region):
-    for a in Address.all(region):
-        minx, miny = a.center
-        yield(a.idx, (minx, miny, minx + EPSILON, miny + EPSILON), a)
+from commands.build_index import build_region, index_properties
 
+# Kept so existing scripts keep working; see commands.build_index for tuning options
 if __name__ == "__main__":
-    region = sys.argv[1]
-    with Timer("Generating index from buildings"):
-        b_rtree = index.Index(f"buildings_{region}_rtree", generate_buildings(region))
-    with Timer("Generating index from addresses"):
-        a_rtree = index.Index(f"addresses_{region}_rtree", generate_addresses(region))
+    build_region(sys.argv[1], index_properties(leaf_capacity=100, index_capacity=100, fill_factor=0.9,
+                                               page_size=4096, buffering_capacity=10))
@@ -0,0 +1,345 @@
+"""
+Apply a new version of a region's shapefiles to the database, its R-tree
+indexes and its geometry store without rebuilding any of them.
+
+Buildings are matched on their stable source id (BUILDING_I), or on their
+footprint for rows stored before ids were kept, which backfills the id.
+Addresses are matched on the components `commands.clean_addresses` groups
+by, and duplicates in the new file are merged the same way.
+
+Inserts and updates go into SQLite first, in one transaction. Each index
+is then copied to a new version, edited and published; running API workers
+notice the new version within the registry's check interval and reopen it,
+so nothing restarts. Deleted rows are only removed from SQLite after that,
+so an index a worker still has open never names a row that is gone. Last,
+the geometry store is exported again if the region has one.
+
+    python -m commands.update_region denver --dry-run
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import peewee as pw
+from rtree import index
+
+from api.catalog import record_region
+from api.db import db
+from api.models import Address, Building
+from api.registry import DATA_DIR, INDEX_EXTENSIONS, file_signature, index_path, new_index_path, publish_index
+from api.store import MANIFEST, store_path
+from commands.build_index import EPSILON
+from commands.clean_addresses import KEY_COLUMNS
+from commands.dedupe_buildings import footprint_keys, unique_footprints
+from commands.export_store import export_region
+from commands.factory import AddressedLocationFactory, BuildingShapeFactory
+from commands.load_shapes import Row, load_shapefile
+from commands.precompute_geometry import precompute_chunk
+from commands.util import Timer
+
+BUILDING_FIELDS = ('height', 'ground_elevation', 'building_type', 'polygon_points', 'vertex_count')
+ADDRESS_FIELDS = ('building_type', 'address_1', 'address_2', 'predirective', 'postdirective', 'street_name',
+                  'post_type', 'unit_type', 'unit_identifier', 'full_address')
+# Addresses closer than this to their stored point, in degrees, are unchanged
+COORDINATE_TOLERANCE = 1e-9
+BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+Box = Tuple[float, float, float, float]
+
+
+class Diff(NamedTuple):
+    """
+    Changes between the stored rows of a region and a new version of its
+    data. `updates` pair each new row with the stored row it replaces, and
+    `backfill` holds stored rows that only gain their building id.
+    """
+    inserts: List[Row]
+    updates: List[Tuple[Row, Row]]
+    deletes: List[Row]
+    backfill: List[Tuple[Row, Row]]
+    unchanged: int
+
+    @property
+    def empty(self) -> bool:
+        return not (self.inserts or self.updates or self.deletes or self.backfill)
+
+    def summary(self) -> str:
+        return (f"{len(self.inserts)} inserted, {len(self.updates)} updated, {len(self.deletes)} deleted, "
+                f"{self.unchanged + len(self.backfill)} unchanged")
+
+
+def db_values(model, row: Row, fields: Iterable[str]) -> tuple:
+    """
+    `fields` of `row` as they would be written to the database, so values
+    parsed from a shapefile compare equal to the stored ones.
+    """
+    return tuple(model._meta.fields[f].db_value(row.get(f)) for f in fields)
+
+
+def stored_values(model, row: Row, fields: Iterable[str]) -> Row:
+    """
+    `fields` of `row` as they would read back from the database, so entries
+    built from them match those of a full rebuild.
+    """
+    return {f: model._meta.fields[f].python_value(model._meta.fields[f].db_value(row.get(f))) for f in fields}
+
+
+def building_id(row: Row) -> Optional[str]:
+    value = row.get('building_id')
+    return None if value is None or value == '' else Building.building_id.db_value(value)
+
+
+def stored_rows(model, region: str) -> List[Row]:
+    return list(model.select().where(model.region == region).order_by(model.idx).dicts())
+
+
+def diff_buildings(stored: List[Row], rows: Iterable[Row]) -> Diff:
+    by_id = {s['building_id']: s for s in stored if s['building_id'] is not None}
+    legacy = [s for s in stored if s['building_id'] is None]
+    by_footprint = dict(zip(footprint_keys([s['polygon_points'] for s in legacy]), legacy))
+    inserts, updates, backfill, matched, unchanged = [], [], [], set(), 0
+    for row in rows:
+        row = {**row, 'vertex_count': len(row['polygon_points'])}
+        key = building_id(row)
+        match = by_id.get(key) if key is not None else None
+        if match is None:
+            match = by_footprint.pop(footprint_keys([row['polygon_points']])[0], None)
+        if match is None or match['id'] in matched:
+            inserts.append(row)
+            continue
+        matched.add(match['id'])
+        if db_values(Building, row, BUILDING_FIELDS) != db_values(Building, match, BUILDING_FIELDS):
+            updates.append((row, match))
+        elif key != match['building_id']:
+            backfill.append((row, match))
+        else:
+            unchanged += 1
+    deletes = [s for s in stored if s['id'] not in matched]
+    return Diff(inserts, updates, deletes, backfill, unchanged)
+
+
+def address_key(row: Row) -> tuple:
+    return tuple(v or '' for v in db_values(Address, row, KEY_COLUMNS))
+
+
+def merged_addresses(rows: Iterable[Row]) -> Dict[tuple, Row]:
+    """
+    New address rows by key, each the first row with a key at the mean
+    coordinate of all of them, as `commands.clean_addresses` would merge them.
+    """
+    groups: Dict[tuple, List[Row]] = {}
+    for row in rows:
+        groups.setdefault(address_key(row), []).append(row)
+    return {key: {**group[0], 'lon': sum(r['lon'] for r in group) / len(group),
+                  'lat': sum(r['lat'] for r in group) / len(group)}
+            for key, group in groups.items()}
+
+
+def diff_addresses(stored: List[Row], rows: Iterable[Row]) -> Diff:
+    current: Dict[tuple, Row] = {}
+    extra = []
+    for s in stored:
+        # Stored duplicates beyond the lowest idx go, as clean_addresses would drop them
+        if current.setdefault(address_key(s), s) is not s:
+            extra.append(s)
+    inserts, updates, unchanged = [], [], 0
+    for key, row in merged_addresses(rows).items():
+        match = current.pop(key, None)
+        if match is None:
+            inserts.append(row)
+        elif (db_values(Address, row, ADDRESS_FIELDS) != db_values(Address, match, ADDRESS_FIELDS) or
+              abs(row['lon'] - match['lon']) > COORDINATE_TOLERANCE or
+              abs(row['lat'] - match['lat']) > COORDINATE_TOLERANCE):
+            updates.append((row, match))
+        else:
+            unchanged += 1
+    return Diff(inserts, updates, list(current.values()) + extra, [], unchanged)
+
+
+def next_idx(stored: List[Row]) -> int:
+    return max((s['idx'] for s in stored), default=-1) + 1
+
+
+def building_models(region: str, diff: Diff, first_idx: int) -> Tuple[List[Building], List[Building]]:
+    """
+    Models for the inserted and updated buildings, with hulls and bounding
+    rectangles computed.
+    """
+    fields = BUILDING_FIELDS + ('building_id',)
+    inserted = [Building(idx=first_idx + i, region=region, **stored_values(Building, row, fields))
+                for i, row in enumerate(diff.inserts)]
+    updated = [Building(id=s['id'], idx=s['idx'], region=region, **stored_values(Building, row, fields))
+               for row, s in diff.updates]
+    for chunk in pw.chunked(inserted + updated, BATCH_SIZE):
+        precompute_chunk(chunk)
+    return inserted, updated
+
+
+def address_models(region: str, diff: Diff, first_idx: int) -> Tuple[List[Address], List[Address]]:
+    fields = ADDRESS_FIELDS + ('lon', 'lat')
+    inserted = [Address(idx=first_idx + i, region=region, **stored_values(Address, row, fields))
+                for i, row in enumerate(diff.inserts)]
+    updated = [Address(id=s['id'], idx=s['idx'], region=region, **stored_values(Address, row, fields))
+               for row, s in diff.updates]
+    return inserted, updated
+
+
+def write_changes(model, diff: Diff, inserted: List[pw.Model], updated: List[pw.Model], fields: Iterable[str]):
+    """
+    Apply one table's inserts, updates and backfills. Call within a
+    transaction.
+    """
+    if inserted:
+        model.bulk_create(inserted, batch_size=BATCH_SIZE)
+    if updated:
+        model.bulk_update(updated, fields=[model._meta.fields[f] for f in fields], batch_size=BATCH_SIZE)
+    if diff.backfill:
+        backfilled = [model(id=s['id'], building_id=building_id(row)) for row, s in diff.backfill]
+        model.bulk_update(backfilled, fields=[model.building_id], batch_size=BATCH_SIZE)
+
+
+def delete_rows(model, ids: Iterable[int]):
+    """
+    Delete rows of `model` by primary key. Call within a transaction, once
+    the indexes no longer name them.
+    """
+    for chunk in pw.chunked(list(ids), BATCH_SIZE):
+        model.delete().where(model.id.in_(chunk)).execute()
+
+
+def building_box(points: Any) -> Box:
+    return Building(polygon_points=points).bbox
+
+
+def address_box(row: Row) -> Box:
+    return row['lon'], row['lat'], row['lon'] + EPSILON, row['lat'] + EPSILON
+
+
+def edit_index(kind: str, region: str, deletes: List[Tuple[int, Box]], inserts: List[Tuple[int, Box, tuple]],
+               data_dir: str = DATA_DIR):
+    """
+    Copy the region's current `kind` index to a new version, delete and
+    insert entries in the copy, and publish it, so its .dat and .idx files
+    switch together. Readers keep the version they have open and see the
+    new one once they reopen it. Nothing is published if there is nothing
+    to change, so readers don't reopen an identical index.
+
+    Raises:
+        FileNotFoundError if the index hasn't been built.
+    """
+    path = index_path(kind, region, data_dir)
+    file_signature(path)
+    if not deletes and not inserts:
+        return
+    new_path = new_index_path(kind, region, data_dir)
+    for extension in INDEX_EXTENSIONS:
+        shutil.copyfile(path + extension, new_path + extension)
+    rtree = index.Index(new_path)
+    for idx, box in deletes:
+        rtree.delete(idx, box)
+    for idx, box, entry in inserts:
+        rtree.insert(idx, box, obj=entry)
+    rtree.close()
+    publish_index(kind, region, new_path, data_dir)
+
+
+def is_projected(region: str, data_dir: str) -> Optional[bool]:
+    """
+    Whether the region's store was exported with a projection, or None if
+    it has no store.
+    """
+    try:
+        with open(os.path.join(store_path(region, data_dir), MANIFEST), 'r') as manifest_file:
+            return 'projection' in json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def refresh_store(region: str, data_dir: str = DATA_DIR):
+    """
+    Export the region's geometry store again from the database if it has
+    one, and otherwise only record its new counts in the catalog.
+    """
+    projected = is_projected(region, data_dir)
+    if projected is not None:
+        export_region(region, data_dir, projected)
+    else:
+        record_region(region, data_dir)
+
+
+def update_region(region: str, building_rows: Iterable[Row], address_rows: Iterable[Row],
+                  data_dir: str = DATA_DIR, dry_run: bool = False) -> Dict[str, Diff]:
+    """
+    Diff `building_rows` and `address_rows` against the region's stored rows
+    and apply the changes to the database, the indexes and the store. If
+    nothing changed, nothing is written and the store isn't exported again.
+
+    Returns:
+        the diff for 'buildings' and 'addresses'.
+
+    Raises:
+        FileNotFoundError if the region's indexes haven't been built.
+    """
+    for kind in ('buildings', 'addresses'):
+        file_signature(index_path(kind, region, data_dir))
+    with Timer(f"Diffing {region}"):
+        stored_buildings, stored_addresses = stored_rows(Building, region), stored_rows(Address, region)
+        diffs = {'buildings': diff_buildings(stored_buildings, unique_footprints(building_rows)),
+                 'addresses': diff_addresses(stored_addresses, address_rows)}
+    if dry_run or all(diff.empty for diff in diffs.values()):
+        return diffs
+    buildings, addresses = diffs['buildings'], diffs['addresses']
+    new_buildings, changed_buildings = building_models(region, buildings, next_idx(stored_buildings))
+    new_addresses, changed_addresses = address_models(region, addresses, next_idx(stored_addresses))
+    with Timer(f"Writing changes to {region}"), db.atomic():
+        write_changes(Building, buildings, new_buildings, changed_buildings,
+                      BUILDING_FIELDS + ('building_id', 'hull_points', 'mbr_points'))
+        write_changes(Address, addresses, new_addresses, changed_addresses, ADDRESS_FIELDS + ('lon', 'lat'))
+    with Timer(f"Updating the indexes for {region}"):
+        edit_index('buildings', region,
+                   [(s['idx'], building_box(s['polygon_points'])) for s in buildings.deletes] +
+                   [(s['idx'], building_box(s['polygon_points'])) for _, s in buildings.updates],
+                   [(b.idx, b.bbox, b.to_entry()) for b in new_buildings + changed_buildings], data_dir)
+        edit_index('addresses', region,
+                   [(s['idx'], address_box(s)) for s in addresses.deletes] +
+                   [(s['idx'], address_box(s)) for _, s in addresses.updates],
+                   [(a.idx, address_box({'lon': a.lon, 'lat': a.lat}), a.to_entry())
+                    for a in new_addresses + changed_addresses], data_dir)
+    with Timer(f"Deleting rows from {region}"), db.atomic():
+        delete_rows(Building, [s['id'] for s in buildings.deletes])
+        delete_rows(Address, [s['id'] for s in addresses.deletes])
+    refresh_store(region, data_dir)
+    return diffs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Apply new shapefiles to a region in place")
+    parser.add_argument('region')
+    parser.add_argument('--buildings', help="building shapefile (default: gis_data/<region>.shp)")
+    parser.add_argument('--addresses', help="address shapefile (default: gis_data/<region>_addresses.shp)")
+    parser.add_argument('--layout', help="shapefile layout to read, e.g. denver (default: the region)")
+    parser.add_argument('--dry-run', action='store_true', help="report the changes without applying them")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    data_dir = os.path.join(os.getcwd(), 'gis_data')
+    building_file = args.buildings or os.path.join(data_dir, f'{args.region}.shp')
+    address_file = args.addresses or os.path.join(data_dir, f'{args.region}_addresses.shp')
+    building_rows = load_shapefile(building_file, BuildingShapeFactory(args.region, args.layout))
+    address_rows = load_shapefile(address_file, AddressedLocationFactory(args.region, args.layout))
+    with Timer(f"Updating {args.region}"):
+        changes = update_region(args.region, building_rows, address_rows, data_dir, args.dry_run)
+    for kind, diff in changes.items():
+        logger.info("%s%s: %s", kind.capitalize(), " (dry run)" if args.dry_run else "", diff.summary())
+        if diff.backfill:
+            logger.info("%s: stored the source id of %s unchanged buildings", kind.capitalize(),
+                        len(diff.backfill))
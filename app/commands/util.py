@@ -1,11 +1,21 @@
 import logging
+import resource
 import time
 
+from api.metrics import metrics, stage_seconds
+
 logger = logging.getLogger(__name__)
 
 class Timer:
-    def __init__(self, reason):
+    def __init__(self, reason, stage=None, **labels):
+        """
+        Logs how long the block took. With a `stage`, the time is recorded
+        in the stage histogram instead, under `labels` and the labels of the
+        request being served, and only logged at DEBUG.
+        """
         self.reason = reason
+        self.stage = stage
+        self.labels = labels
         self.start, self.end = 0, 0
 
     def __enter__(self):
@@ -13,4 +23,32 @@ class Timer:
 
     def __exit__(self, result_type, value, traceback):
         self.end = time.perf_counter()
-        logger.info("Finished: %s in %s s", self.reason, self.end - self.start)
+        if self.stage is None:
+            logger.info("Finished: %s in %s s", self.reason, self.end - self.start)
+            return
+        metrics.observe(stage_seconds, self.end - self.start, stage=self.stage, **self.labels)
+        logger.debug("Finished: %s in %s s", self.reason, self.end - self.start)
+
+
+class Progress:
+    def __init__(self, reason, every=10_000):
+        """
+        Logs a running count, throughput and peak RSS every `every` items.
+        """
+        self.reason = reason
+        self.every = every
+        self.count = 0
+        self.start = time.perf_counter()
+
+    def update(self, n=1):
+        before = self.count
+        self.count += n
+        if self.count // self.every != before // self.every:
+            self.log()
+
+    def log(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        logger.info("%s: %s in %.1f s (%.0f/s, peak RSS %.0f MB)",
+                    self.reason, self.count, elapsed, rate, peak_mb)
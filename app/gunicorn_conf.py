@@ -0,0 +1,45 @@
+"""
+Gunicorn settings, picked up from /app/gunicorn_conf.py by the base image's
+start script in place of its own. They keep the image's environment
+variables, and import the app once in the master (preload_app) so that
+workers fork with the imports done and the preloaded regions' files paged in.
+Each worker then opens its indexes in the background and reports ready on
+/ready.
+"""
+import multiprocessing
+import os
+import time
+
+started_at = time.perf_counter()
+
+workers_per_core = float(os.getenv('WORKERS_PER_CORE', '1'))
+max_workers = int(os.getenv('MAX_WORKERS', '0'))
+default_workers = max(int(workers_per_core * multiprocessing.cpu_count()), 2)
+
+bind = os.getenv('BIND') or f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '80')}"
+workers = int(os.getenv('WEB_CONCURRENCY') or (min(default_workers, max_workers) if max_workers
+                                               else default_workers))
+worker_class = 'uvicorn.workers.UvicornWorker'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+errorlog = os.getenv('ERROR_LOG', '-') or None
+accesslog = os.getenv('ACCESS_LOG', '-') or None
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '120'))
+timeout = int(os.getenv('TIMEOUT', '120'))
+keepalive = int(os.getenv('KEEP_ALIVE', '5'))
+preload_app = True
+
+
+def when_ready(server):
+    """
+    Runs in the master once the app is imported, before any worker forks.
+    """
+    from api.warmup import warm_files  # pylint: disable=import-outside-toplevel
+    server.log.info("Imported the app in %.2f s", time.perf_counter() - started_at)
+    start = time.perf_counter()
+    try:
+        paged = warm_files()
+    except Exception: # pylint: disable=broad-except
+        # Workers open regions themselves and report on /ready
+        server.log.exception("Could not page in region files")
+        return
+    server.log.info("Paged in %.1f MB of region files in %.2f s", paged / 1e6, time.perf_counter() - start)
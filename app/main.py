@@ -1,6 +1,20 @@
+import logging
+import sys
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.status import HTTP_404_NOT_FOUND, HTTP_503_SERVICE_UNAVAILABLE
 from api.api import router
+from api.cache import cache
+from api.catalog import catalog
+from api.encoding import FastJSONResponse
+from api.executor import pool
+from api.metrics import CONTENT_TYPE, MetricsMiddleware, metrics
+from api.registry import preload_regions, registry
+from api.warmup import warm_up
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 app = FastAPI(title="GIS Locator")
 
@@ -15,3 +29,32 @@ app.add_middleware(
 )
 
 app.include_router(router)
+
+app.add_middleware(MetricsMiddleware, routes=[route.path for route in router.routes] + ['/metrics', '/ready'])
+
+metrics.collector(pool.samples)
+metrics.collector(cache.samples)
+metrics.collector(registry.samples)
+
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    if not metrics.enabled:
+        return Response(status_code=HTTP_404_NOT_FOUND)
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get('/ready', include_in_schema=False)
+async def get_ready():
+    return FastJSONResponse(warm_up.as_dict(), status_code=200 if warm_up.ready else HTTP_503_SERVICE_UNAVAILABLE)
+
+
+@app.on_event("startup")
+def open_region_indexes():
+    catalog.entries()
+    warm_up.start(preload_regions(registry.validate()))
+
+
+@app.on_event("shutdown")
+def stop_query_pool():
+    pool.shutdown()
@@ -0,0 +1,47 @@
+"""
+The tests run against a small synthetic city, built once per session in a
+scratch directory. The app resolves gis_data/ and .env against the working
+directory when it is imported, so this moves there before any test module
+imports it.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+REGION = 'testville'
+BUILDINGS = 1500
+
+START_DIR = os.getcwd()
+WORK_DIR = tempfile.mkdtemp(prefix='gis-tests-')
+os.makedirs(os.path.join(WORK_DIR, 'gis_data'))
+os.chdir(WORK_DIR)
+
+
+def pytest_unconfigure(config):
+    os.chdir(START_DIR)
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def city() -> str:
+    """
+    The name of a region of BUILDINGS buildings and as many addresses, with
+    its indexes and geometry store built.
+    """
+    from benchmarks.city import build_city, generate_city  # pylint: disable=import-outside-toplevel
+    generate_city(REGION, BUILDINGS, seed=0)
+    build_city(REGION)
+    return REGION
+
+
+@pytest.fixture(scope='session')
+def client(city):
+    """
+    A client for the app, serving `city`. Startup isn't run, so regions
+    are opened by the first query that needs them.
+    """
+    from starlette.testclient import TestClient  # pylint: disable=import-outside-toplevel
+    from main import app  # pylint: disable=import-outside-toplevel
+    return TestClient(app)
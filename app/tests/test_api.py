@@ -0,0 +1,106 @@
+"""
+Validation of the query parameters by the routes, and the batch routes
+against the single-point ones.
+"""
+import numpy as np
+import pytest
+
+from api.api import MAX_BATCH_SIZE, MAX_K
+from api.catalog import catalog
+
+OTHER_REGION = 'otherville'
+BATCH_ROUTES = [('/addresses/batch', '/addresses'), ('/buildings/batch', '/buildings'),
+                ('/intersect/batch', '/intersect')]
+
+
+@pytest.fixture(scope='module')
+def point(city):
+    min_x, min_y, max_x, max_y = catalog.get(city).bbox
+    return {'lat': (min_y + max_y) / 2, 'lon': (min_x + max_x) / 2}
+
+
+@pytest.fixture(scope='module')
+def other_city(city) -> str:
+    """
+    A second, smaller region 10 km east of `city`.
+    """
+    from benchmarks.city import DEFAULT_ORIGIN, build_city, generate_city  # pylint: disable=import-outside-toplevel
+    generate_city(OTHER_REGION, 300, origin=(DEFAULT_ORIGIN[0] + 0.12, DEFAULT_ORIGIN[1]), seed=1)
+    build_city(OTHER_REGION)
+    catalog.refresh()
+    return OTHER_REGION
+
+
+@pytest.fixture(scope='module')
+def mixed_points(city, other_city) -> list:
+    """
+    Points with headings, alternating between the two regions in runs of
+    random length.
+    """
+    rng = np.random.default_rng(0)
+    points = []
+    while len(points) < 40:
+        min_x, min_y, max_x, max_y = catalog.get(rng.choice([city, other_city])).bbox
+        for _ in range(rng.integers(1, 5)):
+            points.append({'lat': rng.uniform(min_y, max_y), 'lon': rng.uniform(min_x, max_x),
+                           'heading': rng.uniform(0.0, 360.0)})
+    return points
+
+
+@pytest.mark.parametrize('route', ['/addresses', '/buildings'])
+def test_k_up_to_max(client, city, point, route):
+    response = client.get(route, params={**point, 'region': city, 'k': MAX_K})
+    assert response.status_code == 200
+    assert response.json()['count'] == MAX_K
+
+
+@pytest.mark.parametrize('route', ['/addresses', '/buildings', '/intersect'])
+@pytest.mark.parametrize('params', [{'k': MAX_K + 1}, {'k': 0}, {'max_distance_m': 0}])
+def test_rejects_out_of_range(client, city, point, route, params):
+    response = client.get(route, params={**point, 'heading': 90.0, 'region': city, **params})
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize('route', ['/addresses/batch', '/buildings/batch', '/intersect/batch'])
+@pytest.mark.parametrize('body', [{'k': MAX_K + 1}, {'max_distance_m': -1.0}])
+def test_batch_rejects_out_of_range(client, city, point, route, body):
+    response = client.post(route, json={'region': city, 'points': [{**point, 'heading': 90.0}], **body})
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize('batch_route, route', BATCH_ROUTES)
+def test_batch_keeps_input_order(client, mixed_points, batch_route, route):
+    response = client.post(batch_route, json={'points': mixed_points, 'k': 5, 'max_hits': 2})
+    assert response.status_code == 200
+    batch = response.json()
+    assert batch['count'] == len(mixed_points)
+    singles = [client.get(route, params={**p, 'k': 5, 'max_hits': 2}).json() for p in mixed_points]
+    assert batch['results'] == singles
+
+
+@pytest.mark.parametrize('batch_route', [batch for batch, _ in BATCH_ROUTES])
+def test_batch_split_into_chunks(client, mixed_points, batch_route):
+    whole = client.post(batch_route, json={'points': mixed_points, 'k': 5}).json()['results']
+    chunks = []
+    for start in range(0, len(mixed_points), 7):
+        response = client.post(batch_route, json={'points': mixed_points[start:start + 7], 'k': 5})
+        chunks.extend(response.json()['results'])
+    assert chunks == whole
+
+
+@pytest.mark.parametrize('batch_route', [batch for batch, _ in BATCH_ROUTES])
+def test_batch_size_limit(client, city, point, batch_route):
+    points = [{**point, 'heading': 90.0}]
+    response = client.post(batch_route, json={'region': city, 'points': points * MAX_BATCH_SIZE, 'k': 1})
+    assert response.status_code == 200
+    response = client.post(batch_route, json={'region': city, 'points': points * (MAX_BATCH_SIZE + 1)})
+    assert response.status_code == 413
+
+
+def test_intersect_batch_needs_headings(client, city, point):
+    points = [{**point, 'heading': 90.0}, point]
+    response = client.post('/intersect/batch', json={'region': city, 'points': points})
+    assert response.status_code == 422
+    assert response.json()['detail'] == 'Every point needs a heading.'
+    response = client.post('/buildings/batch', json={'region': city, 'points': points})
+    assert response.status_code == 200
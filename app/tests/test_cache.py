@@ -0,0 +1,108 @@
+"""
+Cache keys snapped to the grid, and entries dropped when a region's index
+is reloaded.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import api.geometry as geom
+from api.cache import MISSING, ResponseCache, cache, quantize
+from api.registry import IndexRegistry
+
+GRID_M = 10.0
+
+
+def cell_center(cell: tuple, near_lat: float) -> tuple:
+    """
+    The point `cell` of `quantize` is centered on, with the cell height
+    taken at `near_lat` as `quantize` does.
+    """
+    _, dlat = geom.meters_to_degrees(near_lat, GRID_M)
+    lat = cell[1] * dlat
+    dlon, _ = geom.meters_to_degrees(lat, GRID_M)
+    return cell[0] * dlon, lat
+
+
+@pytest.fixture(params=[None, 'shared'])
+def response_cache(request, tmp_path) -> ResponseCache:
+    shared_path = str(tmp_path / 'cache.sqlite') if request.param else None
+    return ResponseCache(max_entries=100, ttl=60.0, grid_m=GRID_M, heading_deg=1.0, shared_path=shared_path)
+
+
+@pytest.mark.skipif(bool(os.environ.get('GIS_CACHE_SIZE')), reason="GIS_CACHE_SIZE is set")
+def test_off_by_default():
+    assert not cache.enabled
+
+
+@pytest.mark.parametrize('lat', [0.0, 40.7, 65.0])
+def test_cells_are_grid_m_apart(lat):
+    cell = quantize((12.3, lat), GRID_M, 1.0)
+    center = cell_center(cell, lat)
+    assert quantize(center, GRID_M, 1.0) == cell
+    east = cell_center((cell[0] + 1, cell[1]), lat)
+    # Each row of cells is as wide as it should be at its own latitude, so
+    # rows don't line up and the next one is measured along the meridian
+    north = (center[0], cell_center((cell[0], cell[1] + 1), lat)[1])
+    distances = geom.haversine_meters(np.array([center, center]), np.array([east, north]))
+    np.testing.assert_allclose(distances, GRID_M, rtol=1e-3)
+
+
+@pytest.mark.parametrize('lat', [0.0, 40.7, 65.0])
+def test_points_in_a_cell_share_a_key(lat):
+    rng = np.random.default_rng(0)
+    cell = quantize((-73.98, lat), GRID_M, 1.0)
+    center = np.array(cell_center(cell, lat))
+    for heading, meters in zip(rng.uniform(0.0, 360.0, 50), rng.uniform(0.0, 0.45 * GRID_M, 50)):
+        inside = geom.destination(center, heading, meters)[0]
+        assert quantize(tuple(inside), GRID_M, 1.0) == cell
+        outside = geom.destination(center, heading, meters + 1.5 * GRID_M)[0]
+        assert quantize(tuple(outside), GRID_M, 1.0) != cell
+
+
+def test_heading_buckets():
+    point = (-73.98, 40.7)
+    key = lambda heading: quantize(point + (heading,), GRID_M, 1.0)
+    assert key(359.8) == key(0.2) == key(360.0)
+    assert key(370.0) == key(10.0) == key(-350.0)
+    assert key(10.0) != key(11.0)
+    assert key(10.0)[:2] == quantize(point, GRID_M, 1.0)
+
+
+def test_keys_include_the_index_version(response_cache):
+    items = [(-73.98, 40.7), (-73.97, 40.71)]
+    old = response_cache.keys('find_buildings', 'a', 'v1', items, (50, None))
+    response_cache.put_many(old, ['x', 'y'])
+    assert response_cache.get_many(old) == ['x', 'y']
+    new = response_cache.keys('find_buildings', 'a', 'v2', items, (50, None))
+    assert response_cache.get_many(new) == [MISSING, MISSING]
+
+
+def test_invalidate_drops_only_the_region(response_cache):
+    items = [(-73.98, 40.7)]
+    a = response_cache.keys('find_buildings', 'a', 'v1', items, (50, None))
+    b = response_cache.keys('find_buildings', 'b', 'v1', items, (50, None))
+    response_cache.put_many(a + b, ['x', 'y'])
+    response_cache.invalidate('a')
+    assert response_cache.get_many(a + b) == [MISSING, 'y']
+    assert response_cache.stats.as_dict()['invalidations'] == 1
+
+
+def test_reload_invalidates(city, response_cache, tmp_path):
+    from benchmarks.city import build_city  # pylint: disable=import-outside-toplevel
+    data_dir = str(tmp_path / 'gis_data')
+    os.makedirs(data_dir)
+    build_city(city, data_dir)
+    registry = IndexRegistry(data_dir, check_interval=0.0)
+    registry.on_reload(response_cache.invalidate)
+    version = registry.version(city)
+    keys = response_cache.keys('find_buildings', city, version, [(-73.98, 40.7)], (50, None))
+    response_cache.put_many(keys, ['x'])
+    assert registry.version(city) == version
+    assert response_cache.get_many(keys) == ['x']
+
+    build_city(city, data_dir)
+    assert registry.version(city) != version
+    assert response_cache.get_many(keys) == [MISSING]
+    assert response_cache.stats.as_dict()['invalidations'] == 1
@@ -0,0 +1,101 @@
+"""
+Footprint keys that ignore the starting vertex, winding order and closing
+vertex, and a dedupe that takes copies out of the index and store as well
+as the database.
+"""
+import os
+
+import numpy as np
+import pytest
+from rtree import index
+
+from api.models import Building
+from api.registry import index_path
+from api.store import GeometryStore, store_path
+from benchmarks.city import DEFAULT_ORIGIN, build_city, city_rows, generate_city
+from commands.dedupe_buildings import QUANTUM, dedupe_region, footprint_keys
+from commands.load_shapes import write_rows
+
+REGION = 'dupeville'
+ORIGIN = (DEFAULT_ORIGIN[0] - 0.1, DEFAULT_ORIGIN[1])
+BUILDINGS = 30
+
+
+def rings(count: int = 20) -> list:
+    return [b['polygon_points'] for b, _ in city_rows(REGION, count, 2_000.0, ORIGIN, 3)]
+
+
+def variants(ring: list) -> dict:
+    """
+    The same footprint as `ring`, a closed ring, written differently.
+    """
+    open_ring = ring[:-1]
+    rotated = open_ring[2:] + open_ring[:2]
+    return {
+        'open': open_ring,
+        'rotated': rotated + rotated[:1],
+        'rotated open': rotated,
+        'reversed': ring[::-1],
+        'reversed and rotated': (rotated + rotated[:1])[::-1],
+        'closed twice': ring + ring[:1],
+        'array': np.array(ring),
+    }
+
+
+@pytest.mark.parametrize('ring', rings(), ids=lambda ring: f'{len(ring) - 1}-gon')
+def test_footprint_keys_match_variants(ring):
+    names, forms = zip(*variants(ring).items())
+    keys = footprint_keys([ring] + list(forms))
+    assert {name: key for name, key in zip(names, keys[1:]) if key != keys[0]} == {}
+
+
+def test_footprint_keys_ignore_noise_within_a_cell():
+    ring = np.rint(np.array(rings(1)[0]) / QUANTUM) * QUANTUM
+    noise = np.random.default_rng(0).uniform(-0.4 * QUANTUM, 0.4 * QUANTUM, ring.shape)
+    assert footprint_keys([ring])[0] == footprint_keys([ring + noise])[0]
+
+
+def test_footprint_keys_differ():
+    ring = rings(1)[0]
+    shifted = [(x + 10 * QUANTUM, y) for x, y in ring]
+    keys = footprint_keys(rings() + [shifted])
+    assert len(set(keys)) == len(keys)
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory) -> str:
+    """
+    A region with copies of buildings 0, 5 and 9 written differently, as
+    buildings 30 to 32, and building 12 shrunk by 1% as building 33.
+    """
+    path = str(tmp_path_factory.mktemp('dedupe') / 'gis_data')
+    os.makedirs(path)
+    generate_city(REGION, BUILDINGS, origin=ORIGIN, seed=3)
+    stored = {b.idx: [tuple(p) for p in b.polygon_points.tolist()]
+              for b in Building.select().where(Building.region == REGION)}
+    copies = [variants(stored[0])['rotated'], variants(stored[5])['reversed'], variants(stored[9])['open']]
+    ring = np.array(stored[12])
+    center = ring[:-1].mean(axis=0)
+    copies.append([tuple(p) for p in (center + (ring - center) * 0.99).tolist()])
+    write_rows(Building, ({'idx': BUILDINGS + i, 'region': REGION, 'building_type': 'Residential',
+                           'polygon_points': points, 'vertex_count': len(points)}
+                          for i, points in enumerate(copies)))
+    build_city(REGION, path)
+    return path
+
+
+def test_dedupe_region(data_dir):
+    expected = set(range(BUILDINGS))
+    stats = dedupe_region(REGION, overlap=0.9, data_dir=data_dir)
+    assert (stats.copies, stats.overlapping) == (3, 1)
+    assert {b.idx for b in Building.select(Building.idx).where(Building.region == REGION)} == expected
+    rtree = index.Index(index_path('buildings', REGION, data_dir))
+    try:
+        assert set(rtree.intersection(rtree.bounds)) == expected
+    finally:
+        rtree.close()
+    store = GeometryStore(store_path(REGION, data_dir))
+    assert set(store.building_idx.tolist()) == expected
+
+    stats = dedupe_region(REGION, overlap=0.9, data_dir=data_dir)
+    assert stats.removed == 0
@@ -0,0 +1,110 @@
+"""
+The vectorized geodesy in api.geometry against geopy, to the bounds
+documented in its geodesy section. Run from app/:
+
+    python -m pytest tests
+"""
+import geopy
+import geopy.distance
+import numpy as np
+import pytest
+
+import api.geometry as geom
+
+MAX_LAT = 80.0
+SAMPLES = 300
+
+
+def geopy_destination(point, heading: float, meters: float) -> np.array:
+    start = geopy.Point(point[1], point[0])
+    end = geopy.distance.distance(meters=meters).destination(point=start, bearing=heading)
+    return np.array([end.longitude, end.latitude])
+
+
+def geopy_destinations(points: np.array, headings: np.array, meters: np.array) -> np.array:
+    return np.array([geopy_destination(p, h, m) for p, h, m in zip(points, headings, meters)])
+
+
+def angle_deg(a: np.array, b: np.array) -> np.array:
+    cos = np.einsum('ij,ij->i', a, b) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+@pytest.fixture(scope='module')
+def samples():
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(-180.0, 180.0, SAMPLES), rng.uniform(-MAX_LAT, MAX_LAT, SAMPLES)])
+    headings = rng.uniform(0.0, 360.0, SAMPLES)
+    return points, headings
+
+
+@pytest.fixture(scope='module')
+def far_points(samples):
+    points, headings = samples
+    meters = np.random.default_rng(1).uniform(2000.0, 20000.0, SAMPLES)
+    return geom.destination(points, headings, meters)
+
+
+def test_bearing_to_direction(samples):
+    points, headings = samples
+    reference = geopy_destinations(points, headings, np.full(SAMPLES, 10.0))
+    directions = geom.bearing_to_direction(points[:, 1], headings)
+    assert angle_deg(directions, reference - points).max() <= 1e-3
+
+
+def test_bearing_to_direction_cardinal():
+    directions = geom.bearing_to_direction(45.0, [0.0, 90.0, 180.0, 270.0])
+    np.testing.assert_allclose(directions, [[0, 1], [1, 0], [0, -1], [-1, 0]], atol=1e-12)
+
+
+def test_destination_within_2km(samples):
+    points, headings = samples
+    meters = np.random.default_rng(2).uniform(1.0, 2000.0, SAMPLES)
+    reference = geopy_destinations(points, headings, meters)
+    assert geom.haversine_meters(geom.destination(points, headings, meters), reference).max() <= 0.01
+
+
+def test_destination_within_20km(samples):
+    points, headings = samples
+    meters = np.random.default_rng(3).uniform(2000.0, 20000.0, SAMPLES)
+    reference = geopy_destinations(points, headings, meters)
+    errors = geom.haversine_meters(geom.destination(points, headings, meters), reference)
+    assert (errors / meters).max() <= 1e-4
+
+
+def test_haversine_meters(samples, far_points):
+    points, _ = samples
+    haversine = geom.haversine_meters(points, far_points)
+    great_circle = np.array([geopy.distance.great_circle(p[::-1], q[::-1]).meters
+                             for p, q in zip(points, far_points)])
+    geodesic = np.array([geopy.distance.distance(p[::-1], q[::-1]).meters
+                         for p, q in zip(points, far_points)])
+    assert np.abs(haversine - great_circle).max() <= 1e-3
+    assert (np.abs(haversine - geodesic) / geodesic).max() <= 6e-3
+
+
+def test_haversine_meters_same_point(samples):
+    points, _ = samples
+    assert not geom.haversine_meters(points, points).any()
+
+
+def test_equirectangular_meters(samples, far_points):
+    points, _ = samples
+    haversine = geom.haversine_meters(points, far_points)
+    equirectangular = geom.equirectangular_meters(points, far_points)
+    assert (np.abs(equirectangular - haversine) / haversine).max() <= 1e-4
+
+
+def test_enu_round_trip(samples, far_points):
+    points, _ = samples
+    for origin, point in zip(points, far_points):
+        offsets = geom.enu(point[None, :], origin)
+        assert np.abs(geom.from_enu(offsets, origin) - point).max() <= 1e-9
+
+
+def test_enu_axes():
+    origin = (-104.99, 39.74)
+    north = geom.destination(np.array([origin]), 0.0, 100.0)
+    east, up = geom.enu(north, origin)[0]
+    assert abs(east) < 1e-6
+    assert up == pytest.approx(100.0, abs=0.01)
@@ -0,0 +1,107 @@
+"""
+The vectorized ray intersection in api.geometry against `Ray.line_intersection`,
+one ray and one edge at a time.
+"""
+from typing import List
+
+import numpy as np
+import pytest
+
+import api.geometry as geom
+
+ORIGIN = (-73.985, 40.758)
+SHAPES = 60
+RAYS = 40
+
+# Ray.line_intersection takes np.cross of 2-d vectors
+pytestmark = pytest.mark.filterwarnings('ignore::DeprecationWarning')
+
+
+def scalar_hits(rays: List[geom.Ray], edges: geom.EdgeSet) -> List[tuple]:
+    hits = []
+    for r, ray in enumerate(rays):
+        for e, line in enumerate(zip(edges.starts, edges.ends)):
+            found = ray.line_intersection(line)
+            if found is not None:
+                t, point, normal, face_length = found
+                hits.append((r, e, edges.owners[e], t, point, normal, face_length))
+    return hits
+
+
+def assert_same_hits(hits: geom.RayHits, expected: List[tuple]):
+    assert len(hits.t) == len(expected)
+    if not expected:
+        return
+    ray, edge, owner, t, point, normal, face_length = (np.array(column) for column in zip(*expected))
+    np.testing.assert_array_equal(hits.ray, ray)
+    np.testing.assert_array_equal(hits.edge, edge)
+    np.testing.assert_array_equal(hits.owner, owner)
+    np.testing.assert_allclose(hits.t, t, rtol=1e-12)
+    np.testing.assert_allclose(hits.point, point, rtol=1e-12)
+    np.testing.assert_allclose(hits.normal, normal, rtol=1e-12)
+    np.testing.assert_allclose(hits.face_length, face_length, rtol=1e-12)
+
+
+@pytest.fixture(scope='module')
+def edges() -> geom.EdgeSet:
+    """
+    Quadrilaterals scattered around ORIGIN, with their corners in order
+    around the center and the three edges `EdgeSet.from_rects` uses.
+    """
+    rng = np.random.default_rng(0)
+    centers = np.array(ORIGIN) + rng.uniform(-0.002, 0.002, (SHAPES, 2))
+    angles = np.sort(rng.uniform(0.0, 2 * np.pi, (SHAPES, 4)), axis=1)
+    sizes = rng.uniform(5e-5, 4e-4, (SHAPES, 1))
+    corners = centers[:, None] + sizes[:, :, None] * np.stack((np.cos(angles), np.sin(angles)), axis=2)
+    return geom.EdgeSet.from_rects(corners)
+
+
+@pytest.fixture(scope='module')
+def rays() -> List[geom.Ray]:
+    rng = np.random.default_rng(1)
+    origins = np.array(ORIGIN) + rng.uniform(-0.002, 0.002, (RAYS, 2))
+    return [geom.Ray(tuple(o), h) for o, h in zip(origins, rng.uniform(0.0, 360.0, RAYS))]
+
+
+def test_intersect_rays(rays, edges):
+    hits = geom.intersect_rays([r.ro for r in rays], [r.rd for r in rays], edges)
+    assert len(hits.t)
+    assert_same_hits(hits, scalar_hits(rays, edges))
+
+
+def test_intersect_pairs(rays, edges):
+    rng = np.random.default_rng(2)
+    pairs = np.unique(rng.integers(0, [len(rays), len(edges.starts)], (2000, 2)), axis=0)
+    hits = geom.intersect_pairs([r.ro for r in rays], [r.rd for r in rays], edges, pairs[:, 0], pairs[:, 1])
+    expected = [h for h in scalar_hits(rays, edges) if ((pairs[:, 0] == h[0]) & (pairs[:, 1] == h[1])).any()]
+    assert_same_hits(hits, expected)
+
+
+def test_parallel_and_collinear_edges():
+    ray = geom.Ray(ORIGIN, 90.0)
+    ray.rd = np.array([1.0, 0.0])
+    x, y = ORIGIN
+    lines = [((x, y + 1e-4), (x + 1e-3, y + 1e-4)),  # parallel
+             ((x + 1e-4, y), (x + 2e-4, y)),  # collinear, ahead
+             ((x - 2e-4, y), (x - 1e-4, y)),  # collinear, behind
+             ((x + 3e-4, y - 1e-4), (x + 3e-4, y + 1e-4)),  # crossing
+             ((x + 4e-4, y), (x + 4e-4, y + 1e-4)),  # touching at its start
+             ((x - 3e-4, y - 1e-4), (x - 3e-4, y + 1e-4))]  # behind the origin
+    edges = geom.EdgeSet.from_shapes([[tuple(np.array(p) for p in line)] for line in lines])
+    hits = geom.intersect_rays([ray.ro], [ray.rd], edges)
+    expected = scalar_hits([ray], edges)
+    assert [h[1] for h in expected] == [3, 4]
+    assert_same_hits(hits, expected)
+
+
+@pytest.mark.parametrize('min_hits', [1, 2])
+def test_nearest_hits(rays, edges, min_hits):
+    groups = {}
+    for hit in scalar_hits(rays, edges):
+        groups.setdefault((hit[0], hit[2]), []).append(hit)
+    expected = [min(group, key=lambda h: (h[3], h[1])) for group in groups.values() if len(group) >= min_hits]
+    expected.sort(key=lambda h: (h[0], h[3], h[2]))
+    hits = geom.nearest_hits(geom.intersect_rays([r.ro for r in rays], [r.rd for r in rays], edges), min_hits)
+    assert_same_hits(hits, expected)
+    if min_hits == 2:
+        assert len(expected) < len(groups)
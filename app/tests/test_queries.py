@@ -0,0 +1,72 @@
+"""
+Radius searches against a brute force scan of the database, and the two
+intersection modes against each other.
+"""
+import numpy as np
+import pytest
+
+import api.geometry as geom
+import api.queries as queries
+from api.catalog import catalog
+from api.models import Address, Building
+
+SAMPLES = 100
+
+
+@pytest.fixture(scope='module')
+def points(city):
+    min_x, min_y, max_x, max_y = catalog.get(city).bbox
+    rng = np.random.default_rng(0)
+    return np.column_stack([rng.uniform(min_x, max_x, SAMPLES), rng.uniform(min_y, max_y, SAMPLES)])
+
+
+@pytest.fixture(scope='module')
+def radii():
+    return np.random.default_rng(1).uniform(50.0, 300.0, SAMPLES)
+
+
+def nearest_first(ids: np.array, distances: np.array, max_distance_m: float, k: int) -> list:
+    order = np.lexsort((ids, distances))
+    return ids[order[distances[order] <= max_distance_m]][:k].tolist()
+
+
+@pytest.mark.parametrize('k', [10, 500])
+def test_buildings_within_radius(city, points, radii, k):
+    rows = list(Building.select(Building.idx, Building.polygon_points).where(Building.region == city))
+    ids = np.array([row.idx for row in rows], dtype=np.int64)
+    boxes = np.array([row.bbox for row in rows])
+    for point, radius in zip(points, radii):
+        distances = geom.point_rect_distance(np.tile(point, (len(ids), 1)), boxes[:, :2], boxes[:, 2:])
+        found = queries.nearest_buildings_many(city, [tuple(point)], k, radius)[0]
+        assert found.idx.tolist() == nearest_first(ids, distances, radius, k)
+
+
+@pytest.mark.parametrize('k', [10, 500])
+def test_addresses_within_radius(city, points, radii, k):
+    rows = list(Address.select(Address.idx, Address.lon, Address.lat).where(Address.region == city))
+    ids = np.array([row.idx for row in rows], dtype=np.int64)
+    centers = np.array([(row.lon, row.lat) for row in rows])
+    for point, radius in zip(points, radii):
+        distances = geom.haversine_meters(np.tile(point, (len(ids), 1)), centers)
+        found = queries.nearest_addresses_many(city, [tuple(point)], k, radius)[0]
+        assert found.idx.tolist() == nearest_first(ids, distances, radius, k)
+
+
+def test_unbounded_search_returns_k(city, points):
+    found = queries.nearest_buildings_many(city, [tuple(p) for p in points[:10]], 7)
+    assert [len(f) for f in found] == [7] * 10
+
+
+
+@pytest.mark.parametrize('view', [None, queries.View()])
+def test_nearest_and_ray_modes_agree(city, points, view):
+    rays = [(lon, lat, heading) for (lon, lat), heading in
+            zip(points[:40], np.random.default_rng(2).uniform(0.0, 360.0, 40))]
+    options = {'k': 500, 'max_distance_m': 150.0, 'max_hits': 3, 'view': view}
+    nearest = queries.intersect_many(city, rays, queries.SearchOptions(mode='nearest', **options))
+    traced = queries.intersect_many(city, rays, queries.SearchOptions(mode='ray', **options))
+    for ray in range(len(rays)):
+        a, b = nearest.for_ray(ray), traced.for_ray(ray)
+        assert nearest.buildings.idx[nearest.hits.owner[a]].tolist() == \
+            traced.buildings.idx[traced.hits.owner[b]].tolist()
+        np.testing.assert_allclose(nearest.hits.t[a], traced.hits.t[b], atol=1e-6)
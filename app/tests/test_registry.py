@@ -0,0 +1,88 @@
+"""
+Indexes replaced by a rebuild stay open while a `reading` block holds them.
+"""
+import os
+import threading
+
+import pytest
+
+from api.catalog import catalog
+from api.registry import IndexRegistry, SharedIndex
+
+
+@pytest.fixture
+def closed(monkeypatch) -> list:
+    """
+    Every SharedIndex closed during the test.
+    """
+    found = []
+    close = SharedIndex.close
+
+    def record(self):
+        found.append(self)
+        close(self)
+
+    monkeypatch.setattr(SharedIndex, 'close', record)
+    return found
+
+
+@pytest.fixture
+def data_dir(city, tmp_path) -> str:
+    from benchmarks.city import build_city  # pylint: disable=import-outside-toplevel
+    path = str(tmp_path / 'gis_data')
+    os.makedirs(path)
+    build_city(city, path)
+    return path
+
+
+def rebuild(city: str, data_dir: str):
+    from benchmarks.city import build_city  # pylint: disable=import-outside-toplevel
+    build_city(city, data_dir)
+
+
+def test_unheld_index_is_closed_on_reload(city, data_dir, closed):
+    registry = IndexRegistry(data_dir, check_interval=0.0)
+    old = registry.buildings(city)
+    rebuild(city, data_dir)
+    new = registry.buildings(city)
+    assert new is not old
+    assert closed == [old]
+
+
+def test_held_index_is_closed_when_released(city, data_dir, closed):
+    registry = IndexRegistry(data_dir, check_interval=0.0)
+    bbox = catalog.get(city).bbox
+    with registry.reading():
+        old = registry.buildings(city)
+        rebuild(city, data_dir)
+        with registry.reading():
+            new = registry.buildings(city)
+        assert new is not old
+        assert not closed
+        assert old.intersection(bbox)
+    assert closed == [old]
+    with registry.reading():
+        assert registry.buildings(city) is new
+    assert closed == [old]
+
+
+def test_index_held_by_another_thread(city, data_dir, closed):
+    registry = IndexRegistry(data_dir, check_interval=0.0)
+    holding, release = threading.Event(), threading.Event()
+    held = []
+
+    def reader():
+        with registry.reading():
+            held.append(registry.buildings(city))
+            holding.set()
+            release.wait(10.0)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    holding.wait(10.0)
+    rebuild(city, data_dir)
+    assert registry.buildings(city) is not held[0]
+    assert not closed
+    release.set()
+    thread.join()
+    assert closed == [held[0]]
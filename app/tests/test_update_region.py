@@ -0,0 +1,78 @@
+"""
+An in-place update of a region against its database rows, index and store,
+and a second run with the same data that changes nothing.
+"""
+import os
+
+import pytest
+from rtree import index
+
+from api.models import Address, Building
+from api.registry import index_path
+from api.store import GeometryStore, store_path
+from benchmarks.city import DEFAULT_ORIGIN, build_city, city_rows, generate_city
+from commands.update_region import update_region
+
+REGION = 'updateville'
+ORIGIN = (DEFAULT_ORIGIN[0], DEFAULT_ORIGIN[1] + 0.1)
+BUILDINGS = 100
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp('update') / 'gis_data')
+    os.makedirs(path)
+    generate_city(REGION, BUILDINGS, origin=ORIGIN, seed=2)
+    build_city(REGION, path)
+    return path
+
+
+@pytest.fixture(scope='module')
+def new_rows():
+    """
+    The generated rows with rows 1 and 2 gone, 3 and 4 changed and one
+    building and address added.
+    """
+    buildings, addresses = zip(*city_rows(REGION, BUILDINGS, 2_000.0, ORIGIN, 2))
+    buildings, addresses = [dict(b) for b in buildings], [dict(a) for a in addresses]
+    for row in buildings[3:5]:
+        row['height'] = (row['height'] or 0) + 10
+    for row in addresses[3:5]:
+        row['lon'] += 1e-5
+    buildings.append({**buildings[0], 'building_id': 'new',
+                      'polygon_points': [(x + 0.01, y) for x, y in buildings[0]['polygon_points']]})
+    addresses.append({**addresses[0], 'address_1': 1, 'full_address': '1 W Street0 St'})
+    del buildings[1:3], addresses[1:3]
+    return buildings, addresses
+
+
+def indexed(kind: str, data_dir: str) -> set:
+    rtree = index.Index(index_path(kind, REGION, data_dir))
+    try:
+        return set(rtree.intersection(rtree.bounds))
+    finally:
+        rtree.close()
+
+
+def test_update_and_rerun(data_dir, new_rows):
+    diffs = update_region(REGION, *new_rows, data_dir=data_dir)
+    for diff in diffs.values():
+        assert (len(diff.inserts), len(diff.updates), len(diff.deletes)) == (1, 2, 2)
+
+    expected = set(range(BUILDINGS + 1)) - {1, 2}
+    buildings = {b.idx: b for b in Building.select().where(Building.region == REGION)}
+    addresses = {a.idx: a for a in Address.select().where(Address.region == REGION)}
+    assert set(buildings) == set(addresses) == expected
+    assert indexed('buildings', data_dir) == indexed('addresses', data_dir) == expected
+    store = GeometryStore(store_path(REGION, data_dir))
+    assert set(store.building_idx.tolist()) == set(store.address_idx.tolist()) == expected
+    heights = dict(zip(store.building_idx.tolist(), store.building_height.tolist()))
+    assert [heights[i] for i in (3, 4)] == [buildings[3].height, buildings[4].height]
+
+    pointers = [index_path(kind, REGION, data_dir) for kind in ('buildings', 'addresses')]
+    signature = GeometryStore.file_signature(store_path(REGION, data_dir))
+    diffs = update_region(REGION, *new_rows, data_dir=data_dir)
+    assert all(diff.empty for diff in diffs.values())
+    assert diffs['buildings'].unchanged == diffs['addresses'].unchanged == len(expected)
+    assert [index_path(kind, REGION, data_dir) for kind in ('buildings', 'addresses')] == pointers
+    assert GeometryStore.file_signature(store_path(REGION, data_dir)) == signature